@@ -1,13 +1,36 @@
 import os
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+from flask import (Flask, render_template, request, flash, redirect, session,
+                   g, jsonify, abort)
+from markupsafe import Markup
 # from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
+from werkzeug.middleware.proxy_fix import ProxyFix
 
+from assets import assets
+from conditional import (DEFAULT, PRIVATE, PUBLIC, files_version,
+                         render_conditional)
+from current_user import CurrentUser, summaries
 from forms import UserAddForm, LoginForm, MessageForm, EditUserForm
-from models import db, connect_db, User, Message, Likes
+from fragments import fragments, make_shared_store, profile_version
+from like_buffer import like_buffer
+from metrics import metrics
+from models import (db, connect_db, create_indexes, User, Message, Likes,
+                    Follows, TimelineEntry)
+from pagination import Page, decode_cursor, keyset
+from passwords import PasswordHasherBusy, hasher
+from profiler import profiler
+from ratelimit import RateLimiter, make_store
+from search import make_search
+from sql_stats import sql_stats
+from username_index import usernames
 
 CURR_USER_KEY = "curr_user"
+MESSAGES_PER_PAGE = 100
+USERS_PER_PAGE = 48
+SEARCH_RESULTS_PER_PAGE = 20
+BUSY_MESSAGE = "We're very busy right now. Please try again in a moment."
+THROTTLED_MESSAGE = "Too many attempts. Please wait a moment and try again."
 
 app = Flask(__name__)
 
@@ -20,24 +43,278 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+
+# Part of every page's ETag, so pages cached before a deploy that changed
+# the templates or static files (whose hashed URLs pages include) aren't
+# reused after it (see conditional.py).
+app.config['PAGE_VERSION'] = os.environ.get(
+    'PAGE_VERSION',
+    files_version(os.path.join(app.root_path, app.template_folder),
+                  app.static_folder))
+
+# Authors with more followers than this aren't fanned out to their
+# followers' timelines on write; their messages are merged in on read.
+app.config['TIMELINE_FANOUT_MAX_FOLLOWERS'] = int(
+    os.environ.get('TIMELINE_FANOUT_MAX_FOLLOWERS', 10000))
+
+# How many of an author's most recent messages following them copies into
+# the follower's timeline (older ones are on the author's profile).
+app.config['TIMELINE_FOLLOW_BACKFILL'] = int(
+    os.environ.get('TIMELINE_FOLLOW_BACKFILL', MESSAGES_PER_PAGE))
+
+# How long (seconds) each worker caches the logged-in user's summary.
+app.config['CURRENT_USER_CACHE_TTL'] = float(
+    os.environ.get('CURRENT_USER_CACHE_TTL', 30))
+
+# How old (seconds) each worker's username autocomplete index may get
+# before it's rebuilt from the users table, in the background.
+app.config['USERNAME_INDEX_MAX_AGE'] = float(
+    os.environ.get('USERNAME_INDEX_MAX_AGE', 300))
+
+# bcrypt cost for new password hashes (existing hashes with another cost are
+# redone at login), and how many hashes may run/queue at once per worker
+# process (so a host runs up to PASSWORD_HASH_WORKERS per process).
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['PASSWORD_HASH_WORKERS'] = int(
+    os.environ.get('PASSWORD_HASH_WORKERS', 1))
+app.config['PASSWORD_HASH_QUEUE'] = int(
+    os.environ.get('PASSWORD_HASH_QUEUE', 32))
+
+# Message search uses Postgres full-text search when we're on Postgres, and
+# an in-process index otherwise; either can be forced with 'postgres' or
+# 'memory'. The in-process index is rebuilt in the background once it's
+# SEARCH_INDEX_MAX_AGE old.
+app.config['MESSAGE_SEARCH_BACKEND'] = os.environ.get(
+    'MESSAGE_SEARCH_BACKEND',
+    'postgres' if app.config['SQLALCHEMY_DATABASE_URI'].startswith('postgres')
+    else 'memory')
+app.config['SEARCH_INDEX_MAX_AGE'] = float(
+    os.environ.get('SEARCH_INDEX_MAX_AGE', 300))
+
+# Login/signup attempts allowed per client IP and per username: a burst of
+# LOGIN_RATE_LIMIT_BURST, then LOGIN_RATE_LIMIT_PER_MINUTE. The 'memory'
+# backend limits each worker separately; 'sqlite' shares limits between
+# every worker on the host through the file at LOGIN_RATE_LIMIT_PATH.
+app.config['LOGIN_RATE_LIMIT_BURST'] = int(
+    os.environ.get('LOGIN_RATE_LIMIT_BURST', 10))
+app.config['LOGIN_RATE_LIMIT_PER_MINUTE'] = float(
+    os.environ.get('LOGIN_RATE_LIMIT_PER_MINUTE', 5))
+app.config['LOGIN_RATE_LIMIT_BACKEND'] = os.environ.get(
+    'LOGIN_RATE_LIMIT_BACKEND', 'memory')
+app.config['LOGIN_RATE_LIMIT_PATH'] = os.environ.get(
+    'LOGIN_RATE_LIMIT_PATH', 'ratelimit.sqlite3')
+app.config['LOGIN_RATE_LIMIT_MAX_KEYS'] = int(
+    os.environ.get('LOGIN_RATE_LIMIT_MAX_KEYS', 100000))
+
+# Number of reverse proxies (load balancer, nginx, ...) in front of the app
+# whose X-Forwarded-For/-Proto headers are trusted. Behind one proxy, set it
+# to 1 so the rate limits above see each client's IP rather than the
+# proxy's. Leave it at 0 when clients reach the app directly: the headers
+# would then be whatever the client sent.
+app.config['TRUSTED_PROXY_HOPS'] = int(
+    os.environ.get('TRUSTED_PROXY_HOPS', 0))
+
+# Queue likes/unlikes in-process and write them in batches every
+# LIKE_WRITE_BEHIND_INTERVAL seconds, or once LIKE_WRITE_BEHIND_MAX_PENDING
+# are queued, instead of a transaction per click (see like_buffer.py).
+app.config['LIKE_WRITE_BEHIND'] = (
+    os.environ.get('LIKE_WRITE_BEHIND', '').lower() in ('1', 'true', 'yes'))
+app.config['LIKE_WRITE_BEHIND_INTERVAL'] = float(
+    os.environ.get('LIKE_WRITE_BEHIND_INTERVAL', 2))
+app.config['LIKE_WRITE_BEHIND_MAX_PENDING'] = int(
+    os.environ.get('LIKE_WRITE_BEHIND_MAX_PENDING', 1000))
+
+# Time every SQL statement, per request: statement counts and database
+# time go in X-SQL-Stats response headers (in debug mode, or with
+# SQL_STATS_HEADER), and statements slower than SQL_SLOW_QUERY_MS are
+# logged as JSON to the "sql_stats.slow" logger (see sql_stats.py).
+app.config['SQL_STATS'] = (
+    os.environ.get('SQL_STATS', '').lower() in ('1', 'true', 'yes'))
+app.config['SQL_SLOW_QUERY_MS'] = float(
+    os.environ.get('SQL_SLOW_QUERY_MS', 200))
+app.config['SQL_STATS_HEADER'] = app.debug or (
+    os.environ.get('SQL_STATS_HEADER', '').lower() in ('1', 'true', 'yes'))
+
+# Per-endpoint request counts, latency and database time, served at
+# /metrics for Prometheus. With more than one worker process, set
+# METRICS_DIR to a directory they share (see metrics.py). Database time
+# comes from sql_stats, so this turns on its statement timing too.
+app.config['METRICS'] = (
+    os.environ.get('METRICS', 'true').lower() in ('1', 'true', 'yes'))
+app.config['METRICS_DIR'] = os.environ.get('METRICS_DIR')
+
+# Profile requests carrying a signed X-Profile header (see `flask
+# profile-token`) and a PROFILE_SAMPLE_RATE fraction of all requests,
+# keeping the newest PROFILE_MAX_FILES profiles in PROFILE_DIR. Off unless
+# PROFILE_DIR is set (see profiler.py).
+app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR')
+app.config['PROFILE_SAMPLE_RATE'] = float(
+    os.environ.get('PROFILE_SAMPLE_RATE', 0))
+app.config['PROFILE_MAX_FILES'] = int(
+    os.environ.get('PROFILE_MAX_FILES', 200))
+app.config['PROFILE_TOKEN_MAX_AGE'] = int(
+    os.environ.get('PROFILE_TOKEN_MAX_AGE', 86400))
+
+# Rendered message cards are cached in each worker (up to
+# FRAGMENT_CACHE_SIZE of them) and, with FRAGMENT_CACHE_BACKEND 'sqlite',
+# in a file at FRAGMENT_CACHE_PATH shared by every worker on the host
+# (see fragments.py).
+app.config['FRAGMENT_CACHE_SIZE'] = int(
+    os.environ.get('FRAGMENT_CACHE_SIZE', 10000))
+app.config['FRAGMENT_CACHE_BACKEND'] = os.environ.get(
+    'FRAGMENT_CACHE_BACKEND', '')
+app.config['FRAGMENT_CACHE_PATH'] = os.environ.get(
+    'FRAGMENT_CACHE_PATH', 'fragments.sqlite3')
+app.config['FRAGMENT_CACHE_SHARED_SIZE'] = int(
+    os.environ.get('FRAGMENT_CACHE_SHARED_SIZE', 100000))
 # toolbar = DebugToolbarExtension(app)
 
+app.wsgi_app = ProxyFix(app.wsgi_app,
+                        x_for=app.config['TRUSTED_PROXY_HOPS'],
+                        x_proto=app.config['TRUSTED_PROXY_HOPS'])
+
 connect_db(app)
+assets.init_app(app)
+sql_stats.init_app(app, db.engine,
+                   app.config['SQL_STATS'] or app.config['METRICS'],
+                   app.config['SQL_SLOW_QUERY_MS'],
+                   app.config['SQL_STATS_HEADER'])
+profiler.init_app(app, app.config['PROFILE_DIR'],
+                  app.config['PROFILE_SAMPLE_RATE'],
+                  app.config['PROFILE_MAX_FILES'],
+                  app.config['PROFILE_TOKEN_MAX_AGE'])
+metrics.init_app(app, app.config['METRICS'], app.config['METRICS_DIR'])
+summaries.ttl = app.config['CURRENT_USER_CACHE_TTL']
+message_search = make_search(app.config['MESSAGE_SEARCH_BACKEND'])
+hasher.configure(app.config['BCRYPT_LOG_ROUNDS'],
+                 app.config['PASSWORD_HASH_WORKERS'],
+                 app.config['PASSWORD_HASH_QUEUE'])
+login_limiter = RateLimiter(
+    make_store(app.config['LOGIN_RATE_LIMIT_BACKEND'],
+               app.config['LOGIN_RATE_LIMIT_PATH'],
+               app.config['LOGIN_RATE_LIMIT_MAX_KEYS']),
+    burst=app.config['LOGIN_RATE_LIMIT_BURST'],
+    rate=app.config['LOGIN_RATE_LIMIT_PER_MINUTE'] / 60)
+like_buffer.configure(app.config['LIKE_WRITE_BEHIND'],
+                      app.config['LIKE_WRITE_BEHIND_INTERVAL'],
+                      app.config['LIKE_WRITE_BEHIND_MAX_PENDING'])
+if like_buffer.enabled:
+    like_buffer.init_app(app)
+fragments.configure(app.config['FRAGMENT_CACHE_SIZE'],
+                    make_shared_store(app.config['FRAGMENT_CACHE_BACKEND'],
+                                      app.config['FRAGMENT_CACHE_PATH'],
+                                      app.config['FRAGMENT_CACHE_SHARED_SIZE']))
 
 ##############################################################################
 # User signup/login/logout
 
+# pages that show more of the logged-in user than their summary (the home
+# page's header image and counts), which load the full row up front
+FULL_USER_ENDPOINTS = {'homepage'}
+
+
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
+
+    This is a cached summary of the user; the full row is only loaded if
+    a handler needs more than their id, username and image.
+    """
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = CurrentUser.get(session[CURR_USER_KEY],
+                                 full=request.endpoint in FULL_USER_ENDPOINTS)
 
     else:
         g.user = None
 
 
+def liked_ids(messages):
+    """Ids of `messages` the current user has liked, in one query.
+
+    Includes their likes/unlikes still waiting in the write-behind buffer.
+    """
+
+    liked = Likes.liked_ids(g.user.id, [msg.id for msg in messages])
+
+    if like_buffer.enabled:
+        return like_buffer.overlay(g.user.id, liked)
+
+    return liked
+
+
+@app.template_global()
+def like_count(msg):
+    """How many likes `msg` has, including any in the write-behind buffer."""
+
+    if like_buffer.enabled:
+        return msg.like_count + like_buffer.delta([msg.id])[msg.id]
+
+    return msg.like_count
+
+
+@app.template_global()
+def message_card(msg):
+    """The viewer-independent part of `msg`'s card in message lists, from
+    the fragment cache if we have it."""
+
+    version = profile_version(msg.user)
+    html = fragments.get(msg.id, version)
+
+    if html is None:
+        html = app.jinja_env.get_template('messages/card.html').render(msg=msg)
+        fragments.set(msg.id, msg.user_id, version, html)
+
+    return Markup(html)
+
+
+def viewer_version():
+    """What every page's version needs to know about who's looking: the
+    navbar shows their username and image."""
+
+    if not g.user:
+        return None
+
+    return (g.user.id, g.user.username, g.user.image_url)
+
+
+def settle_likes(user):
+    """Write the current user's buffered likes before showing their own
+    likes or like count, which come straight from the likes table."""
+
+    if like_buffer.enabled and g.user and g.user.id == user.id:
+        like_buffer.flush(user.id)
+
+
+def following_ids(users):
+    """Ids of `users` the current user follows, in one query."""
+
+    if not g.user:
+        return set()
+
+    return g.user.following_ids([user.id for user in users
+                                 if user.id != g.user.id])
+
+
+def throttle(template, form, username):
+    """Check a login/signup attempt against the rate limits.
+
+    Returns a 429 response if the client IP or username is out of
+    attempts, or None to go ahead. This runs before any bcrypt work.
+    """
+
+    wait = login_limiter.hit(f"ip:{request.remote_addr}",
+                             f"user:{username.lower()}")
+    if not wait:
+        return None
+
+    flash(THROTTLED_MESSAGE, 'danger')
+    response = app.make_response(
+        (render_template(template, form=form), 429))
+    response.headers['Retry-After'] = str(int(wait) + 1)
+    return response
+
+
 def do_login(user):
     """Log in user."""
 
@@ -67,6 +344,10 @@ def signup():
 
     # if form.validate_on_submit():
     if form.is_submitted() and form.validate():
+        throttled = throttle('users/signup.html', form, form.username.data)
+        if throttled:
+            return throttled
+
         try:
             user = User.signup(
                 username=form.username.data,
@@ -75,11 +356,16 @@ def signup():
                 image_url=form.image_url.data or User.image_url.default.arg,
             )
             db.session.commit()
+            usernames.add(user.id, user.username)
 
         except IntegrityError:
             flash("Username already taken", 'danger')
             return render_template('users/signup.html', form=form)
 
+        except PasswordHasherBusy:
+            flash(BUSY_MESSAGE, 'danger')
+            return render_template('users/signup.html', form=form), 503
+
         do_login(user)
 
         return redirect("/")
@@ -96,10 +382,21 @@ def login():
 
     # if form.validate_on_submit():
     if form.is_submitted() and form.validate():
-        user = User.authenticate(form.username.data,
-                                 form.password.data)
+        throttled = throttle('users/login.html', form, form.username.data)
+        if throttled:
+            return throttled
+
+        try:
+            user = User.authenticate(form.username.data,
+                                     form.password.data)
+
+        except PasswordHasherBusy:
+            flash(BUSY_MESSAGE, 'danger')
+            return render_template('users/login.html', form=form), 503
 
         if user:
+            # saves the new hash if authenticate() rehashed their password
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -125,38 +422,143 @@ def logout():
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username, and a
+    'page' param for later pages. Search results put an exact match first,
+    then usernames starting with the search, then any containing it.
     """
 
     search = request.args.get('q')
+    page = max(request.args.get('page', 1, type=int), 1)
 
     if not g.user:
         flash("Access unauthorized. Please sign up or log in", "danger")
         return redirect("/")
 
     if not search:
-        users = User.query.filter(User.id != g.user.id).all()
+        query = (User
+                 .query
+                 .filter(User.id != g.user.id)
+                 .order_by(User.username))
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        term = escape_like(search)
+        rank = db.case(
+            (db.func.lower(User.username) == search.lower(), 0),
+            (User.username.ilike(f"{term}%", escape='\\'), 1),
+            else_=2)
+        query = (User
+                 .query
+                 .filter(User.username.ilike(f"%{term}%", escape='\\'))
+                 .order_by(rank, User.username))
+
+    users = (query
+             .offset((page - 1) * USERS_PER_PAGE)
+             .limit(USERS_PER_PAGE + 1)
+             .all())
+    has_next = len(users) > USERS_PER_PAGE
+    users = users[:USERS_PER_PAGE]
+
+    return render_template('users/index.html', users=users, search=search,
+                           page=page, has_next=has_next,
+                           following_ids=following_ids(users))
+
+
+@app.route('/api/users/autocomplete')
+def users_autocomplete():
+    """Return JSON of usernames starting with 'q': {users: [{id, username}]}."""
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    prefix = request.args.get('q', '')
+    limit = min(request.args.get('limit', 10, type=int), 50)
+
+    if not prefix:
+        return jsonify(users=[])
+
+    usernames.refresh(app.config['USERNAME_INDEX_MAX_AGE'])
+    matches = usernames.complete(prefix, limit)
+
+    return jsonify(users=[{"id": user_id, "username": username}
+                          for user_id, username in matches])
+
+
+def escape_like(term):
+    """Escape LIKE wildcards in `term` so it matches literally."""
+
+    return (term
+            .replace('\\', '\\\\')
+            .replace('%', '\\%')
+            .replace('_', '\\_'))
+
+
+def get_page_cursors():
+    """Get decoded `before`/`after` cursors from the querystring.
+
+    Responds with a 400 if either cursor is malformed.
+    """
+
+    try:
+        return tuple(decode_cursor(request.args[arg]) if request.args.get(arg)
+                     else None
+                     for arg in ('before', 'after'))
+
+    except ValueError:
+        abort(400)
+
+
+def user_messages_page(user_id):
+    """Get the requested page of a user's messages, newest first."""
+
+    before, after = get_page_cursors()
+
+    # snagging messages in order from the database;
+    # user.messages won't be in order by default
+    query = Message.query.filter(Message.user_id == user_id)
+    rows = (keyset(query, Message.timestamp, Message.id, before, after)
+            .limit(MESSAGES_PER_PAGE + 1)
+            .all())
 
-    return render_template('users/index.html', users=users)
+    return Page(rows, MESSAGES_PER_PAGE, before, after)
 
 
 @app.route('/users/<int:user_id>')
 def users_show(user_id):
-    """Show user profile."""
+    """Show user profile.
+
+    Takes `before`/`after` cursors in the querystring to page through
+    the user's messages.
+    """
 
     user = User.query.get_or_404(user_id)
+    settle_likes(user)
+    page = user_messages_page(user_id)
+    following = following_ids([user])
+
+    version = (viewer_version(), user.username, user.image_url,
+               user.header_image_url, user.bio, user.location,
+               user.messages_count, user.following_count,
+               user.followers_count,
+               user.likes_count if g.user and g.user.id == user.id else None,
+               user.id in following, page.older, page.newer,
+               [(msg.id, like_count(msg)) for msg in page.items])
+
+    return render_conditional(version, PRIVATE, 'users/show.html', user=user,
+                              messages=page.items, page=page,
+                              following_ids=following)
 
-    # snagging messages in order from the database;
-    # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages)
+
+@app.route('/api/users/<int:user_id>/messages')
+def users_show_json(user_id):
+    """Return JSON page of a user's messages: {messages, older, newer}."""
+
+    # keep a reference to the user, so each message's author comes from
+    # the session's identity map rather than a query per message
+    user = User.query.get_or_404(user_id)
+    page = user_messages_page(user.id)
+
+    return jsonify(messages=[msg.serialize() for msg in page.items],
+                   older=page.older,
+                   newer=page.newer)
 
 
 @app.route('/users/<int:user_id>/following')
@@ -168,7 +570,9 @@ def show_following(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    settle_likes(user)
+    return render_template('users/following.html', user=user,
+                           following_ids=following_ids([user, *user.following]))
 
 
 @app.route('/users/<int:user_id>/followers')
@@ -180,18 +584,31 @@ def users_followers(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    settle_likes(user)
+    return render_template('users/followers.html', user=user,
+                           following_ids=following_ids([user, *user.followers]))
 
 @app.route('/users/<int:user_id>/likes')
 def users_likes(user_id):
     """Show list of liked messages"""
-    user = User.query.get_or_404(user_id)
-    messages = g.user.likes
+
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    return render_template('users/likes.html', user = user, messages = messages)
+    user = User.query.get_or_404(user_id)
+    settle_likes(user)
+    messages = (Message
+                .query
+                .join(Likes, Likes.message_id == Message.id)
+                .filter(Likes.user_id == user_id)
+                .options(db.joinedload(Message.user))
+                .order_by(Likes.created_at.desc(), Likes.message_id.desc())
+                .all())
+
+    return render_template('users/likes.html', user = user, messages = messages,
+                           liked_ids = liked_ids(messages),
+                           following_ids = following_ids([user]))
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -204,6 +621,11 @@ def add_follow(follow_id):
 
     followed_user = User.query.get_or_404(follow_id)
     g.user.following.append(followed_user)
+    User.adjust_counter('following_count', 1, [g.user.id])
+    User.adjust_counter('followers_count', 1, [followed_user.id])
+    TimelineEntry.add_author(g.user.id, followed_user.id,
+                             app.config['TIMELINE_FANOUT_MAX_FOLLOWERS'],
+                             app.config['TIMELINE_FOLLOW_BACKFILL'])
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
@@ -219,6 +641,9 @@ def stop_following(follow_id):
 
     followed_user = User.query.get(follow_id)
     g.user.following.remove(followed_user)
+    User.adjust_counter('following_count', -1, [g.user.id])
+    User.adjust_counter('followers_count', -1, [followed_user.id])
+    TimelineEntry.remove_author(g.user.id, followed_user.id)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
@@ -237,16 +662,29 @@ def profile():
         return redirect("/login")
 
     if form.is_submitted() and form.validate():
-        if g.user.check_password(form.password.data):
-            g.user.username = form.username.data
-            g.user.email = form.email.data
-            g.user.image_url = form.image_url.data
-            g.user.header_image_url = form.header_image_url.data
-            g.user.bio = form.bio.data
-            g.user.location = form.location.data
-
-            db.session.add(g.user)
+        user = g.user.load()
+
+        try:
+            password_ok = user.check_password(form.password.data)
+
+        except PasswordHasherBusy:
+            flash(BUSY_MESSAGE, 'danger')
+            return render_template('users/edit.html', form = form,
+                                   user = g.user), 503
+
+        if password_ok:
+            user.username = form.username.data
+            user.email = form.email.data
+            user.image_url = form.image_url.data
+            user.header_image_url = form.header_image_url.data
+            user.bio = form.bio.data
+            user.location = form.location.data
+
+            db.session.add(user)
             db.session.commit()
+            summaries.invalidate(user.id)
+            usernames.add(user.id, user.username)
+            fragments.invalidate_author(user.id)
 
             return redirect('/')
 
@@ -267,8 +705,25 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    # everyone this user followed loses a follower, and vice versa
+    followed = (db.select(Follows.user_being_followed_id)
+                .where(Follows.user_following_id == g.user.id))
+    followers = (db.select(Follows.user_following_id)
+                 .where(Follows.user_being_followed_id == g.user.id))
+    User.adjust_counter('followers_count', -1, followed)
+    User.adjust_counter('following_count', -1, followers)
+
+    # and every message they liked loses a like. Likes they still have
+    # queued in other workers are dropped when written, as they're gone
+    settle_likes(g.user)
+    Message.adjust_like_count(
+        -1, db.select(Likes.message_id).where(Likes.user_id == g.user.id))
+
+    db.session.delete(g.user.load())
     db.session.commit()
+    summaries.invalidate(g.user.id)
+    usernames.remove(g.user.id)
+    fragments.invalidate_author(g.user.id)
 
     return redirect("/signup")
 
@@ -293,8 +748,16 @@ def messages_add():
     if form.is_submitted() and form.validate():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        User.adjust_counter('messages_count', 1, [g.user.id])
+        db.session.flush()
+        written = TimelineEntry.fan_out(
+            msg, app.config['TIMELINE_FANOUT_MAX_FOLLOWERS'])
         db.session.commit()
 
+        app.logger.debug("timeline fan-out: message %s wrote %s entries",
+                         msg.id, written)
+        message_search.add(msg)
+
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
@@ -308,9 +771,19 @@ def messages_show(message_id):
         flash('Access unauthorized.', "danger")
         return redirect('/login')
 
-    msg = Message.query.get(message_id)
+    msg = db.session.get(Message, message_id,
+                         options=[db.joinedload(Message.user)])
     if msg is not None:   
-        return render_template('messages/show.html', message=msg)
+        liked = liked_ids([msg])
+        following = following_ids([msg.user])
+
+        version = (viewer_version(), msg.id, like_count(msg),
+                   msg.user.username, msg.user.image_url,
+                   msg.id in liked, msg.user.id in following)
+
+        return render_conditional(version, PRIVATE, 'messages/show.html',
+                                  message=msg, liked_ids=liked,
+                                  following_ids=following)
     return render_template('404.html')
 
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
@@ -324,8 +797,12 @@ def messages_destroy(message_id):
         return redirect("/")
 
     if g.user.id == msg.user_id:
+        TimelineEntry.remove_message(msg.id)
+        User.adjust_counter('messages_count', -1, [g.user.id])
         db.session.delete(msg)
         db.session.commit()
+        message_search.remove(message_id)
+        fragments.invalidate_message(message_id)
         flash('Deleted Successfully', 'success')
 
     return redirect(f"/users/{g.user.id}")
@@ -334,29 +811,124 @@ def messages_destroy(message_id):
 def like_message(msg_id):
     """Like a message"""
 
-    msg = Message.query.filter(Message.id == msg_id).first()
-
     if not g.user:
         flash('Access unauthorized.', "danger")
         return redirect('/login')
 
-    new_like = Likes(user_id = g.user.id, message_id = msg_id)
+    Message.query.get_or_404(msg_id)
 
-    db.session.add(new_like)
-    db.session.commit()
+    if like_buffer.enabled:
+        # queued even if it looks liked: another worker may be holding an
+        # unlike of it
+        liked = msg_id in like_buffer.overlay(
+            g.user.id, Likes.liked_ids(g.user.id, [msg_id]))
+        like_buffer.like(g.user.id, msg_id, liked)
+
+    elif not db.session.get(Likes, (g.user.id, msg_id)):
+        try:
+            db.session.add(Likes(user_id = g.user.id, message_id = msg_id))
+            db.session.flush()
+            Message.adjust_like_count(1, [msg_id])
+            db.session.commit()
+
+        except IntegrityError:
+            # liked it in another request at the same time
+            db.session.rollback()
 
     return redirect('/')
 
 @app.route('/users/remove_like/<int:msg_id>', methods=['POST'])
 def remove_like(msg_id):
     """Unlike a message"""
-    msg = Likes.query.filter_by(message_id = msg_id, user_id = g.user.id).first()
 
-    db.session.delete(msg)
+    if not g.user:
+        flash('Access unauthorized.', "danger")
+        return redirect('/login')
+
+    if like_buffer.enabled:
+        # queued even if it doesn't look liked: another worker may be
+        # holding a like of it
+        liked = msg_id in like_buffer.overlay(
+            g.user.id, Likes.liked_ids(g.user.id, [msg_id]))
+        like_buffer.unlike(g.user.id, msg_id, liked)
+
+        return redirect('/')
+
+    removed = db.session.execute(
+        db.delete(Likes)
+        .where(Likes.user_id == g.user.id, Likes.message_id == msg_id)
+    ).rowcount
+
+    if removed:
+        Message.adjust_like_count(-1, [msg_id])
     db.session.commit()
 
     return redirect('/')
 
+##############################################################################
+# Message search
+
+
+def search_results():
+    """Get the requested page of messages matching the 'q' param.
+
+    Returns (messages, page number, whether there's a next page).
+    """
+
+    terms = request.args.get('q', '').strip()
+    page = max(request.args.get('page', 1, type=int), 1)
+
+    if not terms:
+        return [], page, False
+
+    message_search.refresh(app.config['SEARCH_INDEX_MAX_AGE'])
+    ids = message_search.search(terms,
+                                (page - 1) * SEARCH_RESULTS_PER_PAGE,
+                                SEARCH_RESULTS_PER_PAGE + 1)
+    has_next = len(ids) > SEARCH_RESULTS_PER_PAGE
+    ids = ids[:SEARCH_RESULTS_PER_PAGE]
+
+    found = {msg.id: msg for msg in (Message
+                                     .query
+                                     .filter(Message.id.in_(ids))
+                                     .options(db.joinedload(Message.user)))}
+
+    # keep search ranking order; skip anything deleted since it was indexed
+    return [found[id] for id in ids if id in found], page, has_next
+
+
+@app.route('/search')
+def search():
+    """Search messages by text, best matches first.
+
+    Takes 'q' (the search) and 'page' params in the querystring.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    messages, page, has_next = search_results()
+
+    return render_template('messages/search.html', messages=messages,
+                           search=request.args.get('q', ''), page=page,
+                           has_next=has_next, liked_ids=liked_ids(messages))
+
+
+@app.route('/api/search')
+def search_json():
+    """Return JSON of matching messages: {messages, page, has_next}."""
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    messages, page, has_next = search_results()
+
+    return jsonify(messages=[msg.serialize() for msg in messages],
+                   page=page,
+                   has_next=has_next)
+
+
 ##############################################################################
 # Homepage and error pages
 
@@ -366,21 +938,58 @@ def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: 100 most recent messages of followed_users, paged with
+      `before`/`after` cursors in the querystring
     """
 
     if g.user:
-        display_ids = [f.id for f in g.user.following] + [g.user.id]
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(display_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-        return render_template('home.html', messages=messages)
+        page = home_timeline_page()
+        liked = liked_ids(page.items)
+
+        version = (viewer_version(), g.user.header_image_url,
+                   g.user.messages_count, g.user.following_count,
+                   g.user.followers_count, page.older, page.newer,
+                   [(msg.id, like_count(msg), msg.user.username,
+                     msg.user.image_url) for msg in page.items],
+                   sorted(liked))
+
+        return render_conditional(version, PRIVATE, 'home.html',
+                                  messages=page.items, page=page,
+                                  liked_ids=liked)
 
     else:
-        return render_template('home-anon.html')
+        return render_conditional((), PUBLIC, 'home-anon.html')
+
+def home_timeline_page():
+    """Get the requested page of the current user's home timeline."""
+
+    before, after = get_page_cursors()
+
+    # timelines are materialized when messages are posted, so this is
+    # one range read on the user's own timeline entries, plus a merge
+    # of any high-follower authors that weren't fanned out
+    rows, stats = TimelineEntry.read(
+        g.user.id, MESSAGES_PER_PAGE + 1,
+        app.config['TIMELINE_FANOUT_MAX_FOLLOWERS'], before, after)
+
+    app.logger.debug("timeline merge: %(pulled_authors)s pulled authors, "
+                     "%(candidates)s candidates, %(merge_ms).2fms", stats)
+
+    return Page(rows, MESSAGES_PER_PAGE, before, after)
+
+
+@app.route('/api/timeline')
+def homepage_json():
+    """Return JSON page of home timeline: {messages, older, newer}."""
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    page = home_timeline_page()
+
+    return jsonify(messages=[msg.serialize() for msg in page.items],
+                   older=page.older,
+                   newer=page.newer)
 
 # custom 404 error page
 @app.errorhandler(404)
@@ -388,18 +997,69 @@ def not_found(e):
     return render_template('404.html')
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
+# Caching
 #
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+# Pages that support conditional GETs set their own Cache-Control (see
+# render_conditional); nothing else may be stored.
 
 @app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+def add_header(response):
+    """Don't let responses without a caching policy of their own be stored."""
+
+    response.headers.setdefault('Cache-Control', DEFAULT)
+    return response
+
+
+##############################################################################
+# Management commands
+#
+# run these like:
+#
+#    flask --app app backfill-timelines
+
+@app.cli.command('backfill-timelines')
+def backfill_timelines():
+    """Rebuild every user's home timeline from messages and follows."""
+
+    # the rebuild leaves out high-follower authors, by their follower count
+    User.reconcile_counters()
+    count = TimelineEntry.rebuild(app.config['TIMELINE_FANOUT_MAX_FOLLOWERS'])
+    db.session.commit()
+
+    print(f"Wrote {count} timeline entries.")
+
+
+@app.cli.command('reconcile-counters')
+def reconcile_counters():
+    """Recompute users' message/following/follower counts from scratch."""
+
+    drifted = User.reconcile_counters()
+    db.session.commit()
+
+    print(f"Fixed counters for {drifted} users.")
+
+
+@app.cli.command('recount-likes')
+def recount_likes():
+    """Recompute every message's like count from the likes table."""
+
+    drifted = Message.recount_likes()
+    db.session.commit()
+
+    print(f"Fixed like counts for {drifted} messages.")
+
+
+@app.cli.command('create-indexes')
+def create_missing_indexes():
+    """Create indexes declared on the models but missing from the database."""
+
+    created = create_indexes(db.engine)
+
+    print(f"Created {len(created)} indexes.")
+
+
+@app.cli.command('profile-token')
+def profile_token():
+    """Print a token to send as an X-Profile header to profile a request."""
+
+    print(profiler.make_token(app.secret_key))
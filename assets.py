@@ -0,0 +1,151 @@
+"""Fingerprinted static assets, cached by browsers for a year.
+
+At startup every file under static/ is read and given a name with a hash
+of its contents in it (stylesheets/style.css becomes something like
+stylesheets/style.3f2a9c1b7d4e.css), served under /assets/. Since the
+name changes whenever the contents do, responses are marked immutable and
+cached for a year; a deploy that changes a file changes its URL.
+
+Templates get URLs with `asset_url('stylesheets/style.css')`. Stylesheets'
+url(/static/...) references are rewritten to the hashed names too (and
+their hashes taken after that), so images they use are cached the same way.
+
+Text files (CSS, JS, SVG, icons) are compressed once at startup, with gzip
+and, if the brotli package is installed, brotli, and sent compressed to
+browsers that accept it. static/ is small, so it's all kept in memory.
+The plain /static/ URLs still work (user images stored in the database
+use them), but aren't cached for long.
+"""
+
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+from collections import namedtuple
+
+from flask import abort, request, url_for
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+COMPRESSIBLE = ('text/', 'application/javascript', 'application/json',
+                'image/svg+xml', 'image/vnd.microsoft.icon', 'image/x-icon')
+
+CSS_URL = re.compile(r'''url\(\s*(["']?)/static/([^"')]+)\1\s*\)''')
+
+Asset = namedtuple('Asset', ['mimetype', 'bodies'])
+
+
+def compress(mimetype, body):
+    """{content coding: body} for the variants worth sending, always
+    including the uncompressed 'identity'."""
+
+    bodies = {'identity': body}
+
+    if not mimetype.startswith(COMPRESSIBLE):
+        return bodies
+
+    variants = {'gzip': gzip.compress(body, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants['br'] = brotli.compress(body)
+
+    bodies.update((coding, compressed)
+                  for coding, compressed in variants.items()
+                  if len(compressed) < len(body))
+    return bodies
+
+
+class Assets:
+    """Hashed names and contents of every file in a static folder."""
+
+    def __init__(self):
+        self.url_path = '/assets'
+        self.names = {}
+        self.files = {}
+
+    def init_app(self, app, url_path='/assets'):
+        """Fingerprint `app`'s static folder, and add the /assets route and
+        the `asset_url` template function."""
+
+        self.url_path = url_path
+        self.build(app.static_folder)
+        app.add_url_rule(f"{url_path}/<path:filename>", 'asset', self.serve)
+        app.add_template_global(self.url, 'asset_url')
+
+    def build(self, folder):
+        """Read and hash every file in `folder`, stylesheets last so the
+        files they refer to have their hashed names already."""
+
+        self.names = {}
+        self.files = {}
+
+        paths = sorted(
+            os.path.relpath(os.path.join(directory, filename), folder)
+            .replace(os.sep, '/')
+            for directory, _, filenames in os.walk(folder)
+            for filename in filenames)
+
+        for path in sorted(paths, key=lambda path: path.endswith('.css')):
+            with open(os.path.join(folder, path), 'rb') as asset:
+                body = asset.read()
+
+            if path.endswith('.css'):
+                body = CSS_URL.sub(self._rewrite, body.decode()).encode()
+
+            self.add(path, body)
+
+    def _rewrite(self, match):
+        quote, path = match.groups()
+        hashed = self.names.get(path)
+
+        # built before there's a request to build URLs with url_for
+        if hashed is None:
+            return match.group(0)
+        return f"url({quote}{self.url_path}/{hashed}{quote})"
+
+    def add(self, path, body):
+        digest = hashlib.sha256(body).hexdigest()[:12]
+        stem, extension = os.path.splitext(path)
+        hashed = f"{stem}.{digest}{extension}"
+
+        mimetype = (mimetypes.guess_type(path)[0]
+                    or 'application/octet-stream')
+        bodies = compress(mimetype, body)
+        if mimetype.startswith('text/'):
+            mimetype += '; charset=utf-8'
+
+        self.names[path] = hashed
+        self.files[hashed] = Asset(mimetype, bodies)
+
+    def url(self, path):
+        """The URL of static file `path`: hashed if we know it."""
+
+        hashed = self.names.get(path)
+        if hashed is None:
+            return url_for('static', filename=path)
+
+        return url_for('asset', filename=hashed)
+
+    def serve(self, filename):
+        asset = self.files.get(filename)
+        if asset is None:
+            abort(404)
+
+        headers = {'Content-Type': asset.mimetype,
+                   'Cache-Control': CACHE_CONTROL,
+                   'Vary': 'Accept-Encoding'}
+
+        for coding in ('br', 'gzip'):
+            if coding in asset.bodies and request.accept_encodings[coding]:
+                headers['Content-Encoding'] = coding
+                return asset.bodies[coding], 200, headers
+
+        return asset.bodies['identity'], 200, headers
+
+
+assets = Assets()
@@ -0,0 +1,70 @@
+"""Benchmark password checks (logins) per second at each bcrypt cost.
+
+For each cost, times password checks on one thread (logins/sec/core) and
+through a PasswordHasher pool with one worker per CPU (logins/sec for the
+whole machine). Run from the project root like:
+
+    python benchmarks/bench_passwords.py
+    python benchmarks/bench_passwords.py --costs 10 12 14 --checks 20
+"""
+
+import argparse
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from passwords import PasswordHasher, bcrypt  # noqa: E402
+
+PASSWORD = 'correct horse battery staple'
+
+
+def per_core_rate(hashed, checks):
+    """Password checks per second on a single thread."""
+
+    start = perf_counter()
+    for _ in range(checks):
+        bcrypt.check_password_hash(hashed, PASSWORD)
+
+    return checks / (perf_counter() - start)
+
+
+def pool_rate(hasher, hashed, checks, clients):
+    """Password checks per second with `clients` requests hitting the pool."""
+
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as requests:
+        list(requests.map(lambda _: hasher.check(hashed, PASSWORD),
+                          range(checks)))
+
+    return checks / (perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--costs', type=int, nargs='+',
+                        default=[10, 11, 12, 13])
+    parser.add_argument('--checks', type=int, default=10,
+                        help='password checks to time at each cost')
+    args = parser.parse_args()
+
+    cores = os.cpu_count() or 1
+    print(f"{cores} cores")
+    print(f"{'cost':>5} {'ms/check':>9} {'logins/s/core':>14} "
+          f"{'logins/s (pool)':>16}")
+
+    for cost in args.costs:
+        hasher = PasswordHasher(rounds=cost, workers=cores, queue=args.checks)
+        hashed = hasher.hash(PASSWORD)
+
+        single = per_core_rate(hashed, args.checks)
+        pooled = pool_rate(hasher, hashed, args.checks, clients=cores * 2)
+
+        print(f"{cost:>5} {1000 / single:>9.1f} {single:>14.1f} "
+              f"{pooled:>16.1f}")
+
+
+if __name__ == '__main__':
+    main()
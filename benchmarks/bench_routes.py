@@ -0,0 +1,386 @@
+"""Benchmark every route against small, medium and large datasets.
+
+For each dataset tier, generates synthetic CSVs (with the generator),
+bulk loads them, then drives each route through the Flask test client,
+recording p50/p95/p99 latency, SQL statements per request and peak Python
+memory per request. Pages are requested as a logged-in user; write and
+auth routes (posting, following, signing up, logging in, editing and
+deleting accounts) each have untimed setup and teardown requests, like
+unfollowing before each timed follow, so every timed request does the
+same work. The one route left out is Flask's /static, which serves
+files the same way /assets does and is timed through that. Results are
+written as JSON; pass a baseline from an earlier run to flag
+regressions. Run from the project root like:
+
+    python benchmarks/bench_routes.py --out bench.json
+    python benchmarks/bench_routes.py --tiers small medium \\
+        --baseline bench.json --out new.json
+
+The dataset is loaded into --database-url (dropping what's there), so
+point it at a scratch database.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import tracemalloc
+from argparse import Namespace
+from collections import namedtuple
+from datetime import datetime
+from itertools import count
+from statistics import quantiles
+from time import perf_counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'generator'))
+
+# users, messages, follows
+TIERS = {
+    'small': (300, 1000, 5000),
+    'medium': (5000, 50000, 100000),
+    'large': (50000, 1000000, 2000000),
+}
+
+USER_ID = 1
+
+# every generated user's password (see generator/create_csvs.py)
+PASSWORD = 'password'
+
+# A request to time: `method path` with form `data` (a dict, or a function
+# making one), sent by the 'user' client (logged in as USER_ID) or the
+# 'visitor' one (logged out unless a setup logs it in). `setup(client)`
+# runs first and may return the path to use instead; `teardown(client)`
+# runs after. Neither is timed.
+Route = namedtuple('Route', ['name', 'method', 'path', 'data', 'client',
+                             'setup', 'teardown'],
+                   defaults=(None, 'user', None, None))
+
+
+def latest_message_id(user_id):
+    from models import db, Message
+
+    return db.session.scalar(
+        db.select(Message.id)
+        .where(Message.user_id == user_id)
+        .order_by(Message.id.desc())
+        .limit(1))
+
+
+def is_following(user_id, other_id):
+    from models import db, Follows
+
+    return db.session.scalar(
+        db.select(db.func.count())
+        .select_from(Follows)
+        .where(Follows.user_following_id == user_id,
+               Follows.user_being_followed_id == other_id)) > 0
+
+
+def routes(message_id, other_id, user, asset_path):
+    """Each route to time. `user` is USER_ID's row, `other_id` a user they
+    can follow and `message_id` a message of theirs."""
+
+    from app import CURR_USER_KEY, login_limiter
+    from ratelimit import MemoryStore
+
+    new_usernames = (f"benchuser{n}" for n in count())
+
+    def new_account():
+        username = next(new_usernames)
+        return {'username': username, 'email': f"{username}@bench.test",
+                'password': PASSWORD}
+
+    def post_message(client):
+        client.post('/messages/new', data={'text': 'benchmark warble'})
+        return f'/messages/{latest_message_id(USER_ID)}/delete'
+
+    def delete_latest_message(client):
+        client.post(f'/messages/{latest_message_id(USER_ID)}/delete')
+
+    def unfollow(client):
+        if is_following(USER_ID, other_id):
+            client.post(f'/users/stop-following/{other_id}')
+
+    def follow(client):
+        if not is_following(USER_ID, other_id):
+            client.post(f'/users/follow/{other_id}')
+
+    def allow_logins(client):
+        # every timed attempt comes from the same IP and username
+        login_limiter.store = MemoryStore()
+
+    def log_in(client):
+        with client.session_transaction() as session:
+            session[CURR_USER_KEY] = USER_ID
+
+    def log_out(client):
+        client.get('/logout')
+
+    def sign_up(client):
+        allow_logins(client)
+        client.post('/signup', data=new_account())
+
+    def delete_account(client):
+        client.post('/users/delete')
+
+    profile = {'username': user.username, 'email': user.email,
+               'image_url': user.image_url,
+               'header_image_url': user.header_image_url,
+               'bio': user.bio or '', 'location': user.location or '',
+               'password': PASSWORD}
+
+    return [
+        Route('homepage', 'GET', '/'),
+        Route('timeline_json', 'GET', '/api/timeline'),
+        Route('list_users', 'GET', '/users'),
+        Route('list_users_search', 'GET', '/users?q=time'),
+        Route('users_autocomplete', 'GET', '/api/users/autocomplete?q=ti'),
+        Route('users_show', 'GET', f'/users/{other_id}'),
+        Route('users_show_json', 'GET', f'/api/users/{other_id}/messages'),
+        Route('show_following', 'GET', f'/users/{USER_ID}/following'),
+        Route('users_followers', 'GET', f'/users/{USER_ID}/followers'),
+        Route('users_likes', 'GET', f'/users/{USER_ID}/likes'),
+        Route('messages_show', 'GET', f'/messages/{message_id}'),
+        Route('search', 'GET', '/search?q=coffee+music'),
+        Route('search_json', 'GET', '/api/search?q=coffee+music'),
+        Route('like_message', 'POST', f'/users/add_like/{message_id}'),
+        Route('remove_like', 'POST', f'/users/remove_like/{message_id}'),
+        Route('messages_add_form', 'GET', '/messages/new'),
+        Route('messages_add', 'POST', '/messages/new',
+              {'text': 'benchmark warble'},
+              teardown=delete_latest_message),
+        Route('messages_destroy', 'POST', None, setup=post_message),
+        Route('add_follow', 'POST', f'/users/follow/{other_id}',
+              setup=unfollow),
+        Route('stop_following', 'POST', f'/users/stop-following/{other_id}',
+              setup=follow),
+        Route('profile_form', 'GET', '/users/profile'),
+        Route('profile', 'POST', '/users/profile', profile),
+        Route('login_form', 'GET', '/login', client='visitor'),
+        Route('login', 'POST', '/login',
+              {'username': user.username, 'password': PASSWORD},
+              client='visitor', setup=allow_logins, teardown=log_out),
+        Route('logout', 'GET', '/logout', client='visitor', setup=log_in),
+        Route('signup_form', 'GET', '/signup', client='visitor'),
+        Route('signup', 'POST', '/signup', new_account, client='visitor',
+              setup=allow_logins, teardown=delete_account),
+        Route('delete_user', 'POST', '/users/delete', client='visitor',
+              setup=sign_up),
+        Route('asset', 'GET', asset_path, client='visitor'),
+        Route('metrics', 'GET', '/metrics', client='visitor'),
+    ]
+
+
+def seed(tier, seed):
+    """Generate and bulk load the CSVs for `tier`."""
+
+    import create_csvs
+    from app import app
+    from bulk_load import load
+    from models import db
+
+    users, messages, follows = TIERS[tier]
+    config = create_csvs.make_config(Namespace(
+        seed=seed, users=users, messages=messages, follows=follows,
+        max_following=5000, start=datetime(2022, 1, 1),
+        end=datetime(2024, 1, 1)))
+
+    with tempfile.TemporaryDirectory() as directory:
+        for name, headers, make_shard in [
+                ('users', create_csvs.USERS_CSV_HEADERS,
+                 create_csvs.users_shard),
+                ('messages', create_csvs.MESSAGES_CSV_HEADERS,
+                 create_csvs.messages_shard),
+                ('follows', create_csvs.FOLLOWS_CSV_HEADERS,
+                 create_csvs.follows_shard)]:
+            create_csvs.write_csv(os.path.join(directory, f"{name}.csv"),
+                                  headers, make_shard, config, pool=None)
+
+        load(db.engine, directory, restart=True,
+             max_followers=app.config['TIMELINE_FANOUT_MAX_FOLLOWERS'],
+             log=lambda line: None)
+
+
+def reset_caches():
+    """Forget per-process caches left over from the last dataset."""
+
+    from app import message_search
+    from current_user import summaries
+    from fragments import fragments
+    from username_index import usernames
+
+    summaries.clear()
+    fragments.clear()
+    usernames.expire()
+    if hasattr(message_search, 'expire'):
+        message_search.expire()
+
+
+def time_route(client, route, repeat, statements):
+    """Latencies (ms), statements per request and peak memory (KiB)."""
+
+    def send(trace=False):
+        path = (route.setup(client) if route.setup else None) or route.path
+        data = route.data() if callable(route.data) else route.data
+
+        before = len(statements)
+        if trace:
+            tracemalloc.start()
+        start = perf_counter()
+        response = client.open(path, method=route.method, data=data)
+        elapsed = (perf_counter() - start) * 1000
+        peak = tracemalloc.get_traced_memory()[1] if trace else 0
+        if trace:
+            tracemalloc.stop()
+        queries = len(statements) - before
+
+        if route.teardown:
+            route.teardown(client)
+
+        if response.status_code >= 400:
+            raise RuntimeError(
+                f"{route.method} {path}: {response.status_code}")
+
+        return elapsed, queries, peak
+
+    # warm caches and lazily built indexes
+    for _ in range(3):
+        send()
+
+    timings = []
+    queries = 0
+
+    for _ in range(repeat):
+        elapsed, ran, _ = send()
+        timings.append(elapsed)
+        queries += ran
+
+    peak = send(trace=True)[2]
+
+    return timings, queries / repeat, peak / 1024
+
+
+def bench_tier(tier, repeat, seed_value):
+    from sqlalchemy import event
+
+    from app import app, CURR_USER_KEY
+    from assets import assets
+    from models import db, Message, User
+
+    seed(tier, seed_value)
+    reset_caches()
+
+    message_id, other_id = db.session.execute(
+        db.select(Message.id, Message.user_id)
+        .where(Message.user_id != USER_ID)
+        .order_by(Message.id)
+        .limit(1)).one()
+    user = db.session.get(User, USER_ID)
+    db.session.commit()
+
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+
+    clients = {'user': app.test_client(), 'visitor': app.test_client()}
+    with clients['user'].session_transaction() as session:
+        session[CURR_USER_KEY] = USER_ID
+
+    asset_path = f"/assets/{assets.names['stylesheets/style.css']}"
+    results = {}
+
+    for route in routes(message_id, other_id, user, asset_path):
+        timings, queries, peak = time_route(clients[route.client], route,
+                                            repeat, statements)
+        cuts = quantiles(timings, n=100)
+        results[route.name] = {
+            'p50_ms': round(cuts[49], 3),
+            'p95_ms': round(cuts[94], 3),
+            'p99_ms': round(cuts[98], 3),
+            'queries': round(queries, 2),
+            'peak_kib': round(peak, 1),
+        }
+
+        print(f"{tier:>7} {route.name:<20} {cuts[49]:>8.2f} {cuts[94]:>8.2f} "
+              f"{cuts[98]:>8.2f} {queries:>8.1f} {peak:>10.1f}")
+
+    event.remove(db.engine, 'before_cursor_execute', record)
+    return results
+
+
+def regressions(results, baseline, threshold):
+    """Lines describing each route that got slower or chattier than `baseline`."""
+
+    found = []
+
+    for tier, tier_results in results['tiers'].items():
+        for name, now in tier_results.items():
+            before = baseline.get('tiers', {}).get(tier, {}).get(name)
+            if not before:
+                continue
+
+            if now['p95_ms'] > before['p95_ms'] * threshold:
+                found.append(f"{tier} {name}: p95 {before['p95_ms']}ms -> "
+                             f"{now['p95_ms']}ms")
+            if now['queries'] > before['queries']:
+                found.append(f"{tier} {name}: queries {before['queries']} -> "
+                             f"{now['queries']}")
+
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tiers', nargs='+', choices=TIERS,
+                        default=['small', 'medium'])
+    parser.add_argument('--repeat', type=int, default=50,
+                        help='timed requests per route')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--database-url',
+                        default=os.environ.get('DATABASE_URL',
+                                               'postgresql:///warbler-bench'))
+    parser.add_argument('--out', help='write JSON results here')
+    parser.add_argument('--baseline', help='JSON results to compare against')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='flag p95 latencies this many times the baseline')
+    args = parser.parse_args()
+
+    # the app reads its database from the environment when imported
+    os.environ['DATABASE_URL'] = args.database_url
+
+    from app import app
+    app.config['WTF_CSRF_ENABLED'] = False
+
+    print(f"{'tier':>7} {'route':<20} {'p50 ms':>8} {'p95 ms':>8} "
+          f"{'p99 ms':>8} {'queries':>8} {'peak KiB':>10}")
+
+    results = {
+        'database': args.database_url.split('://')[0],
+        'repeat': args.repeat,
+        'seed': args.seed,
+        'tiers': {tier: bench_tier(tier, args.repeat, args.seed)
+                  for tier in args.tiers},
+    }
+
+    if args.out:
+        with open(args.out, 'w') as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            found = regressions(results, json.load(baseline), args.threshold)
+
+        for line in found:
+            print(f"REGRESSION {line}")
+
+        sys.exit(1 if found else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+"""Benchmark message search latency as the number of messages grows.
+
+Times a mix of common, rare and multi-word searches over synthetic
+messages of increasing size, with each backend: the in-process index
+('memory', rebuilt for each size) and Postgres full-text search
+('postgres', over a messages table grown to each size in turn, so the
+GIN index is maintained as rows are added, as in production). The build
+column is the time to build the index or to insert the new rows. Run
+from the project root like:
+
+    python benchmarks/bench_search.py
+    python benchmarks/bench_search.py --sizes 1000 10000 100000 1000000
+    python benchmarks/bench_search.py --backends postgres \\
+        --database-url postgresql:///warbler-bench
+
+The Postgres run replaces the tables in --database-url, so point it at a
+scratch database.
+"""
+
+import argparse
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+from itertools import accumulate, islice
+from statistics import quantiles
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from search import InvertedIndex  # noqa: E402
+
+VOCABULARY_SIZE = 20000
+WORDS_PER_MESSAGE = 20
+
+
+INSERT_CHUNK = 10000
+
+
+def make_messages(count, rng, start=1):
+    """Make (id, text) rows with a Zipf-like word distribution, with ids
+    from `start` up to `count`."""
+
+    vocabulary = [f"word{i}" for i in range(VOCABULARY_SIZE)]
+    cum_weights = list(accumulate(1 / (rank + 1)
+                                  for rank in range(VOCABULARY_SIZE)))
+
+    for message_id in range(start, count + 1):
+        words = rng.choices(vocabulary, cum_weights=cum_weights,
+                            k=WORDS_PER_MESSAGE)
+        yield message_id, " ".join(words)
+
+
+def time_searches(index, searches, repeat):
+    """Time each search `repeat` times; return per-search latencies in ms."""
+
+    timings = []
+
+    for _ in range(repeat):
+        for terms in searches:
+            start = perf_counter()
+            index.search(terms, 0, 20)
+            timings.append((perf_counter() - start) * 1000)
+
+    return timings
+
+
+def bench_memory(sizes, searches, repeat, seed):
+    """(size, build seconds, timings) for the in-process index."""
+
+    for size in sizes:
+        rng = random.Random(seed)
+        index = InvertedIndex()
+
+        start = perf_counter()
+        index.rebuild(make_messages(size, rng))
+        build = perf_counter() - start
+
+        yield size, build, time_searches(index, searches, repeat)
+
+
+def bench_postgres(sizes, searches, repeat, seed, database_url):
+    """(size, insert seconds, timings) for Postgres full-text search, over
+    a messages table grown to each size in turn."""
+
+    # the app reads its database from the environment when imported
+    os.environ['DATABASE_URL'] = database_url
+
+    from app import app
+    from models import db, Message, User
+    from search import PostgresSearch
+
+    rng = random.Random(seed)
+    loaded = 0
+    first = datetime(2022, 1, 1)
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        db.session.add(User(id=1, username='searcher',
+                            email='searcher@test.com', password='not a hash'))
+        db.session.commit()
+
+        index = PostgresSearch()
+
+        for size in sorted(sizes):
+            rows = make_messages(size, rng, start=loaded + 1)
+            start = perf_counter()
+
+            while True:
+                chunk = [{'id': message_id, 'text': text, 'user_id': 1,
+                          'timestamp': first + timedelta(seconds=message_id)}
+                         for message_id, text in islice(rows, INSERT_CHUNK)]
+                if not chunk:
+                    break
+                db.session.execute(db.insert(Message), chunk)
+                db.session.commit()
+
+            build = perf_counter() - start
+            loaded = size
+
+            db.session.execute(db.text('ANALYZE messages'))
+            db.session.commit()
+
+            yield size, build, time_searches(index, searches, repeat)
+            db.session.rollback()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1000, 10000, 100000])
+    parser.add_argument('--backends', nargs='+', choices=['memory', 'postgres'],
+                        default=['memory', 'postgres'])
+    parser.add_argument('--database-url',
+                        default=os.environ.get('DATABASE_URL',
+                                               'postgresql:///warbler-bench'))
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    searches = ['word0', 'word5 word17', 'word900', 'word15000',
+                'word3 word40 word700']
+
+    print(f"{'backend':>9} {'messages':>10} {'build s':>9} {'p50 ms':>8} "
+          f"{'p95 ms':>8} {'max ms':>8}")
+
+    for backend in args.backends:
+        if backend == 'memory':
+            runs = bench_memory(args.sizes, searches, args.repeat, args.seed)
+        else:
+            runs = bench_postgres(args.sizes, searches, args.repeat,
+                                  args.seed, args.database_url)
+
+        for size, build, timings in runs:
+            cuts = quantiles(timings, n=100)
+
+            print(f"{backend:>9} {size:>10} {build:>9.2f} {cuts[49]:>8.3f} "
+                  f"{cuts[94]:>8.3f} {max(timings):>8.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+"""Bulk load users, messages, follows and likes from CSV files.
+
+Streams each CSV in fixed-size chunks: with PostgreSQL's COPY, or plain
+executemany INSERTs elsewhere (SQLite). Secondary indexes are dropped
+before loading and built once at the end, sequences are reset past the
+loaded ids, and timelines and counters are rebuilt from the loaded rows.
+Run from the project root like:
+
+    python bulk_load.py
+    python bulk_load.py --dir staging-data --chunk-size 500000
+
+Rows get ids from their line number in the CSV, so messages.csv can refer
+to users by line. Each chunk is committed along with a checkpoint of how
+far we've got; run it again after an interruption and it carries on from
+the last committed chunk. Use --restart to start over from empty tables.
+Without a checkpoint to resume from or --restart, it only loads into an
+empty database, so it can't wipe out one that's in use.
+"""
+
+import argparse
+import csv
+import os
+from io import StringIO
+from itertools import islice
+from time import perf_counter
+
+from models import (db, create_indexes, Follows, Likes, Message, TimelineEntry,
+                    User)
+
+# in load order, so foreign keys are always satisfied
+TABLES = [User.__table__, Message.__table__, Follows.__table__,
+          Likes.__table__]
+
+checkpoints = db.Table(
+    'bulk_load_checkpoints', db.MetaData(),
+    db.Column('table_name', db.String, primary_key=True),
+    db.Column('rows_loaded', db.BigInteger, nullable=False),
+    db.Column('done', db.Boolean, nullable=False),
+)
+
+
+class DatabaseNotEmpty(Exception):
+    """Raised when there's data but no load to resume, and no restart."""
+
+
+def is_empty(engine):
+    """Have none of the app's tables any rows (or do none exist yet)?"""
+
+    existing = set(db.inspect(engine).get_table_names())
+
+    with engine.connect() as conn:
+        return not any(
+            conn.execute(db.select(db.literal(1)).select_from(table)
+                         .limit(1)).first()
+            for table in db.metadata.sorted_tables
+            if table.name in existing)
+
+
+def start_fresh(engine):
+    """Make empty tables, without secondary indexes, and a new checkpoint."""
+
+    db.metadata.drop_all(engine)
+    db.metadata.create_all(engine)
+
+    with engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                index.drop(conn, checkfirst=True)
+
+        checkpoints.drop(conn, checkfirst=True)
+        checkpoints.create(conn)
+
+
+def copy_rows(conn, table, columns, rows):
+    """Insert `rows` (lists of CSV strings) into `columns` of `table`."""
+
+    names = ', '.join(columns)
+
+    if conn.dialect.name == 'postgresql':
+        buffer = StringIO()
+        csv.writer(buffer).writerows(rows)
+        buffer.seek(0)
+
+        cursor = conn.connection.cursor()
+        cursor.copy_expert(
+            f"COPY {table.name} ({names}) FROM STDIN WITH (FORMAT csv)",
+            buffer)
+        return
+
+    # as with COPY's csv format, empty fields are NULL
+    marker = '?' if conn.dialect.paramstyle == 'qmark' else '%s'
+    conn.exec_driver_sql(
+        f"INSERT INTO {table.name} ({names}) "
+        f"VALUES ({', '.join([marker] * len(columns))})",
+        [tuple(value if value != '' else None for value in row)
+         for row in rows])
+
+
+def load_table(engine, table, path, chunk_size, log):
+    """Load `path` into `table` from its checkpoint; returns rows loaded."""
+
+    with engine.begin() as conn:
+        checkpoint = conn.execute(
+            db.select(checkpoints.c.rows_loaded, checkpoints.c.done)
+            .where(checkpoints.c.table_name == table.name)).first()
+
+        if checkpoint is None:
+            conn.execute(checkpoints.insert().values(
+                table_name=table.name, rows_loaded=0, done=False))
+            checkpoint = (0, False)
+
+    done_before, finished = checkpoint
+    if finished:
+        log(f"{table.name}: already loaded.")
+        return 0
+
+    with open(path, newline='') as csv_file:
+        reader = csv.reader(csv_file)
+        columns = next(reader)
+
+        # rows are numbered by line, so they'll get the same ids on a resume
+        numbered = 'id' in table.c and 'id' not in columns
+        if numbered:
+            columns = ['id', *columns]
+
+        rows = islice(reader, done_before, None)
+        loaded = done_before
+        start = perf_counter()
+
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+
+            if numbered:
+                chunk = [[str(loaded + n), *row]
+                         for n, row in enumerate(chunk, start=1)]
+
+            with engine.begin() as conn:
+                copy_rows(conn, table, columns, chunk)
+                loaded += len(chunk)
+                conn.execute(
+                    checkpoints.update()
+                    .where(checkpoints.c.table_name == table.name)
+                    .values(rows_loaded=loaded))
+
+            elapsed = perf_counter() - start
+            log(f"{table.name}: {loaded} rows "
+                f"({(loaded - done_before) / elapsed:,.0f} rows/sec)")
+
+    with engine.begin() as conn:
+        conn.execute(
+            checkpoints.update()
+            .where(checkpoints.c.table_name == table.name)
+            .values(done=True))
+
+    return loaded - done_before
+
+
+def reset_sequences(engine):
+    """Move id sequences past the ids we loaded (Postgres only)."""
+
+    if engine.dialect.name != 'postgresql':
+        return
+
+    with engine.begin() as conn:
+        for table in TABLES:
+            if 'id' in table.c:
+                conn.execute(db.text(
+                    f"SELECT setval(pg_get_serial_sequence('{table.name}', "
+                    f"'id'), COALESCE(MAX(id), 1), MAX(id) IS NOT NULL) "
+                    f"FROM {table.name}"))
+
+
+def load(engine, directory, chunk_size=100000, restart=False,
+         max_followers=None, log=print):
+    """Load the CSVs in `directory`, resuming unless `restart`.
+
+    Timelines are rebuilt without fanning out authors with more than
+    `max_followers` followers, as the app does when they post.
+
+    Returns {table name: rows loaded by this run}. Raises DatabaseNotEmpty,
+    touching nothing, if there's no load to resume, `restart` isn't set
+    and the database has data in it.
+    """
+
+    if not restart and not db.inspect(engine).has_table(checkpoints.name):
+        if not is_empty(engine):
+            raise DatabaseNotEmpty(
+                "The database has data in it and there's no load to resume; "
+                "use --restart to replace it.")
+        restart = True
+
+    if restart:
+        start_fresh(engine)
+
+    loaded = {}
+    start = perf_counter()
+
+    for table in TABLES:
+        path = os.path.join(directory, f"{table.name}.csv")
+        if os.path.exists(path):
+            loaded[table.name] = load_table(engine, table, path, chunk_size,
+                                            log)
+
+    total = sum(loaded.values())
+    elapsed = perf_counter() - start
+    log(f"Loaded {total} rows in {elapsed:.1f}s "
+        f"({total / elapsed:,.0f} rows/sec).")
+
+    create_indexes(engine, log)
+    reset_sequences(engine)
+
+    # follower counts first: the timeline rebuild uses them
+    log("Rebuilding counters and timelines...")
+    User.reconcile_counters()
+    Message.recount_likes()
+    TimelineEntry.rebuild(max_followers)
+    db.session.commit()
+
+    with engine.begin() as conn:
+        if conn.dialect.name in ('postgresql', 'sqlite'):
+            conn.execute(db.text('ANALYZE'))
+        checkpoints.drop(conn)
+
+    return loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dir', default='generator',
+                        help='directory holding users.csv, messages.csv, '
+                             'follows.csv and (optionally) likes.csv')
+    parser.add_argument('--chunk-size', type=int, default=100000,
+                        help='rows per COPY/INSERT and checkpoint')
+    parser.add_argument('--restart', action='store_true',
+                        help='ignore any checkpoint and start from scratch')
+    args = parser.parse_args()
+
+    from app import app
+
+    with app.app_context():
+        try:
+            load(db.engine, args.dir, args.chunk_size, args.restart,
+                 app.config['TIMELINE_FANOUT_MAX_FOLLOWERS'])
+        except DatabaseNotEmpty as e:
+            parser.exit(1, f"{e}\n")
+
+
+if __name__ == '__main__':
+    main()
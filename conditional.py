@@ -0,0 +1,76 @@
+"""Conditional GETs: answer a repeat page view with 304 Not Modified.
+
+A route works out a version of its page from the rows it has loaded (and
+who's looking), then calls `render_conditional` instead of
+`render_template`. If the browser (or a cache in front of us) already
+holds that version, as told by its If-None-Match header, it gets an empty
+304 and the template isn't rendered.
+
+Versions are only as good as the parts they're built from: include
+everything the template shows that can change, like like counts, the
+author's username and image, and which messages the viewer has liked.
+"""
+
+import hashlib
+import os
+
+from flask import current_app, make_response, render_template, request, session
+
+# pages shown to one logged-in user: browsers may keep them, but must
+# check they're current before each use
+PRIVATE = 'private, no-cache'
+
+# pages that are the same for everyone
+PUBLIC = 'public, max-age=60'
+
+# everything else (forms, redirects, JSON): never stored
+DEFAULT = 'no-store'
+
+
+def files_version(*folders):
+    """A digest of every file in `folders` (the templates and static files),
+    so a deploy that changes how pages look changes their versions too."""
+
+    digest = hashlib.sha1()
+
+    for folder in folders:
+        for directory, _, filenames in sorted(os.walk(folder)):
+            for filename in sorted(filenames):
+                path = os.path.join(directory, filename)
+                digest.update(os.path.relpath(path, folder).encode())
+                with open(path, 'rb') as in_file:
+                    digest.update(in_file.read())
+
+    return digest.hexdigest()
+
+
+def page_etag(*parts):
+    """An ETag for a page built from `parts` (anything with a stable repr)."""
+
+    digest = hashlib.sha1(repr((current_app.config['PAGE_VERSION'],
+                                parts)).encode())
+    return digest.hexdigest()[:32]
+
+
+def render_conditional(version, cache_control, template, **context):
+    """Render `template`, or answer 304 if the client has `version` already.
+
+    `version` is a tuple of whatever the page depends on. Pages with
+    flashed messages waiting are always rendered, and never stored.
+    """
+
+    if session.get('_flashes'):
+        response = make_response(render_template(template, **context))
+        response.headers['Cache-Control'] = DEFAULT
+        return response
+
+    etag = page_etag(template, *version)
+
+    if request.if_none_match.contains_weak(etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = make_response(render_template(template, **context))
+
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = cache_control
+    return response
@@ -0,0 +1,133 @@
+"""Cheap loading of the logged-in user for every request.
+
+Most requests only need the current user's id, username and avatar, so we
+keep a small per-process cache of those and only load the full `User` row
+when a handler asks for something else.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+from models import db, User
+
+SUMMARY_FIELDS = ('id', 'username', 'image_url')
+
+
+class SummaryCache:
+    """Bounded, per-process TTL cache of user summaries, keyed by user id."""
+
+    def __init__(self, ttl=30, maxsize=10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, user_id):
+        """Get cached summary dict for `user_id`, or None if missing/stale."""
+
+        with self._lock:
+            entry = self._entries.get(user_id)
+
+            if entry is None:
+                return None
+
+            expires, summary = entry
+            if expires < monotonic():
+                del self._entries[user_id]
+                return None
+
+            return summary
+
+    def set(self, user_id, summary):
+        """Cache `summary`, evicting the oldest entries if we're full."""
+
+        with self._lock:
+            self._entries[user_id] = (monotonic() + self.ttl, summary)
+            self._entries.move_to_end(user_id)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        """Drop `user_id` from the cache (call after changing their row)."""
+
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+summaries = SummaryCache()
+
+
+class CurrentUser:
+    """The logged-in user: summary fields up front, full row on demand.
+
+    Reading any attribute that isn't in the summary loads the `User` row
+    (once per request) and reads it from there. Handlers that change the
+    user should call `load()` and work on the row directly.
+    """
+
+    def __init__(self, summary):
+        self.__dict__.update(summary)
+        self._row = None
+
+    @classmethod
+    def get(cls, user_id, full=False):
+        """Get CurrentUser for `user_id`, or None if there's no such user.
+
+        With `full`, for pages that will read more than the summary, the
+        whole row is loaded straight away instead of the summary first.
+        """
+
+        if full:
+            row = db.session.get(User, user_id)
+
+            if row is None:
+                return None
+
+            summary = {field: getattr(row, field) for field in SUMMARY_FIELDS}
+            summaries.set(user_id, summary)
+
+            current = cls(summary)
+            current._row = row
+            return current
+
+        summary = summaries.get(user_id)
+
+        if summary is None:
+            row = db.session.execute(
+                db.select(*(getattr(User, field) for field in SUMMARY_FIELDS))
+                .where(User.id == user_id)).first()
+
+            if row is None:
+                return None
+
+            summary = row._asdict()
+            summaries.set(user_id, summary)
+
+        return cls(summary)
+
+    def load(self):
+        """Get the full `User` row for this user."""
+
+        if self._row is None:
+            self._row = db.session.get(User, self.id)
+
+        return self._row
+
+    def __getattr__(self, name):
+        # only called for attributes not in the summary
+        return getattr(self.load(), name)
+
+    def __repr__(self):
+        return f"<CurrentUser #{self.id}: {self.username}>"
+
+    # these only need our id, so don't load the row for them
+    is_following = User.is_following
+    is_followed_by = User.is_followed_by
+    following_ids = User.following_ids
+    followed_by_ids = User.followed_by_ids
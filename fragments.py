@@ -0,0 +1,209 @@
+"""Cache of rendered message cards.
+
+The avatar, username, date and text of a message look the same to every
+viewer, so they're rendered once (from messages/card.html) and reused by
+the timeline, profile and likes pages; the like button and like count,
+which differ by viewer or change often, are rendered around them on every
+request.
+
+A card is cached under its message id along with its author's profile
+version, a digest of the author fields the card shows. A card rendered
+before the author changed their username or image has the wrong version
+and is rendered again, so no worker can show a stale card. Cards are
+also dropped explicitly when their message is deleted or their author
+edits or deletes their profile, to free the space.
+
+There are two tiers: a bounded LRU in each process, and optionally a
+SQLite file that every worker on the host shares (FRAGMENT_CACHE_BACKEND
+'sqlite'), consulted on a miss in the first.
+"""
+
+import hashlib
+import sqlite3
+from collections import OrderedDict
+from threading import Lock, local
+from time import time
+
+
+def profile_version(user):
+    """A digest of the fields of `user` that message cards show."""
+
+    fields = f"{user.username}\0{user.image_url}"
+    return hashlib.sha1(fields.encode()).hexdigest()[:12]
+
+
+class SQLiteFragmentStore:
+    """Cards in a SQLite file, shared by every process using it, keeping
+    about the `max_cards` most recently written."""
+
+    PRUNE_EVERY = 1000
+
+    def __init__(self, path, max_cards=100000):
+        self.path = path
+        self.max_cards = max_cards
+        self._local = local()
+        self._sets = 0
+
+        conn = self._connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS cards (
+                message_id INTEGER PRIMARY KEY,
+                author_id INTEGER NOT NULL,
+                version TEXT NOT NULL,
+                html TEXT NOT NULL,
+                updated REAL NOT NULL
+            )""")
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS ix_cards_author_id
+            ON cards (author_id)""")
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS ix_cards_updated
+            ON cards (updated)""")
+
+    def _connect(self):
+        # a connection per thread, kept open: cards are read in loops
+        conn = getattr(self._local, 'conn', None)
+
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5,
+                                   isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+
+        return conn
+
+    def __len__(self):
+        return self._connect().execute(
+            "SELECT count(*) FROM cards").fetchone()[0]
+
+    def get(self, message_id, version):
+        """(author_id, html) of the card, or None."""
+
+        return self._connect().execute(
+            "SELECT author_id, html FROM cards "
+            "WHERE message_id = ? AND version = ?",
+            (message_id, version)).fetchone()
+
+    def set(self, message_id, author_id, version, html):
+        conn = self._connect()
+        conn.execute(
+            "INSERT OR REPLACE INTO cards "
+            "(message_id, author_id, version, html, updated) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (message_id, author_id, version, html, time()))
+
+        self._sets += 1
+        if self._sets % self.PRUNE_EVERY == 0:
+            conn.execute(
+                "DELETE FROM cards WHERE updated < (SELECT updated FROM "
+                "cards ORDER BY updated DESC LIMIT 1 OFFSET ?)",
+                (self.max_cards,))
+
+    def invalidate_message(self, message_id):
+        self._connect().execute("DELETE FROM cards WHERE message_id = ?",
+                                (message_id,))
+
+    def invalidate_author(self, author_id):
+        self._connect().execute("DELETE FROM cards WHERE author_id = ?",
+                                (author_id,))
+
+    def clear(self):
+        self._connect().execute("DELETE FROM cards")
+
+
+class FragmentCache:
+    """Per-process LRU of up to `maxsize` cards, in front of an optional
+    `shared` store."""
+
+    def __init__(self, maxsize=10000, shared=None):
+        self.configure(maxsize, shared)
+        self._cards = OrderedDict()
+        self._lock = Lock()
+
+    def configure(self, maxsize, shared):
+        self.maxsize = maxsize
+        self.shared = shared
+
+    def __len__(self):
+        return len(self._cards)
+
+    def get(self, message_id, version):
+        """The cached card for `message_id` at author `version`, or None."""
+
+        with self._lock:
+            entry = self._cards.get(message_id)
+
+            if entry is not None and entry[1] == version:
+                self._cards.move_to_end(message_id)
+                return entry[2]
+
+        if self.shared is None:
+            return None
+
+        row = self.shared.get(message_id, version)
+        if row is None:
+            return None
+
+        author_id, html = row
+        self._remember(message_id, author_id, version, html)
+        return html
+
+    def set(self, message_id, author_id, version, html):
+        self._remember(message_id, author_id, version, html)
+
+        if self.shared is not None:
+            self.shared.set(message_id, author_id, version, html)
+
+    def _remember(self, message_id, author_id, version, html):
+        with self._lock:
+            self._cards[message_id] = (author_id, version, html)
+            self._cards.move_to_end(message_id)
+
+            while len(self._cards) > self.maxsize:
+                self._cards.popitem(last=False)
+
+    def invalidate_message(self, message_id):
+        """Drop the card for `message_id` (call when it's deleted)."""
+
+        with self._lock:
+            self._cards.pop(message_id, None)
+
+        if self.shared is not None:
+            self.shared.invalidate_message(message_id)
+
+    def invalidate_author(self, author_id):
+        """Drop every card by `author_id` (call when they edit or delete
+        their profile)."""
+
+        with self._lock:
+            for message_id in [message_id for message_id, entry
+                               in self._cards.items()
+                               if entry[0] == author_id]:
+                del self._cards[message_id]
+
+        if self.shared is not None:
+            self.shared.invalidate_author(author_id)
+
+    def clear(self):
+        with self._lock:
+            self._cards.clear()
+
+        if self.shared is not None:
+            self.shared.clear()
+
+
+def make_shared_store(backend, path=None, max_cards=100000):
+    """Make the shared card store named by `backend` ('' for none, or
+    'sqlite')."""
+
+    if not backend:
+        return None
+
+    if backend == 'sqlite':
+        return SQLiteFragmentStore(path, max_cards)
+
+    raise ValueError(f"Unknown fragment cache backend: {backend!r}")
+
+
+fragments = FragmentCache()
@@ -2,76 +2,319 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows, like:
+
+    python generator/create_csvs.py
+    python generator/create_csvs.py --users 10000000 --messages 200000000 \\
+        --follows 1000000000 --out /data/warbler --workers 8
+
+Runs offline and streams rows to disk as it goes, so memory use doesn't
+grow with the number of users or follows. Follower counts follow a power
+law (a few users have most of the followers), and each user posts in
+bursts, more of them around a handful of site-wide busy moments.
+
+Users are generated in fixed-size shards, each with its own random number
+generator seeded from --seed, so the output is the same for the same
+arguments whatever the number of workers. Load the result with bulk_load.py.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
-from faker import Faker
-from helpers import get_random_datetime
-
-MAX_WARBLER_LENGTH = 140
+import io
+import os
+import random
+from collections import namedtuple
+from datetime import datetime, timedelta
+from functools import partial
+from itertools import accumulate
+from math import ceil, gcd
+from multiprocessing import Pool
 
 USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
 
-NUM_USERS = 300
-NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
+MAX_WARBLER_LENGTH = 140
+
+# every user's password is "password"
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+
+# users per shard; each shard gets its own seeded random number generator
+SHARD_SIZE = 10000
+
+# exponents of the power laws for follower counts (popularity by rank),
+# following counts and messages per user
+POPULARITY_EXPONENT = 1.1
+FOLLOWING_EXPONENT = 2.0
+ACTIVITY_EXPONENT = 1.8
+
+# chance that a message starts a new burst, and mean minutes between
+# messages within a burst
+NEW_BURST_CHANCE = 0.2
+BURST_GAP_MINUTES = 4
 
-fake = Faker()
+# site-wide busy moments, and the chance a burst starts near one
+NUM_EVENTS = 50
+EVENT_BURST_CHANCE = 0.3
+EVENT_SPREAD_HOURS = 3
 
-# Generate random profile image URLs to use for users
+WORDS = """
+    time year people way day man thing woman life child world school state
+    family student group country problem hand part place case week company
+    system program question work government number night point home water
+    room mother area money story fact month lot right study book eye job word
+    business issue side kind head house service friend father power hour game
+    line end member law car city community name president team minute idea
+    kid body information back parent face others level office door health
+    person art war history party result change morning reason research girl
+    guy moment air teacher force education coffee music weekend pizza dog cat
+    """.split()
+WORD_WEIGHTS = list(accumulate(1 / rank for rank in range(1, len(WORDS) + 1)))
 
-image_urls = [
+CITIES = ['Springfield', 'Riverside', 'Franklin', 'Greenville', 'Bristol',
+          'Clinton', 'Fairview', 'Salem', 'Madison', 'Georgetown', 'Arlington',
+          'Ashland', 'Dover', 'Oxford', 'Jackson', 'Burlington', 'Manchester',
+          'Milton', 'Newport', 'Auburn']
+
+IMAGE_URLS = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
     for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
+Config = namedtuple('Config', ['seed', 'users', 'mean_messages',
+                               'mean_following', 'max_following',
+                               'start', 'span', 'events', 'stride'])
+
+
+def shard_rng(config, kind, shard):
+    """The random number generator for one shard of one CSV."""
+
+    return random.Random(f"{config.seed}-{kind}-{shard}")
+
+
+def shard_ids(config, shard):
+    """The user ids in `shard`."""
+
+    return range(shard * SHARD_SIZE + 1,
+                 min(config.users, (shard + 1) * SHARD_SIZE) + 1)
+
+
+def power_law(uniforms, n, exponent):
+    """Map uniform [0, 1) samples to ranks 1..n, P(rank r) ~ r ** -exponent.
+
+    Inverse transform sampling of the continuous power law on [1, n + 1).
+    """
+
+    if exponent == 1:
+        return [min(n, int((n + 1) ** u)) for u in uniforms]
+
+    a = 1 - exponent
+    top = (n + 1) ** a - 1
+    return [min(n, int((top * u + 1) ** (1 / a))) for u in uniforms]
+
+
+def pareto(uniforms, mean, exponent, cap):
+    """Map uniform [0, 1) samples to whole numbers >= 1 averaging about `mean`,
+    with a heavy tail, capped at `cap`."""
+
+    scale = mean * (exponent - 1) / exponent
+    return [min(cap, ceil(scale / (1 - u) ** (1 / exponent))) for u in uniforms]
+
+
+def user_id_for_rank(config, rank):
+    """The id of the user with the `rank`th most followers.
+
+    A fixed permutation of the ids, so popular users are spread through the
+    id space rather than all having low ids.
+    """
+
+    return (rank - 1) * config.stride % config.users + 1
+
+
+def sentence(rng, words):
+    text = ' '.join(rng.choices(WORDS, cum_weights=WORD_WEIGHTS, k=words))
+    return f"{text.capitalize()}."[:MAX_WARBLER_LENGTH]
+
+
+def to_csv(rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue()
+
+
+def users_shard(config, shard):
+    """CSV text of the users in `shard`."""
+
+    rng = shard_rng(config, 'users', shard)
+    rows = []
+
+    for user_id in shard_ids(config, shard):
+        first, second = rng.choices(WORDS, k=2)
+        username = f"{first}{second}{user_id}"
+
+        rows.append([
+            f"{username}@example.com",
+            username,
+            rng.choice(IMAGE_URLS),
+            PASSWORD,
+            sentence(rng, rng.randint(4, 12)),
+            "/static/images/warbler-hero.jpg",
+            rng.choice(CITIES),
+        ])
+
+    return to_csv(rows)
+
+
+def burst_start(rng, config):
+    """When a burst of messages starts, in seconds after config.start."""
+
+    if rng.random() < EVENT_BURST_CHANCE:
+        at = rng.choice(config.events) + rng.gauss(0, EVENT_SPREAD_HOURS * 3600)
+        return min(max(at, 0), config.span)
+
+    return rng.uniform(0, config.span)
+
+
+def messages_shard(config, shard):
+    """CSV text of the messages posted by users in `shard`."""
+
+    if not config.mean_messages:
+        return ''
+
+    rng = shard_rng(config, 'messages', shard)
+    ids = shard_ids(config, shard)
+    counts = pareto([rng.random() for _ in ids], config.mean_messages,
+                    ACTIVITY_EXPONENT, cap=100000)
+    rows = []
+
+    for user_id, count in zip(ids, counts):
+        at = burst_start(rng, config)
+
+        for _ in range(count):
+            if rng.random() < NEW_BURST_CHANCE:
+                at = burst_start(rng, config)
+            else:
+                at = min(at + rng.expovariate(1 / (BURST_GAP_MINUTES * 60)),
+                         config.span)
+
+            timestamp = config.start + timedelta(seconds=at)
+            rows.append([sentence(rng, rng.randint(3, 25)),
+                         timestamp.strftime('%Y-%m-%d %H:%M:%S.%f'),
+                         user_id])
+
+    return to_csv(rows)
+
+
+def follows_shard(config, shard):
+    """CSV text of who the users in `shard` follow."""
+
+    cap = min(config.max_following, config.users - 1)
+    if not config.mean_following or cap < 1:
+        return ''
+
+    rng = shard_rng(config, 'follows', shard)
+    ids = shard_ids(config, shard)
+    degrees = pareto([rng.random() for _ in ids], config.mean_following,
+                     FOLLOWING_EXPONENT, cap)
+    rows = []
+
+    for follower, degree in zip(ids, degrees):
+        followed = set()
+
+        # popular users are drawn over and over; give up on the last few
+        # rather than loop for ever on a tiny graph
+        for _ in range(4):
+            ranks = power_law([rng.random() for _ in range(degree)],
+                              config.users, POPULARITY_EXPONENT)
+            followed.update(user_id_for_rank(config, rank) for rank in ranks)
+            followed.discard(follower)
+            if len(followed) >= degree:
+                break
+
+        rows.extend([user_id, follower]
+                    for user_id in sorted(followed)[:degree])
+
+    return to_csv(rows)
+
+
+def write_csv(path, headers, make_shard, config, pool):
+    """Write `headers` then every shard's rows to `path`, in shard order."""
+
+    shards = range(ceil(config.users / SHARD_SIZE))
+    work = partial(make_shard, config)
+    chunks = pool.imap(work, shards) if pool else map(work, shards)
+
+    with open(path, 'w', newline='') as csv_file:
+        csv.writer(csv_file).writerow(headers)
+
+        for shard, chunk in enumerate(chunks, start=1):
+            csv_file.write(chunk)
+            print(f"\r{os.path.basename(path)}: {shard}/{len(shards)} shards",
+                  end='', flush=True)
+
+    print()
+
+
+def make_config(args):
+    rng = random.Random(f"{args.seed}-events")
+    span = (args.end - args.start).total_seconds()
+
+    # a multiplier coprime with the user count permutes ids
+    stride = int(args.users * 0.618) | 1
+    while gcd(stride, args.users) != 1:
+        stride += 2
+
+    return Config(
+        seed=args.seed,
+        users=args.users,
+        mean_messages=args.messages / args.users,
+        mean_following=args.follows / args.users,
+        max_following=args.max_following,
+        start=args.start,
+        span=span,
+        events=[rng.uniform(0, span) for _ in range(NUM_EVENTS)],
+        stride=stride,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--messages', type=int, default=1000,
+                        help='about how many messages to make in all')
+    parser.add_argument('--follows', type=int, default=5000,
+                        help='about how many follows to make in all')
+    parser.add_argument('--max-following', type=int, default=5000,
+                        help='most users any one user follows')
+    parser.add_argument('--start', type=datetime.fromisoformat,
+                        default=datetime(2022, 1, 1))
+    parser.add_argument('--end', type=datetime.fromisoformat,
+                        default=datetime(2024, 1, 1))
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--out', default='generator',
+                        help='directory to write the CSVs to')
+    args = parser.parse_args()
+
+    config = make_config(args)
+    os.makedirs(args.out, exist_ok=True)
+
+    pool = Pool(args.workers) if args.workers > 1 else None
+
+    try:
+        write_csv(os.path.join(args.out, 'users.csv'), USERS_CSV_HEADERS,
+                  users_shard, config, pool)
+        write_csv(os.path.join(args.out, 'messages.csv'), MESSAGES_CSV_HEADERS,
+                  messages_shard, config, pool)
+        write_csv(os.path.join(args.out, 'follows.csv'), FOLLOWS_CSV_HEADERS,
+                  follows_shard, config, pool)
+
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
 
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
-]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,320 @@
+"""Write-behind buffering for likes and unlikes.
+
+When enabled, liking and unliking don't write to the database in the
+request. The intent is queued in-process instead, and a background thread
+writes queued intents every few seconds (or sooner, once enough pile up)
+as one multi-row INSERT, one multi-row DELETE and a few like_count
+UPDATEs. Only a user's latest intent for each message is kept, so liking
+and unliking a message over and over before it's written is one write.
+
+Each worker has its own buffer, and a user's clicks can land on different
+workers, so every click is queued, even one that doesn't change what this
+worker sees: it may be undoing an intent queued in another worker. Writes
+are idempotent (a like already there or an unlike of nothing changes
+nothing), and likes by users or of messages deleted in the meantime are
+dropped. Reads by the acting user go through the buffer (`overlay` and
+`delta`), so they see their own likes immediately; other users see them
+once they're written. Pages that can't be overlaid cheaply, like a user's
+own list of likes, write that user's intents first with `flush(user_id)`.
+Anything still queued is written when the worker exits.
+
+The background thread is started by the first intent queued in each
+process, not at import: a server that imports the app and then forks its
+workers (gunicorn --preload) would otherwise leave them without one, as
+threads don't survive a fork.
+"""
+
+import atexit
+import logging
+import os
+from collections import defaultdict
+from datetime import datetime
+from threading import Event, Lock, Thread
+
+from sqlalchemy import tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import db, Likes, Message, User
+
+logger = logging.getLogger(__name__)
+
+INSERTS = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}
+
+
+class LikeBuffer:
+    """Per-process queue of like/unlike intents, written in batches.
+
+    Intents are kept per user as {message_id: (liked_at, change)}, liked_at
+    being None for an unlike and change the difference the user has seen
+    it make to the message's like count (for `delta`).
+    """
+
+    # times a user's intents are tried before they're dropped
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, enabled=False, interval=2.0, max_pending=1000):
+        self.configure(enabled, interval, max_pending)
+        self._pending = defaultdict(dict)
+        self._attempts = {}
+        self._count = 0
+        self._lock = Lock()
+        self._wake = Event()
+        self._stopping = False
+        self._thread = None
+        self._app = None
+        self._pid = None
+        self._start_lock = Lock()
+
+    def configure(self, enabled, interval, max_pending):
+        """Turn buffering on or off, and set when queued intents are written."""
+
+        self.enabled = enabled
+        self.interval = interval
+        self.max_pending = max_pending
+
+    def __len__(self):
+        return self._count
+
+    def like(self, user_id, message_id, liked=False):
+        """Queue `user_id` liking `message_id`, which they'd `liked`
+        already as far as we know."""
+
+        self._queue(user_id, message_id, datetime.utcnow(), 0 if liked else 1)
+
+    def unlike(self, user_id, message_id, liked=True):
+        """Queue `user_id` unliking `message_id`, which they'd `liked` as
+        far as we know."""
+
+        self._queue(user_id, message_id, None, -1 if liked else 0)
+
+    def _queue(self, user_id, message_id, liked_at, change):
+        if self._app is not None and self._pid != os.getpid():
+            self._start()
+
+        with self._lock:
+            self._add(user_id, message_id, liked_at, change)
+            full = self._count >= self.max_pending
+
+        if full:
+            self._wake.set()
+
+    def _add(self, user_id, message_id, liked_at, change):
+        # the latest intent replaces an earlier one, adding to its change
+        intents = self._pending[user_id]
+        queued = intents.get(message_id)
+
+        if queued is None:
+            self._count += 1
+        else:
+            change += queued[1]
+
+        intents[message_id] = (liked_at, change)
+
+    def overlay(self, user_id, liked_ids):
+        """Apply `user_id`'s queued intents to the set of ids they've liked."""
+
+        with self._lock:
+            intents = dict(self._pending.get(user_id, {}))
+
+        liked = set(liked_ids)
+        for message_id, (liked_at, _) in intents.items():
+            if liked_at is None:
+                liked.discard(message_id)
+            else:
+                liked.add(message_id)
+
+        return liked
+
+    def delta(self, message_ids):
+        """Net queued change to the like count of each of `message_ids`."""
+
+        wanted = set(message_ids)
+        deltas = defaultdict(int)
+
+        with self._lock:
+            for intents in self._pending.values():
+                for message_id in wanted.intersection(intents):
+                    deltas[message_id] += intents[message_id][1]
+
+        return deltas
+
+    def flush(self, user_id=None):
+        """Write queued intents (only `user_id`'s, if given) and commit.
+
+        Uses the current app context's session. If the batch fails, each
+        user's intents are written on their own, so one bad user doesn't
+        hold up the rest; a user's intents that still fail are queued again
+        ahead of anything queued since, and dropped after MAX_ATTEMPTS
+        tries.
+        """
+
+        with self._lock:
+            if user_id is None:
+                batch, self._pending = self._pending, defaultdict(dict)
+            else:
+                batch = {user_id: self._pending.pop(user_id, {})}
+            self._count -= sum(len(intents) for intents in batch.values())
+
+        batch = {user_id: intents for user_id, intents in batch.items()
+                 if intents}
+        if not batch:
+            return
+
+        if len(batch) > 1:
+            try:
+                self._write(batch)
+                db.session.commit()
+
+            except Exception:
+                db.session.rollback()
+                logger.exception("Writing buffered likes failed; "
+                                 "writing them user by user")
+
+            else:
+                self._succeeded(batch)
+                return
+
+        for user_id, intents in batch.items():
+            try:
+                self._write({user_id: intents})
+                db.session.commit()
+
+            except Exception:
+                db.session.rollback()
+                self._retry(user_id, intents)
+
+            else:
+                self._succeeded({user_id: intents})
+
+    def _succeeded(self, batch):
+        with self._lock:
+            for user_id in batch:
+                self._attempts.pop(user_id, None)
+
+    def _retry(self, user_id, intents):
+        with self._lock:
+            attempts = self._attempts.pop(user_id, 0) + 1
+
+            if attempts >= self.MAX_ATTEMPTS:
+                logger.exception("Dropping %s buffered likes by user %s "
+                                 "after %s failed writes",
+                                 len(intents), user_id, attempts)
+                return
+
+            logger.warning("Writing buffered likes by user %s failed; "
+                           "will retry", user_id, exc_info=True)
+            self._attempts[user_id] = attempts
+
+            newer = self._pending.pop(user_id, {})
+            self._count -= len(newer)
+
+            for pending in (intents, newer):
+                for message_id, (liked_at, change) in pending.items():
+                    self._add(user_id, message_id, liked_at, change)
+
+    def _write(self, batch):
+        likes = [{'user_id': user_id, 'message_id': message_id,
+                  'created_at': liked_at}
+                 for user_id, intents in batch.items()
+                 for message_id, (liked_at, _) in intents.items()
+                 if liked_at is not None]
+        unlikes = [(user_id, message_id)
+                   for user_id, intents in batch.items()
+                   for message_id, (liked_at, _) in intents.items()
+                   if liked_at is None]
+
+        deltas = defaultdict(int)
+
+        if likes:
+            # skip users and messages deleted since the likes were queued
+            users = set(db.session.scalars(
+                db.select(User.id)
+                .where(User.id.in_({like['user_id'] for like in likes}))))
+            messages = set(db.session.scalars(
+                db.select(Message.id)
+                .where(Message.id.in_({like['message_id'] for like in likes}))))
+            likes = [like for like in likes
+                     if like['user_id'] in users
+                     and like['message_id'] in messages]
+
+        if likes:
+            insert = INSERTS[db.session.get_bind().dialect.name]
+            added = db.session.scalars(
+                insert(Likes)
+                .values(likes)
+                .on_conflict_do_nothing()
+                .returning(Likes.message_id))
+            for message_id in added:
+                deltas[message_id] += 1
+
+        if unlikes:
+            removed = db.session.scalars(
+                db.delete(Likes)
+                .where(tuple_(Likes.user_id, Likes.message_id).in_(unlikes))
+                .returning(Likes.message_id)
+                .execution_options(synchronize_session=False))
+            for message_id in removed:
+                deltas[message_id] -= 1
+
+        # most messages change by +/-1, so this is only a few UPDATEs
+        by_amount = defaultdict(list)
+        for message_id, amount in deltas.items():
+            if amount:
+                by_amount[amount].append(message_id)
+
+        for amount, message_ids in by_amount.items():
+            Message.adjust_like_count(amount, message_ids)
+
+    def init_app(self, app):
+        """Write queued intents from a background thread, started in each
+        process once it queues its first intent."""
+
+        self._app = app
+
+    def _start(self):
+        with self._start_lock:
+            pid = os.getpid()
+            if self._pid == pid:
+                return
+
+            if self._pid is not None:
+                # forked: the parent's thread didn't come with us, and its
+                # queue is the parent's to write
+                self._lock = Lock()
+                self._wake = Event()
+                self._pending = defaultdict(dict)
+                self._attempts = {}
+                self._count = 0
+
+            self._pid = pid
+            self._thread = Thread(target=self._run, args=(self._app,),
+                                  name='like-buffer', daemon=True)
+            self._thread.start()
+            atexit.register(self.close, self._app)
+
+    def _run(self, app):
+        while not self._stopping:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+            with app.app_context():
+                try:
+                    self.flush()
+                except Exception:
+                    logger.exception("Writing buffered likes failed")
+
+    def close(self, app):
+        """Stop the background thread and write anything still queued."""
+
+        self._stopping = True
+        self._wake.set()
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        with app.app_context():
+            self.flush()
+
+
+like_buffer = LikeBuffer()
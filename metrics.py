@@ -0,0 +1,316 @@
+"""Request metrics, served in Prometheus' text format at /metrics.
+
+For each endpoint we count requests by method and status, and keep
+histograms of request latency and of time spent in the database (from
+sql_stats), along with how many requests are in progress right now.
+
+Each worker process counts its own requests in memory. Given a directory
+(METRICS_DIR), every worker also writes its counts there as
+<pid>.json, from a background thread every FLUSH_INTERVAL seconds, and
+/metrics adds up the files of every worker, so it doesn't matter which
+worker answers the scrape. The thread is started by each process' first
+request rather than at import, so workers forked after the app is
+imported (gunicorn --preload) get their own. Counts from workers that have exited are kept;
+their in-progress requests are not. Empty the directory before starting
+the server (say, in gunicorn's on_starting hook) so counts don't carry
+over from the last run. Without a directory each worker reports only its
+own requests, which is all there is when running a single process.
+"""
+
+import atexit
+import json
+import logging
+import os
+from collections import Counter
+from threading import Event, Lock, Thread
+from time import perf_counter
+
+from flask import g, request
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# upper bounds (seconds) of the histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+FLUSH_INTERVAL = 1.0
+
+
+def new_histogram():
+    """Per-bucket counts (not cumulative; the last is +Inf), then the sum."""
+
+    return [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+
+
+def observe(histogram, value):
+    for i, bound in enumerate(LATENCY_BUCKETS):
+        if value <= bound:
+            break
+    else:
+        i = len(LATENCY_BUCKETS)
+
+    histogram[i] += 1
+    histogram[-1] += value
+
+
+def add_histograms(totals, counts):
+    for endpoint, histogram in counts.items():
+        total = totals.setdefault(endpoint, new_histogram())
+        for i, value in enumerate(histogram):
+            total[i] += value
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def escape(value):
+    return (str(value).replace('\\', r'\\').replace('\n', r'\n')
+            .replace('"', r'\"'))
+
+
+def labels(**values):
+    return ','.join(f'{name}="{escape(value)}"'
+                    for name, value in values.items())
+
+
+class Metrics:
+    """Request counters and histograms for one worker process."""
+
+    def __init__(self):
+        self.enabled = False
+        self.directory = None
+        self._lock = Lock()
+        self._wake = Event()
+        self._stopping = False
+        self._thread = None
+        self._pid = None
+        self._start_lock = Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget everything this process has counted."""
+
+        with self._lock:
+            self.requests = Counter()
+            self.latency = {}
+            self.db_time = {}
+            self.in_progress = 0
+
+    def init_app(self, app, enabled, directory):
+        """Add the request hooks and /metrics route to `app`.
+
+        Call before the app's own before_request hooks are added, so the
+        time they take is counted too.
+        """
+
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+        app.teardown_request(self.teardown_request)
+        app.add_url_rule('/metrics', 'metrics', self.serve)
+
+        self.enabled = enabled
+        self.directory = directory
+
+        if enabled and directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def start_request(self):
+        if not self.enabled:
+            return
+
+        if self.directory and self._pid != os.getpid():
+            self.start()
+
+        g.metrics_started = perf_counter()
+        with self._lock:
+            self.in_progress += 1
+
+    def finish_request(self, response):
+        if self.enabled and 'metrics_started' in g:
+            self.record(response.status_code)
+        return response
+
+    def teardown_request(self, exc):
+        # after_request hooks don't run for an unhandled exception
+        if self.enabled and 'metrics_started' in g:
+            self.record(500)
+
+    def record(self, status):
+        seconds = perf_counter() - g.pop('metrics_started')
+        stats = g.get('sql_stats')
+        endpoint = request.endpoint or 'none'
+
+        with self._lock:
+            self.in_progress -= 1
+            self.requests[endpoint, request.method, str(status)] += 1
+            observe(self.latency.setdefault(endpoint, new_histogram()),
+                    seconds)
+            if stats is not None:
+                observe(self.db_time.setdefault(endpoint, new_histogram()),
+                        stats.seconds)
+
+    def snapshot(self):
+        """This process' counts, as JSON-able data."""
+
+        with self._lock:
+            return {
+                'pid': os.getpid(),
+                'requests': [[*key, count]
+                             for key, count in self.requests.items()],
+                'latency': {endpoint: list(histogram)
+                            for endpoint, histogram in self.latency.items()},
+                'db_time': {endpoint: list(histogram)
+                            for endpoint, histogram in self.db_time.items()},
+                'in_progress': self.in_progress,
+            }
+
+    def write(self):
+        """Write this process' counts to its file in the metrics directory."""
+
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+
+        with open(f"{path}.tmp", 'w') as out:
+            json.dump(self.snapshot(), out)
+        os.replace(f"{path}.tmp", path)
+
+    def collect(self):
+        """Snapshots of every worker: this one's live, others' from their
+        files in the metrics directory."""
+
+        ours = self.snapshot()
+        snapshots = [ours]
+
+        if not self.directory:
+            return snapshots
+
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json') or name == f"{ours['pid']}.json":
+                continue
+
+            try:
+                with open(os.path.join(self.directory, name)) as in_file:
+                    snapshot = json.load(in_file)
+            except (OSError, ValueError):
+                continue
+
+            if not process_alive(snapshot['pid']):
+                snapshot['in_progress'] = 0
+            snapshots.append(snapshot)
+
+        return snapshots
+
+    def exposition(self):
+        """Every worker's metrics, in Prometheus' text format."""
+
+        requests = Counter()
+        latency = {}
+        db_time = {}
+        in_progress = 0
+
+        for snapshot in self.collect():
+            for *key, count in snapshot['requests']:
+                requests[tuple(key)] += count
+            add_histograms(latency, snapshot['latency'])
+            add_histograms(db_time, snapshot['db_time'])
+            in_progress += snapshot['in_progress']
+
+        lines = [
+            '# HELP warbler_http_requests_total Requests handled.',
+            '# TYPE warbler_http_requests_total counter',
+        ]
+        for (endpoint, method, status), count in sorted(requests.items()):
+            lines.append(
+                f"warbler_http_requests_total"
+                f"{{{labels(endpoint=endpoint, method=method, status=status)}}}"
+                f" {count}")
+
+        lines += [
+            '# HELP warbler_http_requests_in_progress Requests being handled.',
+            '# TYPE warbler_http_requests_in_progress gauge',
+            f"warbler_http_requests_in_progress {in_progress}",
+        ]
+
+        for name, help_text, histograms in [
+                ('warbler_http_request_duration_seconds',
+                 'Time to handle requests.', latency),
+                ('warbler_http_request_db_seconds',
+                 'Time spent running SQL statements per request.', db_time)]:
+            lines += [f"# HELP {name} {help_text}",
+                      f"# TYPE {name} histogram"]
+
+            for endpoint, histogram in sorted(histograms.items()):
+                cumulative = 0
+                for bound, count in zip((*LATENCY_BUCKETS, '+Inf'),
+                                        histogram):
+                    cumulative += count
+                    lines.append(
+                        f"{name}_bucket"
+                        f"{{{labels(endpoint=endpoint, le=bound)}}} "
+                        f"{cumulative}")
+
+                lines += [
+                    f"{name}_sum{{{labels(endpoint=endpoint)}}} "
+                    f"{histogram[-1]}",
+                    f"{name}_count{{{labels(endpoint=endpoint)}}} "
+                    f"{cumulative}",
+                ]
+
+        return '\n'.join(lines) + '\n'
+
+    def serve(self):
+        return self.exposition(), 200, {'Content-Type': CONTENT_TYPE}
+
+    def start(self):
+        """Start writing this process' counts to disk from a background
+        thread, unless this process already is."""
+
+        with self._start_lock:
+            pid = os.getpid()
+            if self._pid == pid:
+                return
+
+            if self._pid is not None:
+                # forked: the parent's thread didn't come with us, and its
+                # counts are in its own file
+                self._lock = Lock()
+                self._wake = Event()
+                self.reset()
+
+            self._pid = pid
+            self._thread = Thread(target=self._run, name='metrics',
+                                  daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def _run(self):
+        while not self._stopping:
+            self._wake.wait(FLUSH_INTERVAL)
+
+            try:
+                self.write()
+            except OSError:
+                logger.exception("Writing metrics failed")
+
+    def close(self):
+        """Stop the background thread, writing our counts one last time."""
+
+        self._stopping = True
+        self._wake.set()
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        self.write()
+
+
+metrics = Metrics()
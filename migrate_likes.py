@@ -0,0 +1,132 @@
+"""Convert the old likes table to the composite-key schema.
+
+The old table had a surrogate id and a unique message_id; the new one is
+keyed on (user_id, message_id) and records when each like was made. Run it
+once, from the project root, like:
+
+    python migrate_likes.py
+    python migrate_likes.py --batch-size 5000
+
+Rows are copied into a new table in batches of old ids, each batch its own
+transaction, so the old table stays usable while most of the copy happens.
+The last step locks the old table, copies whatever changed since, and swaps
+the new table in. Old likes get their message's timestamp as created_at,
+which keeps them in the order they were shown in before.
+"""
+
+import argparse
+
+from models import db, Likes, Message, User
+
+NEW_TABLE = 'likes_new'
+
+
+def is_legacy(conn):
+    """Does the likes table still have the old surrogate-id schema?"""
+
+    columns = db.inspect(conn).get_columns('likes')
+    return any(column['name'] == 'id' for column in columns)
+
+
+def new_table():
+    """The likes table as the model defines it, but named `NEW_TABLE`."""
+
+    metadata = db.MetaData()
+    User.__table__.to_metadata(metadata)
+    Message.__table__.to_metadata(metadata)
+
+    return Likes.__table__.to_metadata(metadata, name=NEW_TABLE)
+
+
+def copy_rows(conn, legacy, new, after, through=None):
+    """Copy old likes with ids in (after, through] into the new table."""
+
+    messages = Message.__table__
+    rows = (db.select(legacy.c.user_id, legacy.c.message_id,
+                      messages.c.timestamp)
+            .join(messages, messages.c.id == legacy.c.message_id)
+            .where(legacy.c.id > after, legacy.c.user_id.is_not(None)))
+
+    if through is not None:
+        rows = rows.where(legacy.c.id <= through)
+
+    return conn.execute(new.insert().from_select(
+        ['user_id', 'message_id', 'created_at'], rows)).rowcount
+
+
+def migrate(engine, batch_size=10000, log=print):
+    """Migrate the likes table on `engine`; returns the number of likes."""
+
+    with engine.connect() as conn:
+        with conn.begin():
+            if not is_legacy(conn):
+                log("likes table is already migrated.")
+                return None
+
+            legacy = db.Table('likes', db.MetaData(), autoload_with=conn)
+
+        new = new_table()
+        indexes = set(new.indexes)
+        new.indexes.clear()
+
+        with conn.begin():
+            new.drop(conn, checkfirst=True)
+            new.create(conn)
+            first_id, last_id = conn.execute(
+                db.select(db.func.min(legacy.c.id), db.func.max(legacy.c.id))
+            ).one()
+
+        copied = 0
+        for after in range((first_id or 1) - 1, last_id or 0, batch_size):
+            with conn.begin():
+                copied += copy_rows(conn, legacy, new, after,
+                                    after + batch_size)
+            log(f"Copied {copied} likes (ids through "
+                f"{min(after + batch_size, last_id)} of {last_id}).")
+
+        # indexes are cheaper to build once the rows are in
+        with conn.begin():
+            for index in indexes:
+                index.create(conn)
+
+        with conn.begin():
+            if conn.dialect.name == 'postgresql':
+                conn.execute(db.text(
+                    "LOCK TABLE likes IN SHARE ROW EXCLUSIVE MODE"))
+
+            # catch up on likes removed and added during the copy
+            conn.execute(new.delete().where(~db.exists().where(
+                legacy.c.id <= (last_id or 0),
+                legacy.c.user_id == new.c.user_id,
+                legacy.c.message_id == new.c.message_id)))
+            copy_rows(conn, legacy, new, last_id or 0)
+
+            legacy.drop(conn)
+            conn.execute(db.text(f"ALTER TABLE {NEW_TABLE} RENAME TO likes"))
+
+            if conn.dialect.name == 'postgresql':
+                for suffix in ('pkey', 'user_id_fkey', 'message_id_fkey'):
+                    conn.execute(db.text(
+                        f"ALTER TABLE likes RENAME CONSTRAINT "
+                        f"{NEW_TABLE}_{suffix} TO likes_{suffix}"))
+
+            total = conn.scalar(db.text("SELECT count(*) FROM likes"))
+
+        log(f"Migrated {total} likes.")
+        return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--batch-size', type=int, default=10000,
+                        help='old likes to copy per transaction')
+    args = parser.parse_args()
+
+    from app import app
+
+    with app.app_context():
+        migrate(db.engine, args.batch_size)
+
+
+if __name__ == '__main__':
+    main()
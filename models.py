@@ -1,19 +1,40 @@
 """SQLAlchemy models for Warbler."""
 
+import heapq
 from datetime import datetime
+from itertools import islice
+from time import perf_counter
 
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
 
-bcrypt = Bcrypt()
+from pagination import keyset
+from passwords import hasher
+
 db = SQLAlchemy()
 
+# text search configuration for Postgres full-text search over messages;
+# queries must use the same expression as the index for it to be used
+TEXT_SEARCH_CONFIG = db.literal_column("'english'::regconfig")
+
+
+def postgres_only(index):
+    """Make `index` only on Postgres, in create_all() and create_indexes()."""
+
+    index.info['dialect'] = 'postgresql'
+    return index.ddl_if(dialect='postgresql')
+
 
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
 
     __tablename__ = 'follows'
 
+    __table_args__ = (
+        # the primary key serves "followers of X"; this serves "who X follows"
+        db.Index('ix_follows_user_following_id',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
     user_being_followed_id = db.Column(
         db.Integer,
         db.ForeignKey('users.id', ondelete="cascade"),
@@ -28,32 +49,343 @@ class Follows(db.Model):
 
 
 class Likes(db.Model):
-    """Mapping user likes to warbles."""
+    """Mapping user likes to warbles.
 
-    __tablename__ = 'likes' 
+    Keyed on (user_id, message_id), which also serves "has this user liked
+    this message" lookups; the other indexes serve a user's likes newest
+    first and the likers of a message without touching the table.
+    """
 
-    id = db.Column(
+    __tablename__ = 'likes'
+
+    __table_args__ = (
+        db.Index('ix_likes_user_id_created_at',
+                 'user_id', 'created_at', 'message_id'),
+        db.Index('ix_likes_message_id_user_id', 'message_id', 'user_id'),
+    )
+
+    user_id = db.Column(
         db.Integer,
-        primary_key=True
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    @classmethod
+    def liked_ids(cls, user_id, message_ids):
+        """Which of `message_ids` has `user_id` liked?
+
+        One query restricted to the given ids, for rendering like buttons
+        without loading the user's whole likes collection.
+        """
+
+        if not message_ids:
+            return set()
+
+        return set(db.session.scalars(
+            db.select(cls.message_id)
+            .where(cls.user_id == user_id, cls.message_id.in_(message_ids))))
+
+
+class TimelineEntry(db.Model):
+    """A message materialized into a user's home timeline.
+
+    Rows are written when a message is posted (one per follower, plus one
+    for the author), so the homepage is a single range read on
+    (user_id, timestamp) instead of a scan over everyone the user follows.
+
+    Authors with more than `max_followers` followers are not fanned out;
+    their recent messages are merged into the timeline when it is read.
+    Once an author has gone over, they stay pulled (`User.timeline_pulled`)
+    even if they drop back under, since the messages they posted meanwhile
+    are only in their own timeline.
+    """
+
+    __tablename__ = 'timeline_entries'
+
+    __table_args__ = (
+        db.Index('ix_timeline_entries_user_id_timestamp',
+                 'user_id', 'timestamp', 'message_id'),
+        db.Index('ix_timeline_entries_user_id_author_id', 'user_id', 'author_id'),
+        db.Index('ix_timeline_entries_message_id', 'message_id'),
     )
 
     user_id = db.Column(
         db.Integer,
-        db.ForeignKey('users.id', ondelete='cascade')
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
     )
 
     message_id = db.Column(
         db.Integer,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+        primary_key=True,
     )
 
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    @classmethod
+    def fan_out(cls, message, max_followers=None):
+        """Add `message` to the timelines of its author and their followers.
+
+        The message must already be flushed so it has an id and timestamp.
+        If the author has more than `max_followers` followers, only the
+        author's own timeline is written and readers pull the message in.
+
+        Returns the number of timeline entries written.
+        """
+
+        author = db.select(
+            db.literal(message.user_id),
+            db.literal(message.id),
+            db.literal(message.user_id),
+            db.literal(message.timestamp))
+
+        if (max_followers is not None
+                and is_pulled(message.user_id, max_followers)):
+            db.session.execute(
+                db.insert(cls).from_select(
+                    ['user_id', 'message_id', 'author_id', 'timestamp'],
+                    author))
+            return 1
+
+        followers = (db.select(
+                        Follows.user_following_id,
+                        db.literal(message.id),
+                        db.literal(message.user_id),
+                        db.literal(message.timestamp))
+                     .where(Follows.user_being_followed_id == message.user_id))
+
+        result = db.session.execute(
+            db.insert(cls).from_select(
+                ['user_id', 'message_id', 'author_id', 'timestamp'],
+                db.union_all(followers, author)))
+        return result.rowcount
+
+    @classmethod
+    def add_author(cls, user_id, author_id, max_followers=None, limit=None):
+        """Copy `author_id`'s messages into `user_id`'s timeline: the most
+        recent `limit` of them, or all if None.
+
+        This runs when following someone, so keep `limit` to about a page;
+        older messages are on the author's profile, and `rebuild` fills in
+        the rest. Pulled authors (see `is_pulled`) are skipped, as `read`
+        pulls their messages in.
+        """
+
+        if max_followers is not None and is_pulled(author_id, max_followers):
+            return
+
+        messages = (db.select(
+                        db.literal(user_id),
+                        Message.id,
+                        Message.user_id,
+                        Message.timestamp)
+                    .where(Message.user_id == author_id))
+
+        if limit is not None:
+            messages = (messages
+                        .order_by(Message.timestamp.desc(), Message.id.desc())
+                        .limit(limit))
+
+        db.session.execute(
+            db.insert(cls).from_select(
+                ['user_id', 'message_id', 'author_id', 'timestamp'],
+                messages))
+
+    @classmethod
+    def remove_author(cls, user_id, author_id):
+        """Drop `author_id`'s messages from `user_id`'s timeline."""
+
+        db.session.execute(
+            db.delete(cls)
+            .where(cls.user_id == user_id, cls.author_id == author_id))
+
+    @classmethod
+    def remove_message(cls, message_id):
+        """Drop a message from every timeline it was fanned out to."""
+
+        db.session.execute(db.delete(cls).where(cls.message_id == message_id))
+
+    @classmethod
+    def read(cls, user_id, limit, max_followers=None, before=None, after=None):
+        """Get up to `limit` messages from `user_id`'s home timeline.
+
+        Reads the materialized entries and, if `max_followers` is set,
+        merges in recent messages from followed authors above that
+        threshold (whose messages were not fanned out).
+
+        `before`/`after` are decoded (timestamp, id) cursors, as for
+        `pagination.keyset`; messages are newest-first unless paging `after`.
+
+        Returns (messages, stats); stats reports how many authors were
+        pulled, how many candidate rows were merged and the merge time.
+        """
+
+        # authors are joined in, since the timeline shows each one's name/image
+        entries = (Message
+                   .query
+                   .join(cls, cls.message_id == Message.id)
+                   .filter(cls.user_id == user_id)
+                   .options(db.joinedload(Message.user)))
+        sources = [keyset(entries, cls.timestamp, cls.message_id,
+                          before, after).limit(limit).all()]
+
+        pulled = []
+        if max_followers is not None:
+            pulled = pulled_authors(user_id, max_followers)
+            for author_id in pulled:
+                authored = (Message
+                            .query
+                            .filter(Message.user_id == author_id)
+                            .options(db.joinedload(Message.user)))
+                sources.append(keyset(authored, Message.timestamp, Message.id,
+                                      before, after).limit(limit).all())
+
+        start = perf_counter()
+        messages = merge_messages(sources, limit, newest_first=not after)
+        stats = {
+            'pulled_authors': len(pulled),
+            'candidates': sum(len(source) for source in sources),
+            'merge_ms': (perf_counter() - start) * 1000,
+        }
+
+        return messages, stats
+
+    @classmethod
+    def rebuild(cls, max_followers=None):
+        """Rebuild every timeline from the messages and follows tables.
+
+        Messages by authors with more than `max_followers` followers only
+        go in the author's own timeline, as when they're posted, and every
+        author is marked pulled or not afresh by their follower count.
+        Follower counts must be up to date (see `User.reconcile_counters`).
+
+        Returns the number of timeline entries written.
+        """
+
+        db.session.execute(db.delete(cls))
+        db.session.execute(
+            db.update(User)
+            .values(timeline_pulled=(User.followers_count > max_followers)
+                    if max_followers is not None else False)
+            .execution_options(synchronize_session=False))
+
+        followed = (db.select(
+                        Follows.user_following_id,
+                        Message.id,
+                        Message.user_id,
+                        Message.timestamp)
+                    .join(Follows,
+                          Follows.user_being_followed_id == Message.user_id))
+
+        if max_followers is not None:
+            fanned_out = db.select(User.id).where(~User.timeline_pulled)
+            followed = followed.where(Message.user_id.in_(fanned_out))
+
+        own = db.select(
+            Message.user_id,
+            Message.id,
+            Message.user_id,
+            Message.timestamp)
+
+        db.session.execute(
+            db.insert(cls).from_select(
+                ['user_id', 'message_id', 'author_id', 'timestamp'],
+                db.union_all(followed, own)))
+
+        return db.session.scalar(db.select(db.func.count()).select_from(cls))
+
+
+def is_pulled(author_id, max_followers):
+    """Are `author_id`'s messages pulled into timelines on read, rather
+    than fanned out?
+
+    They are once the author has more than `max_followers` followers, and
+    from then on: the author is marked `timeline_pulled`, so falling back
+    under the threshold doesn't lose what they posted while over it.
+    """
+
+    followers, pulled = db.session.execute(
+        db.select(User.followers_count, User.timeline_pulled)
+        .where(User.id == author_id)).one()
+
+    if not pulled and followers > max_followers:
+        db.session.execute(
+            db.update(User)
+            .where(User.id == author_id)
+            .values(timeline_pulled=True))
+        pulled = True
+
+    return pulled
+
+
+def pulled_authors(user_id, max_followers):
+    """Ids of users followed by `user_id` whose messages are pulled (see
+    `is_pulled`)."""
+
+    followed = (db.select(Follows.user_being_followed_id)
+                .where(Follows.user_following_id == user_id))
+
+    return db.session.scalars(
+        db.select(User.id)
+        .where(User.id.in_(followed),
+               User.timeline_pulled
+               | (User.followers_count > max_followers))
+    ).all()
+
+
+def merge_messages(sources, limit, newest_first=True):
+    """Merge sorted lists of messages into the first `limit` of them.
+
+    Each source must already be ordered by (timestamp, id), newest-first
+    unless `newest_first` is False. Messages appearing in more than one
+    source are only kept once.
+    """
+
+    merged = heapq.merge(*sources,
+                         key=lambda msg: (msg.timestamp, msg.id),
+                         reverse=newest_first)
+    seen = set()
+    unique = (msg for msg in merged
+              if msg.id not in seen and not seen.add(msg.id))
+
+    return list(islice(unique, limit))
+
 
 class User(db.Model):
     """User in the system."""
 
     __tablename__ = 'users'
 
+    __table_args__ = (
+        # serves ILIKE '%term%' and 'term%' username searches on Postgres
+        postgres_only(
+            db.Index('ix_users_username_trgm', 'username',
+                     postgresql_using='gin',
+                     postgresql_ops={'username': 'gin_trgm_ops'})),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True,
@@ -94,6 +426,39 @@ class User(db.Model):
         nullable=False,
     )
 
+    # denormalized counts, kept up to date by the routes that change them;
+    # run `flask reconcile-counters` to fix any drift
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # set once the user has had more followers than the timeline fan-out
+    # threshold; their messages are pulled into timelines from then on
+    # (see TimelineEntry), until timelines are next rebuilt
+    timeline_pulled = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+        server_default=db.false(),
+    )
+
     messages = db.relationship('Message', backref = 'users', cascade='all, delete')
 
     followers = db.relationship(
@@ -115,23 +480,101 @@ class User(db.Model):
         secondary="likes"
     )
 
+    # only loaded when asked for, as a COUNT rather than the liked rows
+    likes_count = db.column_property(
+        db.select(db.func.count())
+        .where(Likes.user_id == id)
+        .correlate_except(Likes)
+        .scalar_subquery(),
+        deferred=True,
+    )
+
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return db.session.scalar(db.select(db.exists().where(
+            Follows.user_being_followed_id == self.id,
+            Follows.user_following_id == other_user.id)))
 
     def is_following(self, other_user):
         """Is this user following `other_user`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return db.session.scalar(db.select(db.exists().where(
+            Follows.user_being_followed_id == other_user.id,
+            Follows.user_following_id == self.id)))
+
+    def following_ids(self, user_ids):
+        """Which of `user_ids` is this user following? (one query)"""
+
+        if not user_ids:
+            return set()
+
+        return set(db.session.scalars(
+            db.select(Follows.user_being_followed_id)
+            .where(Follows.user_following_id == self.id,
+                   Follows.user_being_followed_id.in_(user_ids))))
+
+    def followed_by_ids(self, user_ids):
+        """Which of `user_ids` are following this user? (one query)"""
+
+        if not user_ids:
+            return set()
+
+        return set(db.session.scalars(
+            db.select(Follows.user_following_id)
+            .where(Follows.user_being_followed_id == self.id,
+                   Follows.user_following_id.in_(user_ids))))
+
+    @classmethod
+    def adjust_counter(cls, column, amount, user_ids):
+        """Atomically add `amount` to counter `column` for `user_ids`.
+
+        `user_ids` may be a list of ids or a select of them.
+
+        Done as one UPDATE ... SET col = col + amount, so concurrent
+        requests can't lose each other's changes.
+        """
+
+        counter = getattr(cls, column)
+        db.session.execute(
+            db.update(cls)
+            .where(cls.id.in_(user_ids))
+            .values({counter: counter + amount}))
+
+    @classmethod
+    def reconcile_counters(cls):
+        """Recompute every user's counters from the underlying tables.
+
+        Returns the number of users whose counters had drifted.
+        """
+
+        messages = (db.select(db.func.count())
+                    .where(Message.user_id == cls.id)
+                    .scalar_subquery())
+        following = (db.select(db.func.count())
+                     .where(Follows.user_following_id == cls.id)
+                     .scalar_subquery())
+        followers = (db.select(db.func.count())
+                     .where(Follows.user_being_followed_id == cls.id)
+                     .scalar_subquery())
+
+        result = db.session.execute(
+            db.update(cls)
+            .where(db.or_(cls.messages_count != messages,
+                          cls.following_count != following,
+                          cls.followers_count != followers))
+            .values(messages_count=messages,
+                    following_count=following,
+                    followers_count=followers)
+            .execution_options(synchronize_session=False))
+
+        return result.rowcount
 
     def check_password(self, password):
-        if bcrypt.check_password_hash(self.password, password):
+        if hasher.check(self.password, password):
             return True
         return False
 
@@ -143,7 +586,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hasher.hash(password)
 
         user = User(
             username=username,
@@ -164,13 +607,18 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        If the user's hash was made with a different bcrypt cost than we now
+        use, it's replaced with a fresh hash (commit to save it).
         """
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = hasher.check(user.password, password)
             if is_auth:
+                if hasher.needs_rehash(user.password):
+                    user.password = hasher.hash(password)
                 return user
 
         return False
@@ -194,7 +642,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -203,8 +651,128 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # denormalized count of likes; see adjust_like_count / recount_likes
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     user = db.relationship('User')
 
+    __table_args__ = (
+        db.Index('ix_messages_user_id_timestamp', 'user_id', 'timestamp', 'id'),
+        # full-text search on Postgres (see search.py)
+        postgres_only(
+            db.Index('ix_messages_text_fts',
+                     db.func.to_tsvector(TEXT_SEARCH_CONFIG, text),
+                     postgresql_using='gin')),
+    )
+
+    @classmethod
+    def adjust_like_count(cls, amount, message_ids):
+        """Atomically add `amount` to the like count of `message_ids`.
+
+        `message_ids` may be a list of ids or a select of them. Done as one
+        UPDATE ... SET like_count = like_count + amount, like
+        User.adjust_counter.
+        """
+
+        db.session.execute(
+            db.update(cls)
+            .where(cls.id.in_(message_ids))
+            .values(like_count=cls.like_count + amount))
+
+    @classmethod
+    def recount_likes(cls):
+        """Recompute every message's like count from the likes table.
+
+        Returns the number of messages whose count had drifted.
+        """
+
+        likes = (db.select(db.func.count())
+                 .where(Likes.message_id == cls.id)
+                 .scalar_subquery())
+
+        result = db.session.execute(
+            db.update(cls)
+            .where(cls.like_count != likes)
+            .values(like_count=likes)
+            .execution_options(synchronize_session=False))
+
+        return result.rowcount
+
+    def serialize(self):
+        """Serialize message (and its author) to a dict for JSON."""
+
+        return {
+            "id": self.id,
+            "text": self.text,
+            "timestamp": self.timestamp.isoformat(),
+            "user_id": self.user_id,
+            "like_count": self.like_count,
+            "username": self.user.username,
+            "image_url": self.user.image_url,
+        }
+
+
+db.event.listen(
+    User.__table__,
+    'before_create',
+    db.DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    .execute_if(dialect='postgresql'),
+)
+
+
+def create_indexes(engine, log=print):
+    """Create any index declared on the models but missing from the database.
+
+    create_all() only makes indexes along with new tables, so databases made
+    before an index was declared need this. On Postgres indexes are built
+    CONCURRENTLY, so the tables stay writable meanwhile.
+
+    Returns the names of the indexes created.
+    """
+
+    created = []
+
+    with engine.connect().execution_options(
+            isolation_level='AUTOCOMMIT') as conn:
+        if conn.dialect.name == 'postgresql':
+            conn.execute(db.text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+
+        inspector = db.inspect(conn)
+
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+
+            existing = {index['name']
+                        for index in inspector.get_indexes(table.name)}
+
+            for index in sorted(table.indexes, key=lambda index: index.name):
+                if index.name in existing:
+                    continue
+
+                # not for this dialect (see postgres_only)
+                if index.info.get('dialect', conn.dialect.name) != (
+                        conn.dialect.name):
+                    continue
+
+                ddl = db.schema.CreateIndex(index)
+                if conn.dialect.name == 'postgresql':
+                    sql = str(ddl.compile(dialect=conn.dialect))
+                    conn.execute(db.text(sql.replace(
+                        'INDEX', 'INDEX CONCURRENTLY', 1)))
+                else:
+                    conn.execute(ddl)
+
+                log(f"Created {index.name}")
+                created.append(index.name)
+
+    return created
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -0,0 +1,75 @@
+"""Keyset (cursor) pagination for newest-first message lists.
+
+Pages are found by comparing (timestamp, id) against the last row seen
+instead of using OFFSET, so page 500 costs the same as page 1.
+"""
+
+import base64
+from datetime import datetime
+
+from sqlalchemy import tuple_
+
+
+def encode_cursor(message):
+    """Make an opaque cursor pointing at `message`'s place in a list."""
+
+    raw = f"{message.timestamp.isoformat()}|{message.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Turn a cursor back into (timestamp, id).
+
+    Raises ValueError if the cursor is malformed.
+    """
+
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        timestamp, id = base64.urlsafe_b64decode(padded).decode().split('|')
+        return datetime.fromisoformat(timestamp), int(id)
+
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from e
+
+
+def keyset(query, timestamp, id, before=None, after=None):
+    """Restrict and order `query` to the rows just past a decoded cursor.
+
+    Rows come back newest-first when paging `before` a cursor (or from the
+    top), and oldest-first when paging `after` one; `Page` flips them back.
+    """
+
+    if after:
+        return (query
+                .filter(tuple_(timestamp, id) > tuple_(*after))
+                .order_by(timestamp.asc(), id.asc()))
+
+    if before:
+        query = query.filter(tuple_(timestamp, id) < tuple_(*before))
+
+    return query.order_by(timestamp.desc(), id.desc())
+
+
+class Page:
+    """One page of newest-first messages, with cursors to its neighbours.
+
+    `rows` should be fetched with a limit of `per_page + 1` so we can tell
+    whether there's anything past this page.
+    """
+
+    def __init__(self, rows, per_page, before=None, after=None):
+        more = len(rows) > per_page
+        rows = rows[:per_page]
+
+        if after:
+            rows.reverse()
+
+        self.items = rows
+        self.older = None
+        self.newer = None
+
+        if rows and (more or after):
+            self.older = encode_cursor(rows[-1])
+
+        if rows and (before or (after and more)):
+            self.newer = encode_cursor(rows[0])
@@ -0,0 +1,91 @@
+"""Password hashing on a bounded pool of threads in each process.
+
+bcrypt is deliberately slow CPU work. Every hash runs on a small, fixed
+pool, so at most `workers` hashes run at once in a process (bcrypt
+releases the GIL while it hashes), and once `queue` more are waiting,
+further ones are refused straight away with PasswordHasherBusy instead of
+piling up.
+
+What it doesn't do: the request still waits for its hash, so it doesn't
+free the thread or process handling the request (with sync workers the
+pool changes nothing about how many requests a worker can take), and
+the bound is per process, so a host may run up to `workers` hashes for
+each server process. Keep `workers` small, 1 by default, and size the
+server's process count with that in mind.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore
+
+from flask_bcrypt import Bcrypt
+
+bcrypt = Bcrypt()
+
+
+class PasswordHasherBusy(Exception):
+    """Raised when too many hashes are already running or queued."""
+
+
+class PasswordHasher:
+    """Hash and check passwords with bcrypt on a bounded thread pool.
+
+    `rounds` is the bcrypt cost used for new hashes; at most `workers`
+    hashes run at once, with up to `queue` more waiting behind them.
+    """
+
+    def __init__(self, rounds=12, workers=1, queue=32):
+        self.configure(rounds, workers, queue)
+
+    def configure(self, rounds, workers, queue):
+        """(Re)size the pool and set the cost used for new hashes."""
+
+        old_pool = getattr(self, '_pool', None)
+
+        self.rounds = rounds
+        self._pool = ThreadPoolExecutor(max_workers=workers,
+                                        thread_name_prefix='bcrypt')
+        self._slots = BoundedSemaphore(workers + queue)
+
+        if old_pool is not None:
+            old_pool.shutdown(wait=False)
+
+    def _run(self, fn, *args):
+        slots = self._slots
+
+        if not slots.acquire(blocking=False):
+            raise PasswordHasherBusy()
+
+        try:
+            future = self._pool.submit(fn, *args)
+        except Exception:
+            slots.release()
+            raise
+
+        future.add_done_callback(lambda _: slots.release())
+        return future.result()
+
+    def hash(self, password):
+        """Hash `password` at the configured cost; returns a str."""
+
+        hashed = self._run(bcrypt.generate_password_hash, password, self.rounds)
+        return hashed.decode('UTF-8')
+
+    def check(self, hashed, password):
+        """Does `password` match the stored hash `hashed`?"""
+
+        return self._run(bcrypt.check_password_hash, hashed, password)
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made with a different cost than we use now?"""
+
+        # bcrypt hashes look like $2b$12$<salt+hash>, 12 being the cost
+        return cost(hashed) != self.rounds
+
+
+def cost(hashed):
+    """The bcrypt cost (log rounds) a hash was made with."""
+
+    return int(hashed.split('$')[2])
+
+
+hasher = PasswordHasher()
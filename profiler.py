@@ -0,0 +1,188 @@
+"""Profile live requests on demand.
+
+A request is profiled with cProfile when it carries a valid X-Profile
+header (a token signed with the app's secret key; `flask profile-token`
+makes one), or at random for a PROFILE_SAMPLE_RATE fraction of requests.
+Only one request per worker is profiled at a time; others go ahead
+unprofiled meanwhile.
+
+Each profile is written to PROFILE_DIR as a pstats file (<name>.prof),
+which snakeviz, flameprof, gprof2dot and the like load as they are, with a
+<name>.json summary alongside: the request, its wall time and how its
+time split between SQL (SQLAlchemy and the database driver), Jinja
+templates and everything else. Only the newest PROFILE_MAX_FILES profiles
+are kept. Profiled responses get an X-Profile-Id header naming their file.
+"""
+
+import cProfile
+import json
+import os
+import pstats
+import random
+from datetime import datetime
+from threading import Lock
+from time import perf_counter
+
+from flask import current_app, g, request
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+HEADER = 'X-Profile'
+ID_HEADER = 'X-Profile-Id'
+
+# where a function's own time goes, by the file it's in (or for C
+# functions, its name)
+SQL_MARKERS = ('/sqlalchemy/', '/psycopg2/', 'sqlite3')
+TEMPLATE_MARKERS = ('/jinja2/', '/markupsafe/', '.html')
+
+
+def time_split(profile):
+    """Seconds `profile` spent in SQL, in templates and in other Python."""
+
+    split = {'sql': 0.0, 'templates': 0.0, 'python': 0.0}
+
+    for (filename, line, name), (_, _, own_time, _, _) in (
+            pstats.Stats(profile).stats.items()):
+        where = name if filename == '~' else filename
+
+        if any(marker in where for marker in SQL_MARKERS):
+            split['sql'] += own_time
+        elif any(marker in where for marker in TEMPLATE_MARKERS):
+            split['templates'] += own_time
+        else:
+            split['python'] += own_time
+
+    return split
+
+
+class Profiler:
+    """Request hooks that profile chosen requests into a directory."""
+
+    def __init__(self):
+        self.configure(None, 0.0, 200, 86400)
+        self._busy = Lock()
+
+    def init_app(self, app, directory, sample_rate, max_files, token_max_age):
+        """Add the request hooks to `app`.
+
+        Call before the app's own request hooks are added, so the time
+        they take is profiled too, and after sql_stats.init_app, so its
+        statement count is still there when the profile is written.
+        """
+
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+        app.teardown_request(self.teardown_request)
+
+        self.configure(directory, sample_rate, max_files, token_max_age)
+
+    def configure(self, directory, sample_rate, max_files, token_max_age):
+        """Profile into `directory` (None to turn profiling off), sampling
+        `sample_rate` of requests, keeping the newest `max_files`."""
+
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.max_files = max_files
+        self.token_max_age = token_max_age
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def _serializer(secret_key):
+        return URLSafeTimedSerializer(secret_key, salt='profile')
+
+    def make_token(self, secret_key):
+        """A token for the X-Profile header, good for token_max_age
+        seconds."""
+
+        return self._serializer(secret_key).dumps('profile')
+
+    def requested(self):
+        """Has this request a valid X-Profile token?"""
+
+        token = request.headers.get(HEADER)
+        if not token:
+            return False
+
+        try:
+            self._serializer(current_app.secret_key).loads(
+                token, max_age=self.token_max_age)
+        except BadSignature:
+            return False
+
+        return True
+
+    def start_request(self):
+        if not self.directory:
+            return
+
+        if not (self.requested() or random.random() < self.sample_rate):
+            return
+
+        if not self._busy.acquire(blocking=False):
+            return
+
+        g.profile_started = (datetime.utcnow(), perf_counter())
+        g.profile = cProfile.Profile()
+        g.profile.enable()
+
+    def finish_request(self, response):
+        if 'profile' in g:
+            response.headers[ID_HEADER] = self.stop(response.status_code)
+        return response
+
+    def teardown_request(self, exc):
+        # after_request hooks don't run for an unhandled exception
+        if 'profile' in g:
+            self.stop(500)
+
+    def stop(self, status):
+        """Stop profiling the request and write it out; returns its name."""
+
+        profile = g.pop('profile')
+        profile.disable()
+        started, start_time = g.pop('profile_started')
+        wall_time = perf_counter() - start_time
+        self._busy.release()
+
+        name = (f"{started:%Y%m%dT%H%M%S%f}-{os.getpid()}-"
+                f"{request.endpoint or 'none'}")
+        path = os.path.join(self.directory, name)
+
+        profile.dump_stats(f"{path}.prof")
+
+        stats = g.get('sql_stats')
+        summary = {
+            'method': request.method,
+            'path': request.full_path.rstrip('?'),
+            'endpoint': request.endpoint,
+            'status': status,
+            'started': started.isoformat(),
+            'wall_ms': round(wall_time * 1000, 3),
+            'split_ms': {part: round(seconds * 1000, 3)
+                         for part, seconds in time_split(profile).items()},
+            'statements': stats.statements if stats is not None else None,
+        }
+
+        with open(f"{path}.json", 'w') as out:
+            json.dump(summary, out, indent=2)
+
+        self.prune()
+        return name
+
+    def prune(self):
+        """Delete all but the newest max_files profiles."""
+
+        names = sorted(name[:-len('.prof')]
+                       for name in os.listdir(self.directory)
+                       if name.endswith('.prof'))
+
+        for name in names[:-self.max_files]:
+            for extension in ('.prof', '.json'):
+                try:
+                    os.remove(os.path.join(self.directory, name + extension))
+                except FileNotFoundError:
+                    pass
+
+
+profiler = Profiler()
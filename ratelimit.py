@@ -0,0 +1,184 @@
+"""Token-bucket rate limiting for login and signup attempts.
+
+Every key (a client IP, or a username) gets a bucket holding up to
+`burst` tokens, refilled at `rate` tokens a second; each attempt takes a
+token, and attempts on an empty bucket are refused. Checking a bucket is
+far cheaper than the bcrypt work it protects.
+
+Bucket state lives in a store. `MemoryStore` is per-process; `SQLiteStore`
+keeps buckets in a SQLite file, so every gunicorn worker on a host shares
+the same limits. Any object with the same `take()` method can be used for
+a networked store.
+
+A bucket that has sat idle long enough to refill is the same as a brand
+new one, so stores can drop idle buckets without changing behavior;
+that's how both keep their memory bounded.
+"""
+
+import sqlite3
+from collections import OrderedDict
+from threading import Lock
+from time import time
+
+
+def refill(tokens, updated, now, burst, rate):
+    """How many tokens a bucket has now, given its last known state."""
+
+    return min(burst, tokens + (now - updated) * rate)
+
+
+class MemoryStore:
+    """Per-process bucket store, holding at most `max_keys` buckets."""
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def take(self, key, burst, rate, now):
+        """Try to take a token from `key`'s bucket.
+
+        Returns 0 if we got one, or else how many seconds until we could.
+        """
+
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens = refill(tokens, updated, now, burst, rate)
+
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / rate
+
+            self._buckets[key] = (tokens, now)
+            self._evict(burst, rate, now)
+
+            return wait
+
+    def _evict(self, burst, rate, now):
+        # buckets are in least-recently-used order
+        idle_after = burst / rate
+
+        while self._buckets:
+            key, (tokens, updated) = next(iter(self._buckets.items()))
+
+            if (len(self._buckets) <= self.max_keys
+                    and now - updated < idle_after):
+                break
+
+            del self._buckets[key]
+
+
+class SQLiteStore:
+    """Bucket store in a SQLite file, shared by every process using it."""
+
+    PRUNE_EVERY = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self._calls = 0
+
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS buckets (
+                    key TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    updated REAL NOT NULL
+                )""")
+            conn.execute("""
+                CREATE INDEX IF NOT EXISTS ix_buckets_updated
+                ON buckets (updated)""")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=5, isolation_level=None)
+
+    def __len__(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT count(*) FROM buckets").fetchone()[0]
+
+    def take(self, key, burst, rate, now):
+        """Try to take a token from `key`'s bucket.
+
+        Returns 0 if we got one, or else how many seconds until we could.
+        """
+
+        self._calls += 1
+        conn = self._connect()
+
+        try:
+            # IMMEDIATE takes the write lock up front, so two processes
+            # can't both read the same bucket and spend the same token
+            conn.execute("BEGIN IMMEDIATE")
+
+            row = conn.execute(
+                "SELECT tokens, updated FROM buckets WHERE key = ?",
+                (key,)).fetchone()
+            tokens = refill(*(row or (burst, now)), now, burst, rate)
+
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / rate
+
+            conn.execute(
+                "INSERT OR REPLACE INTO buckets (key, tokens, updated) "
+                "VALUES (?, ?, ?)",
+                (key, tokens, now))
+
+            if self._calls % self.PRUNE_EVERY == 0:
+                conn.execute("DELETE FROM buckets WHERE updated < ?",
+                             (now - burst / rate,))
+
+            conn.execute("COMMIT")
+            return wait
+
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+
+        finally:
+            conn.close()
+
+
+class RateLimiter:
+    """Token-bucket limiter: `burst` attempts at once, `rate` per second after."""
+
+    def __init__(self, store, burst, rate):
+        self.store = store
+        self.burst = burst
+        self.rate = rate
+
+    def hit(self, *keys):
+        """Record an attempt against every key in `keys`.
+
+        Returns 0 if allowed, or else the seconds to wait before retrying.
+        Stops at the first key that's out of tokens, so one busy key
+        doesn't drain the others.
+        """
+
+        now = time()
+
+        for key in keys:
+            wait = self.store.take(key, self.burst, self.rate, now)
+            if wait:
+                return wait
+
+        return 0
+
+
+def make_store(backend, path=None, max_keys=100000):
+    """Make the bucket store named by `backend` ('memory' or 'sqlite')."""
+
+    if backend == 'memory':
+        return MemoryStore(max_keys)
+
+    if backend == 'sqlite':
+        return SQLiteStore(path)
+
+    raise ValueError(f"Unknown rate limit backend: {backend!r}")
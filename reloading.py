@@ -0,0 +1,101 @@
+"""In-process indexes of database rows, rebuilt without holding up requests.
+
+Each worker builds its index the first time a request needs it. After
+that, once the index is older than its max age, `refresh` starts
+rebuilding it from the database in a background thread and returns
+straight away: requests keep using the old contents until the new ones
+are swapped in. Changes this worker makes to the index while a rebuild is
+reading the table (a message posted, a user renamed) are replayed onto
+the new contents, so they aren't lost when it's swapped in.
+"""
+
+import abc
+import logging
+from threading import Lock, Thread
+from time import monotonic
+
+from flask import current_app
+
+logger = logging.getLogger(__name__)
+
+
+class ReloadingIndex(abc.ABC):
+    """Base for indexes rebuilt from a table by `load`.
+
+    Subclasses implement `load`, which calls `_start_recording` before
+    reading the table, builds new contents, and swaps them in under
+    `_lock` after replaying `_changes`, then calls `_finish_rebuild`.
+    Their own updates should `_note` what they changed, with the lock held.
+    """
+
+    def __init__(self):
+        self._built_at = None
+        self._changes = None
+        self._lock = Lock()
+        self._thread = None
+
+    @abc.abstractmethod
+    def load(self):
+        """Rebuild the index from the database."""
+
+    def refresh(self, max_age):
+        """Build the index if it's never been built; if it's over `max_age`
+        seconds old, start rebuilding it in the background."""
+
+        if self._built_at is None:
+            self._reload()
+
+        elif monotonic() - self._built_at > max_age:
+            self._reload_in_background()
+
+    def expire(self):
+        """Rebuild on the next `refresh`, in the request."""
+
+        self._built_at = None
+
+    def _start_recording(self):
+        with self._lock:
+            if self._changes is None:
+                self._changes = []
+
+    def _note(self, *change):
+        if self._changes is not None:
+            self._changes.append(change)
+
+    def _finish_rebuild(self):
+        # with the lock held, once the new contents are in
+        self._changes = None
+        self._built_at = monotonic()
+
+    def _reload(self):
+        try:
+            self.load()
+
+        except Exception:
+            with self._lock:
+                self._changes = None
+            raise
+
+    def _reload_in_background(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+
+            self._thread = Thread(
+                target=self._run, args=(current_app._get_current_object(),),
+                name=f"reload-{type(self).__name__}", daemon=True)
+
+        self._thread.start()
+
+    def _run(self, app):
+        try:
+            with app.app_context():
+                self._reload()
+
+        except Exception:
+            logger.exception("Rebuilding %s failed", type(self).__name__)
+            # try again once it's max_age old again
+            self._built_at = monotonic()
+
+        finally:
+            self._thread = None
@@ -0,0 +1,172 @@
+"""Full-text search over messages.
+
+On Postgres we use its built-in full-text search, served by the GIN index
+on to_tsvector(messages.text), which Postgres keeps current itself.
+Elsewhere (SQLite in tests and development) we fall back to an in-process
+inverted index, updated as messages are posted and deleted and rebuilt
+from the messages table in the background once it gets old (see
+reloading.py).
+
+Both return message ids, best match first; ties go to the newest message.
+"""
+
+import heapq
+import re
+from collections import defaultdict
+from math import log
+
+from models import db, Message, TEXT_SEARCH_CONFIG
+from reloading import ReloadingIndex
+
+WORD_RE = re.compile(r"\w+")
+
+
+def tokenize(text):
+    """Split text into lowercased words."""
+
+    return WORD_RE.findall(text.lower())
+
+
+def index_message(postings, words, message_id, text):
+    counts = defaultdict(int)
+    for word in tokenize(text):
+        counts[word] += 1
+
+    words[message_id] = tuple(counts)
+    for word, count in counts.items():
+        postings[word][message_id] = count
+
+
+def unindex_message(postings, words, message_id):
+    for word in words.pop(message_id, ()):
+        word_postings = postings[word]
+        word_postings.pop(message_id, None)
+        if not word_postings:
+            del postings[word]
+
+
+class PostgresSearch:
+    """Search using Postgres full-text search."""
+
+    def add(self, message):
+        """Nothing to do; Postgres maintains the index."""
+
+    def remove(self, message_id):
+        """Nothing to do; Postgres maintains the index."""
+
+    def refresh(self, max_age):
+        """Nothing to do; Postgres maintains the index."""
+
+    def search(self, terms, offset, limit):
+        """Get ids of messages matching `terms`, ranked by ts_rank."""
+
+        query = db.func.websearch_to_tsquery(TEXT_SEARCH_CONFIG, terms)
+        vector = db.func.to_tsvector(TEXT_SEARCH_CONFIG, Message.text)
+
+        return db.session.scalars(
+            db.select(Message.id)
+            .where(vector.op('@@')(query))
+            .order_by(db.func.ts_rank(vector, query).desc(), Message.id.desc())
+            .offset(offset)
+            .limit(limit)).all()
+
+
+class InvertedIndex(ReloadingIndex):
+    """In-process inverted index of message words.
+
+    Maps each word to the messages containing it (and how often), and
+    ranks messages containing every search word by tf-idf.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._postings = defaultdict(dict)
+        self._words = {}
+
+    def __len__(self):
+        return len(self._words)
+
+    def add(self, message):
+        """Index a newly posted message."""
+
+        with self._lock:
+            index_message(self._postings, self._words, message.id,
+                          message.text)
+            self._note(message.id, message.text)
+
+    def remove(self, message_id):
+        """Drop a deleted message from the index."""
+
+        with self._lock:
+            unindex_message(self._postings, self._words, message_id)
+            self._note(message_id, None)
+
+    def load(self):
+        """Rebuild from the messages table."""
+
+        # from before the query, so nothing posted after it starts is lost
+        self._start_recording()
+        self.rebuild(db.session.execute(
+            db.select(Message.id, Message.text)
+            .execution_options(yield_per=10000)))
+
+    def rebuild(self, rows):
+        """Replace the index contents with (id, text) `rows`.
+
+        Searches use the old contents until the new ones are built.
+        """
+
+        self._start_recording()
+        postings = defaultdict(dict)
+        words = {}
+
+        for message_id, text in rows:
+            index_message(postings, words, message_id, text)
+
+        with self._lock:
+            for message_id, text in self._changes:
+                if text is None:
+                    unindex_message(postings, words, message_id)
+                else:
+                    index_message(postings, words, message_id, text)
+
+            self._postings = postings
+            self._words = words
+            self._finish_rebuild()
+
+    def search(self, terms, offset, limit):
+        """Get ids of messages containing every word in `terms`."""
+
+        words = set(tokenize(terms))
+        if not words:
+            return []
+
+        with self._lock:
+            postings = [self._postings.get(word, {}) for word in words]
+            if not all(postings):
+                return []
+
+            # intersect starting from the rarest word
+            postings.sort(key=len)
+            matches = set(postings[0]).intersection(*postings[1:])
+
+            total = len(self._words)
+            weighted = [(p, log(1 + total / len(p))) for p in postings]
+            scored = heapq.nlargest(
+                offset + limit,
+                ((sum(p[message_id] * idf for p, idf in weighted), message_id)
+                 for message_id in matches))
+
+        return [message_id for score, message_id in scored[offset:]]
+
+
+def make_search(backend):
+    """Make the search backend named by `backend` ('postgres' or 'memory')."""
+
+    if backend == 'postgres':
+        return PostgresSearch()
+
+    if backend == 'memory':
+        return InvertedIndex()
+
+    raise ValueError(f"Unknown search backend: {backend!r}")
@@ -1,20 +1,12 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
 
-from csv import DictReader
-from app import db
-from models import User, Message, Follows
+This loads the small sample data in generator/ from scratch; see
+bulk_load.py for loading (and resuming) larger datasets.
+"""
 
+from app import app, db
+from bulk_load import load
 
-db.drop_all()
-db.create_all()
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
-
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
-
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
-
-db.session.commit()
+load(db.engine, 'generator', restart=True,
+     max_followers=app.config['TIMELINE_FANOUT_MAX_FOLLOWERS'])
@@ -0,0 +1,194 @@
+"""Per-request SQL statement counts and timings, and a slow-query log.
+
+When enabled, listeners on the engine time every statement. For each Flask
+request we keep how many statements ran, the total time spent in the
+database and the slowest statement with the shape of its parameters (their
+names and types, never their values). In debug mode this is sent back in
+X-SQL-Stats and X-SQL-Slowest response headers, and any statement slower
+than the threshold is logged as one line of JSON to the "sql_stats.slow"
+logger:
+
+    {"duration_ms": 812.4, "endpoint": "users_show", "method": "GET",
+     "params": {"id_1": "int"}, "path": "/users/1", "statement": "SELECT ..."}
+
+When disabled, no listeners are attached, so statements cost nothing
+extra; the request hooks just check a flag.
+"""
+
+import json
+import logging
+from time import perf_counter
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+slow_logger = logging.getLogger('sql_stats.slow')
+
+HEADER = 'X-SQL-Stats'
+SLOWEST_HEADER = 'X-SQL-Slowest'
+
+
+def parameter_shape(parameters):
+    """The names and types of `parameters`, without their values.
+
+    executemany parameters (a list of parameter sets) are summarised as
+    the number of sets and the shape of the first.
+    """
+
+    if isinstance(parameters, dict):
+        return {name: type(value).__name__
+                for name, value in parameters.items()}
+
+    if isinstance(parameters, list):
+        if not parameters:
+            return []
+        return {'rows': len(parameters),
+                'each': parameter_shape(parameters[0])}
+
+    if isinstance(parameters, tuple):
+        return [type(value).__name__ for value in parameters]
+
+    return type(parameters).__name__
+
+
+class RequestStats:
+    """What the database did for one request."""
+
+    def __init__(self):
+        self.statements = 0
+        self.seconds = 0.0
+        self.slowest_seconds = 0.0
+        self.slowest_statement = None
+        self._slowest_parameters = None
+
+    def add(self, statement, parameters, seconds):
+        self.statements += 1
+        self.seconds += seconds
+
+        # keep a reference; the shape is only worked out if asked for
+        if seconds > self.slowest_seconds:
+            self.slowest_seconds = seconds
+            self.slowest_statement = statement
+            self._slowest_parameters = parameters
+
+    def headers(self):
+        """Response headers summarising the request's statements.
+
+        X-SQL-Stats is like "statements=3; db_ms=1.52; slowest_ms=0.81";
+        X-SQL-Slowest is the slowest statement and its parameter shape as
+        one line of JSON.
+        """
+
+        headers = {HEADER: f"statements={self.statements}; "
+                           f"db_ms={self.seconds * 1000:.2f}; "
+                           f"slowest_ms={self.slowest_seconds * 1000:.2f}"}
+
+        if self.slowest_statement is not None:
+            headers[SLOWEST_HEADER] = json.dumps({
+                'statement': ' '.join(self.slowest_statement.split()),
+                'params': parameter_shape(self._slowest_parameters),
+            }, sort_keys=True)
+
+        return headers
+
+
+class SQLStats:
+    """Engine listeners and request hooks that fill in `g.sql_stats`."""
+
+    def __init__(self):
+        self.enabled = False
+        self.slow_ms = 200.0
+        self.header = False
+        self._engine = None
+
+    def init_app(self, app, engine, enabled, slow_ms, header):
+        """Add the request hooks to `app`, and start timing `engine`'s
+        statements if `enabled`.
+
+        Call before the app's own before_request hooks are added, so the
+        queries they run are counted too.
+        """
+
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+
+        self.configure(engine, enabled, slow_ms, header)
+
+    def configure(self, engine, enabled, slow_ms, header):
+        """Turn timing on or off, and set the slow-query threshold (ms)
+        and whether to send the response header."""
+
+        if self.enabled:
+            self._remove_listeners()
+
+        self.slow_ms = slow_ms
+        self.header = header
+        self._engine = engine
+        self.enabled = enabled
+
+        if enabled:
+            self._add_listeners()
+
+    def _add_listeners(self):
+        event.listen(self._engine, 'before_cursor_execute',
+                     self.before_cursor_execute)
+        event.listen(self._engine, 'after_cursor_execute',
+                     self.after_cursor_execute)
+
+    def _remove_listeners(self):
+        event.remove(self._engine, 'before_cursor_execute',
+                     self.before_cursor_execute)
+        event.remove(self._engine, 'after_cursor_execute',
+                     self.after_cursor_execute)
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters,
+                              context, executemany):
+        # kept on the statement's execution context, which goes away with
+        # it, so nothing's left behind when a statement fails
+        if context is not None:
+            context._sql_stats_started = perf_counter()
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters,
+                             context, executemany):
+        started = getattr(context, '_sql_stats_started', None)
+        if started is None:
+            return
+        seconds = perf_counter() - started
+
+        in_request = has_request_context()
+        stats = g.get('sql_stats') if in_request else None
+        if stats is not None:
+            stats.add(statement, parameters, seconds)
+
+        if seconds * 1000 >= self.slow_ms:
+            self.log_slow(statement, parameters, seconds, in_request)
+
+    def log_slow(self, statement, parameters, seconds, in_request):
+        record = {
+            'duration_ms': round(seconds * 1000, 2),
+            'statement': statement,
+            'params': parameter_shape(parameters),
+        }
+
+        if in_request:
+            record.update(endpoint=request.endpoint, method=request.method,
+                          path=request.path)
+
+        slow_logger.warning(json.dumps(record, sort_keys=True))
+
+    def start_request(self):
+        if self.enabled:
+            g.sql_stats = RequestStats()
+
+    def finish_request(self, response):
+        # added first, so this runs after the app's other after_request
+        # hooks and they can still read g.sql_stats
+        stats = g.pop('sql_stats', None)
+
+        if stats is not None and self.header:
+            response.headers.update(stats.headers())
+
+        return response
+
+
+sql_stats = SQLStats()
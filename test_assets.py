@@ -0,0 +1,72 @@
+"""Static asset tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_assets.py
+
+
+import gzip
+import os
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from assets import assets
+
+
+def asset_url(path):
+    with app.test_request_context():
+        return assets.url(path)
+
+
+class AssetsTestCase(TestCase):
+    """Test fingerprinted static files."""
+
+    def setUp(self):
+        self.client = app.test_client()
+
+    def test_asset_url(self):
+        """Do pages link to hashed, long-cached static files?"""
+
+        html = self.client.get('/login').get_data(as_text=True)
+        css_url = asset_url('stylesheets/style.css')
+
+        self.assertRegex(css_url,
+                         r'^/assets/stylesheets/style\.[0-9a-f]{12}\.css$')
+        self.assertIn(f'href="{css_url}"', html)
+        self.assertNotIn('/static/stylesheets/style.css', html)
+
+        resp = self.client.get(css_url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Cache-Control'],
+                         'public, max-age=31536000, immutable')
+
+        # images the stylesheet uses are hashed too
+        self.assertIn(asset_url('images/nav-bg.png'),
+                      resp.get_data(as_text=True))
+
+        # unknown files get a plain static URL
+        self.assertEqual(asset_url('nope.txt'), '/static/nope.txt')
+        resp = self.client.get('/assets/nope.0123456789ab.txt')
+        self.assertIn('page does not exist', resp.get_data(as_text=True))
+        self.assertNotIn('immutable', resp.headers['Cache-Control'])
+
+    def test_compressed_asset(self):
+        """Are text assets sent compressed to browsers that accept it?"""
+
+        css_url = asset_url('stylesheets/style.css')
+
+        plain = self.client.get(css_url)
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertEqual(plain.headers['Vary'], 'Accept-Encoding')
+
+        resp = self.client.get(css_url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(resp.get_data()), plain.get_data())
+
+        # images are already compressed
+        resp = self.client.get(asset_url('images/warbler-logo.png'),
+                               headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(resp.mimetype, 'image/png')
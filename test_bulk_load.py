@@ -0,0 +1,143 @@
+"""Bulk loader tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_bulk_load.py
+
+
+import csv
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import db, create_indexes, Message, User, Follows, TimelineEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+import bulk_load
+
+db.create_all()
+
+USERS = [
+    ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url',
+     'location'],
+    ['one@test.com', 'one', '', 'not a hash', 'Hi, "I\'m" one.', '', ''],
+    ['two@test.com', 'two', '', 'not a hash', '', '', 'Somewhere'],
+    ['three@test.com', 'three', '', 'not a hash', '', '', ''],
+]
+MESSAGES = [
+    ['text', 'timestamp', 'user_id'],
+    ['first, with a comma', '2020-01-01 10:00:00.000000', '1'],
+    ['second', '2020-01-02 10:00:00.000000', '2'],
+    ['third', '2020-01-03 10:00:00.000000', '2'],
+]
+FOLLOWS = [
+    ['user_being_followed_id', 'user_following_id'],
+    ['2', '1'],
+    ['3', '1'],
+]
+
+
+class BulkLoadTestCase(TestCase):
+    """Test loading CSVs in chunks, and resuming a load."""
+
+    def setUp(self):
+        db.session.rollback()
+
+        self.dir = tempfile.TemporaryDirectory()
+        for name, rows in [('users', USERS), ('messages', MESSAGES),
+                           ('follows', FOLLOWS)]:
+            with open(os.path.join(self.dir.name, f"{name}.csv"), 'w',
+                      newline='') as csv_file:
+                csv.writer(csv_file).writerows(rows)
+
+    def tearDown(self):
+        self.dir.cleanup()
+        db.session.rollback()
+
+        for model in (TimelineEntry, Follows, Message, User):
+            model.query.delete()
+        db.session.commit()
+
+        # leave the schema whole, even if a load failed part way
+        bulk_load.checkpoints.drop(db.engine, checkfirst=True)
+        create_indexes(db.engine, log=lambda line: None)
+
+    def load(self, **kwargs):
+        return bulk_load.load(db.engine, self.dir.name, chunk_size=2,
+                              log=lambda line: None, **kwargs)
+
+    def test_load(self):
+        """Are rows loaded with line-number ids, and derived data built?"""
+
+        self.assertEqual(self.load(restart=True),
+                         {'users': 3, 'messages': 3, 'follows': 2})
+
+        one = db.session.get(User, 1)
+        self.assertEqual(one.username, 'one')
+        self.assertEqual(one.bio, 'Hi, "I\'m" one.')
+        self.assertIsNone(one.location)
+        self.assertEqual(one.following_count, 2)
+        self.assertEqual(db.session.get(User, 2).messages_count, 2)
+        self.assertEqual(db.session.get(Message, 1).text, 'first, with a comma')
+
+        # timelines were built, and indexes put back
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=1).count(), 3)
+        indexes = {index['name']
+                   for index in db.inspect(db.engine).get_indexes('messages')}
+        self.assertIn('ix_messages_user_id_timestamp', indexes)
+
+        # and new rows get ids after the loaded ones
+        user = User.signup('four', 'four@test.com', 'password', None)
+        db.session.commit()
+        self.assertEqual(user.id, 4)
+
+    def test_resume(self):
+        """Does an interrupted load carry on from its last chunk?"""
+
+        copy_rows = bulk_load.copy_rows
+        calls = []
+
+        def fail_on_messages(conn, table, columns, rows):
+            # fail on the second chunk of messages
+            if calls.count('messages') == 1 and table.name == 'messages':
+                raise RuntimeError("interrupted")
+            calls.append(table.name)
+            copy_rows(conn, table, columns, rows)
+
+        with patch('bulk_load.copy_rows', fail_on_messages):
+            with self.assertRaises(RuntimeError):
+                self.load(restart=True)
+
+        self.assertEqual(Message.query.count(), 2)
+
+        self.assertEqual(self.load(),
+                         {'users': 0, 'messages': 1, 'follows': 2})
+        self.assertEqual(Message.query.count(), 3)
+        self.assertEqual(db.session.get(Message, 3).text, 'third')
+        self.assertFalse(db.inspect(db.engine).has_table('bulk_load_checkpoints'))
+
+    def test_refuses_to_replace_data(self):
+        """Does a load with nothing to resume leave existing data alone?"""
+
+        db.session.add(User(id=100, username='existing',
+                            email='existing@test.com', password='not a hash'))
+        db.session.commit()
+
+        with self.assertRaises(bulk_load.DatabaseNotEmpty):
+            self.load()
+
+        self.assertEqual(db.session.get(User, 100).username, 'existing')
+        self.assertFalse(db.inspect(db.engine).has_table('bulk_load_checkpoints'))
+
+        # but an empty database is loaded, and --restart replaces the data
+        self.assertEqual(self.load(restart=True)['users'], 3)
+        self.assertIsNone(db.session.get(User, 100))
+
+        for model in (TimelineEntry, Follows, Message, User):
+            model.query.delete()
+        db.session.commit()
+
+        self.assertEqual(self.load()['users'], 3)
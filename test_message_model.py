@@ -1,7 +1,13 @@
 import os
+import tempfile
+from datetime import datetime
 from unittest import TestCase
 
-from models import db, User, Message, Follows, Likes
+from fragments import FragmentCache, SQLiteFragmentStore
+from migrate_likes import is_legacy, migrate
+from models import db, User, Message, Follows, Likes, merge_messages
+from reloading import ReloadingIndex
+from search import InvertedIndex
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
@@ -15,6 +21,7 @@ class MessageModelTestCase(TestCase):
 
         User.query.delete()
         Message.query.delete()
+        Likes.query.delete()
 
         self.client = app.test_client()
 
@@ -79,3 +86,168 @@ class MessageModelTestCase(TestCase):
         
         self.assertEqual(len(self.u1.likes), 1)
         self.assertTrue(self.u1.likes[0] == self.msg)
+
+    def test_message_liked_by_many(self):
+        """can more than one user like the same message"""
+
+        u2 = User.signup(username = 'testuser2', email = 'test2@test.com',
+                         password = 'password', image_url = None)
+        db.session.commit()
+
+        self.u1.likes.append(self.msg)
+        u2.likes.append(self.msg)
+        db.session.commit()
+
+        likers = db.session.scalars(
+            db.select(Likes.user_id).where(Likes.message_id == self.msg.id))
+        self.assertEqual(set(likers), {self.u1.id, u2.id})
+
+    def test_migrate_likes(self):
+        """does the likes migration carry old likes over to the new schema"""
+
+        db.session.add_all([
+            Message(id = 10001, text = 'older', user_id = 1000,
+                    timestamp = datetime(2020, 1, 1)),
+            Message(id = 10002, text = 'newer', user_id = 1000,
+                    timestamp = datetime(2021, 1, 1)),
+        ])
+        db.session.commit()
+
+        # put back the old surrogate-id table, with a gap in its ids
+        Likes.__table__.drop(db.engine)
+        legacy = db.Table('likes', db.MetaData(),
+                          db.Column('id', db.Integer, primary_key=True),
+                          db.Column('user_id', db.Integer),
+                          db.Column('message_id', db.Integer, unique=True))
+        legacy.create(db.engine)
+
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(legacy.insert(), [
+                    {'id': 3, 'user_id': 1000, 'message_id': 10001},
+                    {'id': 4, 'user_id': 1000, 'message_id': 10002},
+                    {'id': 9, 'user_id': None, 'message_id': 10000},
+                ])
+
+            self.assertEqual(migrate(db.engine, batch_size=2,
+                                     log=lambda line: None), 2)
+            self.assertIsNone(migrate(db.engine, log=lambda line: None))
+
+            likes = (Likes.query
+                     .filter(Likes.user_id == 1000)
+                     .order_by(Likes.created_at.desc())
+                     .all())
+            self.assertEqual([like.message_id for like in likes],
+                             [10002, 10001])
+            self.assertEqual(likes[0].created_at, datetime(2021, 1, 1))
+
+        finally:
+            db.session.rollback()
+            with db.engine.begin() as conn:
+                if is_legacy(conn):
+                    legacy.drop(conn)
+                    Likes.__table__.create(conn)
+
+    def test_merge_messages(self):
+        """does timeline merge keep the newest unique messages in order"""
+
+        older = Message(id = 1, text = 'older', timestamp = datetime(2020, 1, 1))
+        middle = Message(id = 2, text = 'middle', timestamp = datetime(2021, 1, 1))
+        newest = Message(id = 3, text = 'newest', timestamp = datetime(2022, 1, 1))
+
+        merged = merge_messages([[newest, older], [middle, older]], 2)
+
+        self.assertEqual(merged, [newest, middle])
+        self.assertEqual(merge_messages([[newest, older], [older]], 5),
+                         [newest, older])
+
+    def test_inverted_index(self):
+        """does the fallback search index rank and forget messages"""
+
+        index = InvertedIndex()
+        index.rebuild([(1, 'warble warble warble'),
+                       (2, 'a single warble among birds'),
+                       (3, 'birds of a feather')])
+
+        self.assertEqual(index.search('warble', 0, 10), [1, 2])
+        self.assertEqual(index.search('WARBLE birds', 0, 10), [2])
+        self.assertEqual(index.search('warble', 1, 10), [2])
+        self.assertEqual(index.search('nothing', 0, 10), [])
+
+        index.remove(2)
+        self.assertEqual(index.search('birds', 0, 10), [3])
+
+    def test_inverted_index_background_rebuild(self):
+        """is an old index rebuilt in the background, keeping changes made
+        while it rebuilds"""
+
+        user = User.signup("searcher", "searcher@test.com", "password", None)
+        db.session.commit()
+        db.session.add(Message(id = 1, text = 'first warble', user_id = user.id))
+        db.session.commit()
+
+        index = InvertedIndex()
+        index.refresh(300)
+        self.assertEqual(index.search('warble', 0, 10), [1])
+
+        # posted by another worker: seen once the index is rebuilt
+        db.session.add(Message(id = 2, text = 'second warble', user_id = user.id))
+        db.session.commit()
+        index.refresh(300)
+        self.assertEqual(index.search('warble', 0, 10), [1])
+
+        index._built_at -= 301
+        index.refresh(300)
+        thread = index._thread
+        if thread is not None:
+            thread.join()
+        self.assertEqual(index.search('warble', 0, 10), [2, 1])
+
+        # a message posted here while rows are being read isn't lost
+        index._start_recording()
+        index.add(Message(id = 3, text = 'third warble'))
+        index.rebuild([(1, 'first warble'), (2, 'second warble')])
+        self.assertEqual(index.search('warble', 0, 10), [3, 2, 1])
+
+    def test_reloading_index_needs_loader(self):
+        """does an index without a loader fail when it's made"""
+
+        class NoLoader(ReloadingIndex):
+            pass
+
+        with self.assertRaises(TypeError):
+            NoLoader()
+
+    def test_fragment_cache(self):
+        """are cards kept per author version, bounded, and shared"""
+
+        cache = FragmentCache(maxsize=2)
+        cache.set(1, 10, 'v1', '<p>one</p>')
+        cache.set(2, 10, 'v1', '<p>two</p>')
+
+        self.assertEqual(cache.get(1, 'v1'), '<p>one</p>')
+        self.assertIsNone(cache.get(1, 'v2'))
+
+        # 2 is least recently used
+        cache.set(3, 20, 'v1', '<p>three</p>')
+        self.assertIsNone(cache.get(2, 'v1'))
+        self.assertEqual(len(cache), 2)
+
+        cache.invalidate_author(10)
+        self.assertIsNone(cache.get(1, 'v1'))
+        cache.invalidate_message(3)
+        self.assertEqual(len(cache), 0)
+
+        # two workers sharing a store see each other's cards
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'fragments.sqlite3')
+            worker1 = FragmentCache(10, SQLiteFragmentStore(path))
+            worker2 = FragmentCache(10, SQLiteFragmentStore(path))
+
+            worker1.set(1, 10, 'v1', '<p>one</p>')
+            self.assertEqual(worker2.get(1, 'v1'), '<p>one</p>')
+            self.assertIsNone(worker2.get(1, 'v2'))
+
+            worker1.invalidate_author(10)
+            self.assertIsNone(FragmentCache(10, SQLiteFragmentStore(path))
+                              .get(1, 'v1'))
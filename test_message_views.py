@@ -5,10 +5,17 @@
 #    FLASK_ENV=production python -m unittest test_message_views.py
 
 
+import json
 import os
+import pstats
+import tempfile
+from datetime import datetime
 from unittest import TestCase
+from unittest.mock import patch
 
-from models import db, connect_db, Message, User
+from sqlalchemy.exc import DatabaseError
+
+from models import db, connect_db, Message, User, Follows, Likes, TimelineEntry
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -20,7 +27,11 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+from app import app, CURR_USER_KEY, message_search
+from fragments import fragments, profile_version
+from like_buffer import LikeBuffer, like_buffer
+from profiler import profiler
+from sql_stats import sql_stats, parameter_shape
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -41,6 +52,13 @@ class MessageViewTestCase(TestCase):
 
         User.query.delete()
         Message.query.delete()
+        Follows.query.delete()
+        Likes.query.delete()
+        TimelineEntry.query.delete()
+
+        # ids are reused from test to test, so drop cards rendered for
+        # the last test's messages
+        fragments.clear()
 
         self.client = app.test_client()
 
@@ -85,7 +103,245 @@ class MessageViewTestCase(TestCase):
             # grab message and make sure the text is correct
             msg = Message.query.filter(Message.text == 'test message').one()
             self.assertEqual(msg.text, "test message")
+            self.assertEqual(db.session.get(User, self.testuser.id).messages_count, 1)
     
+    def test_add_message_fan_out(self):
+        """Does a new message land in followers' timelines?"""
+
+        follower = User.signup(username="follower",
+                               email="follower@test.com",
+                               password="follower",
+                               image_url=None)
+        follower.id = 3000
+        db.session.add(Follows(user_being_followed_id = self.testuser.id,
+                               user_following_id = 3000))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "fan out message"})
+            msg = Message.query.filter(Message.text == 'fan out message').one()
+
+            timeline = {e.user_id for e in
+                        TimelineEntry.query.filter_by(message_id = msg.id)}
+            self.assertEqual(timeline, {self.testuser.id, 3000})
+
+            # deleting the message removes it from every timeline
+            c.post(f'/messages/{msg.id}/delete')
+            self.assertEqual(
+                TimelineEntry.query.filter_by(message_id = msg.id).count(), 0)
+
+    def test_add_message_high_follower_author(self):
+        """Are high-follower authors merged into timelines on read?"""
+
+        follower = User.signup(username="follower",
+                               email="follower@test.com",
+                               password="follower",
+                               image_url=None)
+        follower.id = 3000
+        db.session.commit()
+
+        app.config['TIMELINE_FANOUT_MAX_FOLLOWERS'] = 0
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = 3000
+
+                c.post(f'/users/follow/{self.testuser.id}')
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser.id
+
+                c.post("/messages/new", data={"text": "celebrity message"})
+                msg = Message.query.filter(Message.text == 'celebrity message').one()
+
+                # only the author's own timeline is written...
+                timeline = {e.user_id for e in
+                            TimelineEntry.query.filter_by(message_id = msg.id)}
+                self.assertEqual(timeline, {self.testuser.id})
+
+                # ...but followers still see it on their homepage
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = 3000
+
+                html = c.get('/').get_data(as_text=True)
+                self.assertIn('celebrity message', html)
+
+        finally:
+            app.config['TIMELINE_FANOUT_MAX_FOLLOWERS'] = 10000
+
+    def test_follow_backfill_limit(self):
+        """Does following copy only the author's most recent messages?"""
+
+        follower = User.signup(username="follower",
+                               email="follower@test.com",
+                               password="follower",
+                               image_url=None)
+        follower.id = 3000
+        for n in range(3):
+            db.session.add(Message(id = 3000 + n, text = f"message {n}",
+                                   timestamp = datetime(2020, 1, 1 + n),
+                                   user_id = self.testuser.id))
+        db.session.commit()
+
+        app.config['TIMELINE_FOLLOW_BACKFILL'] = 2
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = 3000
+
+                c.post(f'/users/follow/{self.testuser.id}')
+
+            # the newest is the message from setUp
+            self.assertEqual({e.message_id for e in
+                              TimelineEntry.query.filter_by(user_id = 3000)},
+                             {1000, 3002})
+
+        finally:
+            app.config['TIMELINE_FOLLOW_BACKFILL'] = 100
+
+    def test_high_follower_author_drops_under_threshold(self):
+        """Do messages posted while over the threshold stay in timelines
+        once the author drops back under it?"""
+
+        for user_id in (3000, 3001, 3002):
+            user = User.signup(username=f"follower{user_id}",
+                               email=f"follower{user_id}@test.com",
+                               password="follower",
+                               image_url=None)
+            user.id = user_id
+        db.session.commit()
+
+        app.config['TIMELINE_FANOUT_MAX_FOLLOWERS'] = 1
+
+        try:
+            with self.client as c:
+                for user_id in (3000, 3001):
+                    with c.session_transaction() as sess:
+                        sess[CURR_USER_KEY] = user_id
+                    c.post(f'/users/follow/{self.testuser.id}')
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser.id
+                c.post("/messages/new", data={"text": "celebrity message"})
+
+                # back down to one follower
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = 3001
+                c.post(f'/users/stop-following/{self.testuser.id}')
+                self.assertEqual(db.session.get(User, self.testuser.id)
+                                 .followers_count, 1)
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = 3000
+                html = c.get('/').get_data(as_text=True)
+                self.assertIn('celebrity message', html)
+
+                # and someone following now sees it too
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = 3002
+                c.post(f'/users/follow/{self.testuser.id}')
+                html = c.get('/').get_data(as_text=True)
+                self.assertIn('celebrity message', html)
+
+        finally:
+            app.config['TIMELINE_FANOUT_MAX_FOLLOWERS'] = 10000
+
+    def test_rebuild_skips_high_follower_authors(self):
+        """Do rebuilt timelines leave out high-follower authors' messages?"""
+
+        follower = User.signup(username="follower",
+                               email="follower@test.com",
+                               password="follower",
+                               image_url=None)
+        follower.id = 3000
+        db.session.add(Follows(user_being_followed_id = self.testuser.id,
+                               user_following_id = 3000))
+        db.session.add(Message(id = 3000, text = "celebrity message",
+                               user_id = self.testuser.id))
+        db.session.commit()
+
+        User.reconcile_counters()
+        TimelineEntry.rebuild(0)
+        db.session.commit()
+
+        timeline = {e.user_id for e in
+                    TimelineEntry.query.filter_by(message_id = 3000)}
+        self.assertEqual(timeline, {self.testuser.id})
+
+        TimelineEntry.rebuild(1)
+        db.session.commit()
+
+        timeline = {e.user_id for e in
+                    TimelineEntry.query.filter_by(message_id = 3000)}
+        self.assertEqual(timeline, {self.testuser.id, 3000})
+
+    def test_follow_high_follower_author(self):
+        """Does following a high-follower author leave the timeline alone?"""
+
+        follower = User.signup(username="follower",
+                               email="follower@test.com",
+                               password="follower",
+                               image_url=None)
+        follower.id = 3000
+        db.session.add(Message(id = 3000, text = "celebrity message",
+                               user_id = self.testuser.id))
+        db.session.commit()
+
+        app.config['TIMELINE_FANOUT_MAX_FOLLOWERS'] = 0
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = 3000
+
+                c.post(f'/users/follow/{self.testuser.id}')
+
+                self.assertEqual(
+                    TimelineEntry.query.filter_by(user_id = 3000).count(), 0)
+
+                html = c.get('/').get_data(as_text=True)
+                self.assertIn('celebrity message', html)
+
+        finally:
+            app.config['TIMELINE_FANOUT_MAX_FOLLOWERS'] = 10000
+
+    def test_search_messages(self):
+        """Can search messages, and do deleted ones drop out?"""
+
+        message_search.expire()
+
+        with self.client as c:
+            self.assertEqual(c.get('/api/search?q=fox').status_code, 401)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "the quick brown fox"})
+            c.post("/messages/new", data={"text": "a lazy brown dog"})
+
+            resp = c.get('/api/search?q=brown fox')
+            self.assertEqual([m['text'] for m in resp.json['messages']],
+                             ['the quick brown fox'])
+
+            resp = c.get('/api/search?q=Brown')
+            self.assertEqual(len(resp.json['messages']), 2)
+            self.assertFalse(resp.json['has_next'])
+
+            html = c.get('/search?q=dog').get_data(as_text=True)
+            self.assertIn('a lazy brown dog', html)
+            self.assertNotIn('the quick brown fox', html)
+
+            fox = Message.query.filter(Message.text == 'the quick brown fox').one()
+            c.post(f'/messages/{fox.id}/delete')
+
+            resp = c.get('/api/search?q=fox')
+            self.assertEqual(resp.json['messages'], [])
+
     def test_add_message_get(self):
         """Can view page only when logged in?"""
         with self.client as c:
@@ -161,4 +417,364 @@ class MessageViewTestCase(TestCase):
 
             self.assertEqual(unlike_resp.status_code, 302)
             self.assertEqual(unlike_resp.location, '/')
-            self.assertEqual(len(self.testuser.likes), 0)      
+            self.assertEqual(len(self.testuser.likes), 0)
+
+    def test_like_count(self):
+        """Do likes and unlikes keep the message's like count?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            other_user = User.signup(username="otheruser",
+                                     email="other@other.com",
+                                     password="otheruser",
+                                     image_url=None)
+            other_user.id = 2000
+            db.session.add(Message(id = 2000, text = 'likeable',
+                                   user_id = 2000))
+            db.session.commit()
+
+            # liking twice only counts once
+            c.post('/users/add_like/2000')
+            c.post('/users/add_like/2000')
+            self.assertEqual(db.session.get(Message, 2000).like_count, 1)
+
+            resp = c.get('/messages/2000')
+            self.assertIn('<i class="fa fa-thumbs-up"></i> 1',
+                          resp.get_data(as_text=True))
+
+            c.post('/users/remove_like/2000')
+            c.post('/users/remove_like/2000')
+            self.assertEqual(db.session.get(Message, 2000).like_count, 0)
+
+    def test_recount_likes(self):
+        """Does the bulk recount fix drifted like counts?"""
+
+        db.session.add(Likes(user_id = 1000, message_id = 1000))
+        db.session.commit()
+
+        self.assertEqual(Message.recount_likes(), 1)
+        self.assertEqual(Message.recount_likes(), 0)
+        db.session.commit()
+
+        self.assertEqual(db.session.get(Message, 1000).like_count, 1)
+
+    def test_like_write_behind(self):
+        """Are buffered likes visible to the liker, coalesced and written?"""
+
+        other_user = User.signup(username="otheruser",
+                                 email="other@other.com",
+                                 password="otheruser",
+                                 image_url=None)
+        other_user.id = 2000
+        db.session.add(Message(id = 2000, text = 'likeable', user_id = 2000))
+        db.session.commit()
+
+        like_buffer.enabled = True
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser.id
+
+                # like then unlike leaves one intent, which changes nothing
+                c.post('/users/add_like/2000')
+                c.post('/users/remove_like/2000')
+                self.assertEqual(len(like_buffer), 1)
+                html = c.get('/messages/2000').get_data(as_text=True)
+                self.assertIn('<i class="fa fa-thumbs-up"></i> 0', html)
+                like_buffer.flush()
+                self.assertEqual(len(like_buffer), 0)
+                self.assertEqual(Likes.query.count(), 0)
+                self.assertEqual(db.session.get(Message, 2000).like_count, 0)
+
+                c.post('/users/add_like/2000')
+                c.post('/users/add_like/2000')
+                self.assertEqual(len(like_buffer), 1)
+                self.assertEqual(Likes.query.count(), 0)
+
+                # the liker sees their like before it's written
+                html = c.get('/messages/2000').get_data(as_text=True)
+                self.assertIn('/users/remove_like/2000', html)
+                self.assertIn('<i class="fa fa-thumbs-up"></i> 1', html)
+
+                like_buffer.flush()
+                self.assertEqual(len(like_buffer), 0)
+                self.assertIsNotNone(db.session.get(Likes, (1000, 2000)))
+                self.assertEqual(db.session.get(Message, 2000).like_count, 1)
+
+                # and their own likes page writes their pending intents first
+                c.post('/users/remove_like/2000')
+                c.get('/users/1000/likes')
+                self.assertEqual(Likes.query.count(), 0)
+                self.assertEqual(db.session.get(Message, 2000).like_count, 0)
+
+        finally:
+            like_buffer.enabled = False
+            like_buffer.flush()
+
+    def test_like_write_behind_across_workers(self):
+        """Is an unlike queued in one worker applied after another worker's
+        queued like, and are likes by deleted users dropped?"""
+
+        other_user = User.signup(username="otheruser",
+                                 email="other@other.com",
+                                 password="otheruser",
+                                 image_url=None)
+        other_user.id = 2000
+        db.session.add(Message(id = 2000, text = 'likeable', user_id = 2000))
+        db.session.commit()
+
+        first, second = LikeBuffer(True), LikeBuffer(True)
+
+        # liked in one worker, unliked in another that can't see the like
+        first.like(1000, 2000)
+        second.unlike(1000, 2000, liked=False)
+        first.flush()
+        second.flush()
+
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(db.session.get(Message, 2000).like_count, 0)
+
+        # a like queued by a user deleted before it's written is dropped
+        first.like(2000, 2000)
+        first.like(1000, 2000)
+        db.session.delete(db.session.get(User, 2000))
+        db.session.add(Message(id = 2001, text = 'still here',
+                               user_id = 1000))
+        db.session.commit()
+        first.like(1000, 2001)
+        first.flush()
+
+        self.assertEqual(len(first), 0)
+        self.assertEqual({(like.user_id, like.message_id)
+                          for like in Likes.query}, {(1000, 2001)})
+
+    def test_like_write_behind_failures(self):
+        """Are intents that keep failing to write dropped, without holding
+        up other users'?"""
+
+        other_user = User.signup(username="otheruser",
+                                 email="other@other.com",
+                                 password="otheruser",
+                                 image_url=None)
+        other_user.id = 2000
+        db.session.add(Message(id = 2000, text = 'likeable', user_id = 2000))
+        db.session.commit()
+
+        buffer = LikeBuffer(True)
+        buffer.like(1000, 2000)
+        buffer.like(2000, 2000)
+
+        write = buffer._write
+
+        def failing_write(batch):
+            if 2000 in batch:
+                raise RuntimeError("can't write")
+            write(batch)
+
+        buffer._write = failing_write
+
+        buffer.flush()
+        self.assertEqual(len(buffer), 1)
+        self.assertIsNotNone(db.session.get(Likes, (1000, 2000)))
+
+        for _ in range(LikeBuffer.MAX_ATTEMPTS - 1):
+            buffer.flush()
+        self.assertEqual(len(buffer), 0)
+        self.assertIsNone(db.session.get(Likes, (2000, 2000)))
+
+    def test_like_write_behind_thread(self):
+        """Is the writer thread started by the first intent, and again by
+        the first one queued in a forked worker?"""
+
+        buffer = LikeBuffer(True, interval=3600)
+        buffer.init_app(app)
+        self.assertIsNone(buffer._thread)
+
+        buffer.like(1000, 1000)
+        parent = buffer._thread
+        parent_wake = buffer._wake
+        self.assertTrue(parent.is_alive())
+
+        buffer.unlike(1000, 1000)
+        self.assertIs(buffer._thread, parent)
+
+        # in a forked worker, only the intents it queues are its to write
+        with patch('like_buffer.os.getpid', return_value=os.getpid() + 1):
+            buffer.like(1000, 1000)
+
+        self.assertIsNot(buffer._thread, parent)
+        self.assertTrue(buffer._thread.is_alive())
+        self.assertEqual(len(buffer), 1)
+
+        buffer.close(app)
+        parent_wake.set()
+        parent.join()
+        self.assertIsNone(buffer._thread)
+        self.assertEqual(len(buffer), 0)
+        self.assertIsNotNone(db.session.get(Likes, (1000, 1000)))
+
+    def test_sql_stats(self):
+        """Are a request's statements counted, timed and logged when slow?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            # no header outside debug mode by default
+            resp = c.get('/messages/1000')
+            self.assertNotIn('X-SQL-Stats', resp.headers)
+
+            sql_stats.configure(db.engine, True, 0, True)
+
+            try:
+                # load the message afresh, rather than from the session
+                db.session.expire_all()
+                with self.assertLogs('sql_stats.slow', 'WARNING') as logs:
+                    resp = c.get('/messages/1000')
+
+                stats = dict(part.split('=')
+                             for part in resp.headers['X-SQL-Stats'].split('; '))
+                self.assertGreater(int(stats['statements']), 0)
+                self.assertGreaterEqual(float(stats['db_ms']),
+                                        float(stats['slowest_ms']))
+
+                slowest = json.loads(resp.headers['X-SQL-Slowest'])
+                self.assertIn('SELECT', slowest['statement'])
+
+                # every statement is over a 0ms threshold
+                self.assertEqual(len(logs.records), int(stats['statements']))
+                record = json.loads(logs.records[0].getMessage())
+                self.assertEqual(record['endpoint'], 'messages_show')
+                self.assertEqual(record['path'], '/messages/1000')
+                self.assertNotIn('setUP test message', logs.output[0])
+
+                # a failing statement leaves nothing behind on its connection
+                conn = db.session.connection()
+                info = {key: list(value) if isinstance(value, list) else value
+                        for key, value in conn.info.items()}
+                with self.assertRaises(DatabaseError):
+                    conn.execute(db.text("SELECT * FROM no_such_table"))
+                self.assertEqual(conn.info, info)
+                db.session.rollback()
+
+            finally:
+                sql_stats.configure(db.engine, app.config['METRICS'],
+                                    app.config['SQL_SLOW_QUERY_MS'],
+                                    app.config['SQL_STATS_HEADER'])
+
+        self.assertEqual(parameter_shape({'id_1': 1000, 'text': 'hi'}),
+                         {'id_1': 'int', 'text': 'str'})
+        self.assertEqual(parameter_shape([(1, 'a'), (2, 'b')]),
+                         {'rows': 2, 'each': ['int', 'str']})
+
+    def test_profile_request(self):
+        """Are requests with a valid token profiled into a bounded directory?"""
+
+        with tempfile.TemporaryDirectory() as directory, self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            profiler.configure(directory, 0, 2, 60)
+
+            try:
+                token = profiler.make_token(app.secret_key)
+
+                resp = c.get('/messages/1000', headers={'X-Profile': 'forged'})
+                self.assertNotIn('X-Profile-Id', resp.headers)
+                self.assertEqual(os.listdir(directory), [])
+
+                resp = c.get('/messages/1000', headers={'X-Profile': token})
+                name = resp.headers['X-Profile-Id']
+                self.assertIn('messages_show', name)
+
+                path = os.path.join(directory, name)
+                self.assertGreater(pstats.Stats(f"{path}.prof").total_tt, 0)
+
+                with open(f"{path}.json") as in_file:
+                    summary = json.load(in_file)
+                self.assertEqual(summary['path'], '/messages/1000')
+                self.assertEqual(summary['status'], 200)
+                self.assertGreater(summary['split_ms']['sql'], 0)
+                self.assertGreater(summary['split_ms']['templates'], 0)
+                self.assertGreater(summary['statements'], 0)
+
+                # only the newest two are kept
+                for _ in range(3):
+                    last = c.get('/messages/1000', headers={'X-Profile': token})
+                self.assertEqual(len(os.listdir(directory)), 4)
+                self.assertTrue(os.path.exists(os.path.join(
+                    directory, f"{last.headers['X-Profile-Id']}.prof")))
+                self.assertFalse(os.path.exists(f"{path}.prof"))
+
+            finally:
+                profiler.configure(app.config['PROFILE_DIR'],
+                                   app.config['PROFILE_SAMPLE_RATE'],
+                                   app.config['PROFILE_MAX_FILES'],
+                                   app.config['PROFILE_TOKEN_MAX_AGE'])
+
+    def test_show_message_conditional(self):
+        """Is a message page answered with 304 until it changes?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.get('/messages/1000')
+            etag = resp.headers['ETag']
+            self.assertEqual(resp.headers['Cache-Control'], 'private, no-cache')
+
+            resp = c.get('/messages/1000', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.get_data(), b'')
+            self.assertEqual(resp.headers['ETag'], etag)
+
+            # liking it changes what the page shows
+            c.post('/users/add_like/1000')
+            resp = c.get('/messages/1000', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers['ETag'], etag)
+
+            # so does another user looking at it
+            other = User.signup(username="other", email="other@test.com",
+                                password="password", image_url=None)
+            db.session.commit()
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = other.id
+            resp = c.get('/messages/1000',
+                         headers={'If-None-Match': resp.headers['ETag']})
+            self.assertEqual(resp.status_code, 200)
+
+            # forms and redirects still aren't stored
+            resp = c.post('/users/remove_like/1000')
+            self.assertEqual(resp.headers['Cache-Control'], 'no-store')
+
+    def test_message_card_cache(self):
+        """Are message cards cached, and re-rendered when they change?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            html = c.get('/users/1000').get_data(as_text=True)
+            self.assertIn('setUP test message', html)
+            self.assertIn('@testuser', html)
+            self.assertIsNotNone(fragments.get(
+                1000, profile_version(self.testuser)))
+
+            # editing the profile changes the author's cards
+            c.post('/users/profile', data={
+                'username': 'renamed', 'email': 'test@test.com',
+                'image_url': '/static/images/default-pic.png',
+                'header_image_url': '', 'bio': '', 'location': '',
+                'password': 'testuser'})
+            self.assertEqual(len(fragments), 0)
+
+            html = c.get('/users/1000').get_data(as_text=True)
+            self.assertIn('@renamed', html)
+            self.assertNotIn('@testuser', html)
+
+            c.post('/messages/1000/delete')
+            self.assertEqual(len(fragments), 0)
@@ -0,0 +1,136 @@
+"""Query budget tests.
+
+Each route gets a fixed budget of SQL statements per request, so a lazy
+load sneaking into a template loop (an N+1) fails the build.
+"""
+
+# run these tests like:
+#
+#    python -m unittest test_query_budgets.py
+
+
+import os
+from contextlib import contextmanager
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db, Message, User, Follows, Likes, TimelineEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from current_user import summaries
+from fragments import fragments
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+NUM_FOLLOWED = 20
+MESSAGES_EACH = 3
+
+# route -> most statements it may run, no matter how much data is shown
+BUDGETS = {
+    '/': 4,
+    '/api/timeline': 4,
+    '/users': 3,
+    '/users/1000': 3,
+    '/api/users/1001/messages': 3,
+    '/users/1000/following': 4,
+    '/users/1000/followers': 4,
+    '/users/1000/likes': 4,
+    '/messages/1001': 4,
+}
+
+
+@contextmanager
+def count_queries():
+    """Count SQL statements run inside the block; yields a list to check."""
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+
+
+class QueryBudgetTestCase(TestCase):
+    """Make sure list views don't issue a query per row."""
+
+    def setUp(self):
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        Likes.query.delete()
+        TimelineEntry.query.delete()
+
+        # ids are reused from test to test, so drop cards rendered for
+        # the last test's messages, and summaries of the last test's users
+        fragments.clear()
+        summaries.clear()
+
+        self.client = app.test_client()
+
+        testuser = User.signup(username="testuser",
+                               email="test@test.com",
+                               password="testuser",
+                               image_url=None)
+        testuser.id = 1000
+        db.session.add(testuser)
+
+        # testuser and each followed user follow each other, and
+        # testuser likes every message they've written
+        for i in range(1, NUM_FOLLOWED + 1):
+            user = User(id = 1000 + i,
+                        username = f"followed{i}",
+                        email = f"followed{i}@test.com",
+                        password = "HASHED_PASSWORD")
+            db.session.add(user)
+            db.session.add(Follows(user_being_followed_id = user.id,
+                                   user_following_id = 1000))
+            db.session.add(Follows(user_being_followed_id = 1000,
+                                   user_following_id = user.id))
+
+            for j in range(MESSAGES_EACH):
+                message_id = (1000 + i) * 10 + j
+                db.session.add(Message(id = message_id,
+                                       text = f"message {i}-{j}",
+                                       user_id = user.id))
+                db.session.add(Likes(user_id = 1000, message_id = message_id))
+
+        db.session.add(Message(id = 1001, text = "one", user_id = 1001))
+        db.session.commit()
+
+        User.reconcile_counters()
+        TimelineEntry.rebuild(app.config['TIMELINE_FANOUT_MAX_FOLLOWERS'])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_query_budgets(self):
+        """Does every route stay within its query budget?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1000
+
+            for url, budget in BUDGETS.items():
+                with self.subTest(url = url):
+                    # start each request with nothing cached in the session
+                    db.session.expunge_all()
+
+                    with count_queries() as statements:
+                        resp = c.get(url)
+
+                    self.assertEqual(resp.status_code, 200)
+                    self.assertLessEqual(
+                        len(statements), budget,
+                        f"{url} ran {len(statements)} queries:\n" +
+                        "\n".join(statements))
@@ -0,0 +1,207 @@
+"""Query plan tests.
+
+Seeds a largish dataset, requests the timeline, profile, follow and like
+pages, and EXPLAINs every statement they run, failing if any of them
+falls back to a sequential scan of a table (a missing or unusable index).
+Capturing the statements the pages actually run, rather than copies of
+them, means the plans checked are the ones the model and pagination code
+build, keyset filters, joins and all.
+"""
+
+# run these tests like:
+#
+#    python -m unittest test_query_plans.py
+
+
+import json
+import os
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db, Message, User, Follows, Likes, TimelineEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from current_user import summaries
+from fragments import fragments
+from pagination import encode_cursor
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+NUM_USERS = 2000
+FOLLOWS_EACH = 25
+MESSAGES_EACH = 20
+LIKES_EACH = 10
+
+# one user/message in the middle of the data, as the pages would ask for
+USER_ID = NUM_USERS // 2
+MESSAGE_ID = USER_ID * MESSAGES_EACH
+
+# statements that read rows (INSERTs of new rows don't scan anything)
+EXPLAINABLE = ('SELECT', 'UPDATE', 'DELETE')
+
+
+def hot_pages(cursor):
+    """(name, method, path) of each page to check, as user USER_ID;
+    `cursor` points into the middle of the messages, for second pages."""
+
+    return [
+        ('home timeline', 'GET', '/'),
+        ('home timeline, older page', 'GET', f'/?before={cursor}'),
+        ('home timeline, newer page', 'GET', f'/api/timeline?after={cursor}'),
+        ("user's messages", 'GET', f'/users/{USER_ID + 1}'),
+        ("user's messages, older page", 'GET',
+         f'/users/{USER_ID + 1}?before={cursor}'),
+        ('following', 'GET', f'/users/{USER_ID}/following'),
+        ('followers', 'GET', f'/users/{USER_ID}/followers'),
+        ("user's likes", 'GET', f'/users/{USER_ID}/likes'),
+        ('message', 'GET', f'/messages/{MESSAGE_ID}'),
+        ('like', 'POST', f'/users/add_like/{MESSAGE_ID}'),
+        ('unlike', 'POST', f'/users/remove_like/{MESSAGE_ID}'),
+        # last, as it changes what the pages above show
+        ('unfollow', 'POST', f'/users/stop-following/{USER_ID + 38}'),
+    ]
+
+
+@contextmanager
+def capture_statements():
+    """Collect the (statement, parameters) run inside the block."""
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(EXPLAINABLE):
+            statements.append((statement, parameters))
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+
+
+def delete_all():
+    for model in (TimelineEntry, Likes, Follows, Message, User):
+        model.query.delete()
+    db.session.commit()
+
+
+def seed():
+    """Insert NUM_USERS users, with follows, messages, likes and timelines."""
+
+    start = datetime(2020, 1, 1)
+    users = range(1, NUM_USERS + 1)
+
+    def followed(user_id):
+        return [(user_id + step * 37) % NUM_USERS + 1
+                for step in range(1, FOLLOWS_EACH + 1)]
+
+    db.session.execute(db.insert(User), [
+        {'id': user_id, 'email': f"user{user_id}@test.com",
+         'username': f"user{user_id}", 'password': 'not a real hash'}
+        for user_id in users])
+
+    db.session.execute(db.insert(Follows), [
+        {'user_following_id': user_id, 'user_being_followed_id': other_id}
+        for user_id in users for other_id in followed(user_id)])
+
+    messages = [
+        {'id': user_id * MESSAGES_EACH + n, 'user_id': user_id,
+         'text': f"message {n} from user {user_id}",
+         'timestamp': start + timedelta(minutes=user_id * 7 + n * 911)}
+        for user_id in users for n in range(MESSAGES_EACH)]
+    db.session.execute(db.insert(Message), messages)
+
+    db.session.execute(db.insert(Likes), [
+        {'user_id': user_id, 'message_id': (user_id * 13 + n * 97)
+         % len(messages) + MESSAGES_EACH, 'created_at': start}
+        for user_id in users for n in range(LIKES_EACH)])
+
+    # enough timeline entries for one page per user
+    db.session.execute(db.insert(TimelineEntry), [
+        {'user_id': user_id, 'message_id': message['id'],
+         'author_id': message['user_id'], 'timestamp': message['timestamp']}
+        for user_id in users
+        for other_id in followed(user_id)[:5]
+        for message in messages[(other_id - 1) * MESSAGES_EACH:
+                                other_id * MESSAGES_EACH]])
+
+    db.session.commit()
+    db.session.execute(db.text('ANALYZE'))
+    db.session.commit()
+
+
+def sequential_scans(statement, parameters):
+    """Names of tables the database would read in full to run `statement`."""
+
+    conn = db.session.connection()
+
+    if conn.dialect.name == 'postgresql':
+        plan = conn.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {statement}",
+                                    parameters).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+
+        scans = []
+        nodes = [plan[0]['Plan']]
+        while nodes:
+            node = nodes.pop()
+            if node['Node Type'] == 'Seq Scan':
+                scans.append(node['Relation Name'])
+            nodes.extend(node.get('Plans', []))
+        return scans
+
+    # SQLite: "SCAN <table>" reads it all, and so, near enough, does a
+    # skip-scan ("ANY(column)") through an index on the wrong columns;
+    # "SEARCH <table> USING INDEX" is what we want
+    rows = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}",
+                                parameters).all()
+    return [detail.split()[1] for *_, detail in rows
+            if detail.startswith('SCAN ') or 'ANY(' in detail]
+
+
+class QueryPlanTestCase(TestCase):
+    """Make sure the hot queries are all served by indexes."""
+
+    @classmethod
+    def setUpClass(cls):
+        delete_all()
+
+        # start from new connections, so none plans with stale statistics
+        db.session.close()
+        db.engine.dispose()
+
+        seed()
+
+    @classmethod
+    def tearDownClass(cls):
+        delete_all()
+
+    def test_hot_pages_use_indexes(self):
+        """Does every statement behind the hot pages avoid sequential scans?"""
+
+        cursor = encode_cursor(db.session.get(Message, MESSAGE_ID))
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = USER_ID
+
+            for name, method, path in hot_pages(cursor):
+                # nothing cached, so every query the page needs is run
+                summaries.clear()
+                fragments.clear()
+
+                with capture_statements() as statements:
+                    resp = c.open(path, method=method)
+                self.assertLess(resp.status_code, 400, name)
+
+                for statement, parameters in statements:
+                    with self.subTest(page=name, statement=statement):
+                        self.assertEqual(
+                            sequential_scans(statement, parameters), [])
@@ -6,9 +6,12 @@
 
 
 import os
+import tempfile
 from unittest import TestCase
 
 from models import db, User, Message, Follows
+from passwords import PasswordHasher, PasswordHasherBusy, hasher
+from ratelimit import MemoryStore, SQLiteStore
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -105,9 +108,85 @@ class UserModelTestCase(TestCase):
         self.assertTrue(len(self.u2.following) == 0)
         self.assertTrue(len(self.u2.followers) == 1)
 
+    def test_follow_checks(self):
+        """do the single and batch follow lookups agree with follows"""
+
+        self.u1.following.append(self.u2)
+        db.session.commit()
+
+        self.assertTrue(self.u1.is_following(self.u2))
+        self.assertFalse(self.u2.is_following(self.u1))
+        self.assertTrue(self.u2.is_followed_by(self.u1))
+        self.assertFalse(self.u1.is_followed_by(self.u2))
+
+        self.assertEqual(self.u1.following_ids([1000, 2000, 3000]), {2000})
+        self.assertEqual(self.u2.following_ids([1000, 2000]), set())
+        self.assertEqual(self.u2.followed_by_ids([1000, 3000]), {1000})
+        self.assertEqual(self.u1.followed_by_ids([]), set())
+
     def test_user_authenticate(self):
         """Does auth method only work for correct username and password"""
 
         self.assertFalse(self.u1.authenticate('testuser1', 'wrongpassword'))
         self.assertFalse(self.u1.authenticate('wrongusername', 'password'))
-        self.assertTrue(self.u1.authenticate('testuser1', 'password'), self.u1)
\ No newline at end of file
+        self.assertTrue(self.u1.authenticate('testuser1', 'password'), self.u1)
+
+    def test_user_authenticate_rehash(self):
+        """Does logging in redo hashes made with an old bcrypt cost"""
+
+        rounds = hasher.rounds
+        hasher.rounds = 4
+
+        try:
+            user = User.authenticate('testuser1', 'password')
+            self.assertTrue(user.password.startswith('$2b$04$'))
+            db.session.commit()
+
+            self.assertTrue(User.authenticate('testuser1', 'password'))
+            self.assertFalse(User.authenticate('testuser1', 'wrongpassword'))
+
+        finally:
+            hasher.rounds = rounds
+
+    def test_password_hasher_busy(self):
+        """Does a saturated hasher refuse work instead of queueing it"""
+
+        busy_hasher = PasswordHasher(rounds=4, workers=1, queue=0)
+        hashed = busy_hasher.hash('password')
+        self.assertTrue(busy_hasher.check(hashed, 'password'))
+
+        # take the only slot, as if a hash were already running
+        busy_hasher._slots.acquire()
+        with self.assertRaises(PasswordHasherBusy):
+            busy_hasher.check(hashed, 'password')
+
+    def test_rate_limit_buckets(self):
+        """Do both rate limit stores refuse attempts once a bucket is empty"""
+
+        with tempfile.TemporaryDirectory() as tmp:
+            stores = [MemoryStore(),
+                      SQLiteStore(os.path.join(tmp, 'ratelimit.sqlite3'))]
+
+            for store in stores:
+                # burst of 2, then one attempt every 10 seconds
+                self.assertEqual(store.take('ip:1', 2, 0.1, now=100), 0)
+                self.assertEqual(store.take('ip:1', 2, 0.1, now=100), 0)
+                self.assertAlmostEqual(store.take('ip:1', 2, 0.1, now=100), 10)
+
+                # other keys have their own buckets
+                self.assertEqual(store.take('ip:2', 2, 0.1, now=100), 0)
+
+                # and tokens come back over time
+                self.assertEqual(store.take('ip:1', 2, 0.1, now=111), 0)
+
+    def test_rate_limit_eviction(self):
+        """Does the in-memory store stay bounded, dropping idle buckets"""
+
+        store = MemoryStore(max_keys=3)
+        for i in range(5):
+            store.take(f"ip:{i}", 2, 0.1, now=100)
+        self.assertEqual(len(store), 3)
+
+        # full buckets are forgotten once idle long enough to refill
+        store.take('ip:new', 2, 0.1, now=200)
+        self.assertEqual(len(store), 1)
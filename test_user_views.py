@@ -1,13 +1,26 @@
+import atexit
+import json
 import os
+import tempfile
+from datetime import datetime, timedelta
 from unittest import TestCase
+from unittest.mock import patch
 
-from models import db, connect_db, Message, User, Follows, Likes
+from flask import session
+
+from models import db, connect_db, Message, User, Follows, Likes, TimelineEntry
 from sqlalchemy.exc import IntegrityError
 
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
-from app import app, CURR_USER_KEY
+from app import app, BUSY_MESSAGE, CURR_USER_KEY, login_limiter
+from current_user import CurrentUser, summaries
+from fragments import fragments
+from metrics import Metrics, metrics
+from passwords import hasher
+from ratelimit import MemoryStore
+from username_index import usernames
 
 db.create_all()
 
@@ -21,6 +34,13 @@ class UserViewTestCase(TestCase):
         Message.query.delete()
         Follows.query.delete()
         Likes.query.delete()
+        TimelineEntry.query.delete()
+
+        # ids are reused from test to test, so drop cards rendered for
+        # the last test's messages
+        fragments.clear()
+
+        login_limiter.store = MemoryStore()
 
         self.client = app.test_client()
 
@@ -88,6 +108,74 @@ class UserViewTestCase(TestCase):
             self.assertEqual(post_resp.status_code, 302)
             self.assertEqual(post_resp.location, '/')
 
+    def test_login_throttled(self):
+        """Are repeated logins refused before checking the password?"""
+
+        # no refills while the test runs, however slow bcrypt is
+        rate = login_limiter.rate
+        login_limiter.rate = 1e-9
+
+        try:
+            with self.client as c:
+                for _ in range(app.config['LOGIN_RATE_LIMIT_BURST']):
+                    resp = c.post('/login', data={"username": "testuser",
+                                                  "password": "wrongpassword"})
+                    self.assertEqual(resp.status_code, 200)
+
+                resp = c.post('/login', data={"username": "testuser",
+                                              "password": "testuser"})
+                self.assertEqual(resp.status_code, 429)
+                self.assertIn('Retry-After', resp.headers)
+                self.assertIn("Too many attempts", resp.get_data(as_text=True))
+                self.assertNotIn(CURR_USER_KEY, session)
+
+                # other usernames are still limited by the client's IP
+                resp = c.post('/signup', data={"username": "newuser",
+                                               "password": "newuser",
+                                               "email": "new@test.com"})
+                self.assertEqual(resp.status_code, 429)
+                self.assertIsNone(User.query.filter_by(username="newuser").first())
+
+        finally:
+            login_limiter.rate = rate
+
+    def test_login_throttled_per_forwarded_ip(self):
+        """Behind a trusted proxy, is each X-Forwarded-For client limited
+        separately, and the header ignored otherwise?"""
+
+        rate = login_limiter.rate
+        login_limiter.rate = 1e-9
+        proxy_fix = app.wsgi_app
+
+        def signup(ip, username):
+            return self.client.post(
+                '/signup', headers={'X-Forwarded-For': ip},
+                data={"username": username, "password": "newuser",
+                      "email": f"{username}@test.com"})
+
+        try:
+            proxy_fix.x_for = 1
+            for _ in range(app.config['LOGIN_RATE_LIMIT_BURST']):
+                resp = self.client.post(
+                    '/login', headers={'X-Forwarded-For': '203.0.113.1'},
+                    data={"username": "testuser", "password": "wrongpassword"})
+                self.assertEqual(resp.status_code, 200)
+
+            self.assertEqual(signup('203.0.113.1', "newuser").status_code, 429)
+            self.assertEqual(signup('203.0.113.2', "newuser").status_code, 302)
+
+            # untrusted, the header can't move a client to a fresh bucket
+            proxy_fix.x_for = 0
+            login_limiter.store = MemoryStore()
+            for _ in range(app.config['LOGIN_RATE_LIMIT_BURST']):
+                signup('203.0.113.3', "otheruser")
+            self.assertEqual(signup('203.0.113.4', "thirduser").status_code,
+                             429)
+
+        finally:
+            proxy_fix.x_for = app.config['TRUSTED_PROXY_HOPS']
+            login_limiter.rate = rate
+
     def test_logout(self):
         """Can logout?"""
         with self.client as c:
@@ -120,6 +208,57 @@ class UserViewTestCase(TestCase):
             self.assertIn('Sorry, no users found', search_html)
             self.assertEqual(search_resp.status_code, 200)
     
+    def test_list_users_ranking(self):
+        """Are search results ranked exact, then prefix, then substring?"""
+
+        for username in ['xother', 'other', 'otherwise']:
+            User.signup(username=username,
+                        email=f"{username}@test.com",
+                        password="password",
+                        image_url=None)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            html = c.get('/users?q=other').get_data(as_text=True)
+            found = [html.index(f'@{name}<') for name in
+                     ['other', 'otheruser', 'otherwise', 'xother']]
+            self.assertEqual(found, sorted(found))
+
+            # wildcards in the search are matched literally
+            html = c.get('/users?q=%25').get_data(as_text=True)
+            self.assertIn('Sorry, no users found', html)
+
+    def test_users_autocomplete(self):
+        """Does autocomplete find usernames by prefix?"""
+
+        usernames.expire()
+
+        with self.client as c:
+            resp = c.get('/api/users/autocomplete?q=OTH')
+            self.assertEqual(resp.status_code, 401)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.get('/api/users/autocomplete?q=OTH')
+            self.assertEqual(resp.json['users'],
+                             [{'id': 2000, 'username': 'otheruser'}])
+
+            # signing up adds the new user straight to the index
+            c.post("/signup", data={"username": "otherother",
+                                    "password": "otherother",
+                                    "email": "otherother@test.com"})
+            resp = c.get('/api/users/autocomplete?q=other')
+            self.assertEqual([u['username'] for u in resp.json['users']],
+                             ['otherother', 'otheruser'])
+
+            self.assertEqual(c.get('/api/users/autocomplete').json['users'], [])
+
+        usernames.expire()
+
     def test_users_show(self):
         """Make sure user page displays info."""
 
@@ -133,6 +272,54 @@ class UserViewTestCase(TestCase):
             self.assertIn(self.testuser.username, html)
             self.assertIn(self.test_message.text, html)
 
+    def test_users_show_pagination(self):
+        """Can page through a user's messages with cursors?"""
+
+        start = datetime(2020, 1, 1)
+        db.session.add_all([Message(text = f'old message {i}',
+                                    user_id = self.testuser.id,
+                                    timestamp = start + timedelta(minutes = i))
+                            for i in range(105)])
+        db.session.commit()
+
+        with self.client as c:
+            first = c.get('/api/users/1000/messages').json
+            self.assertEqual(len(first['messages']), 100)
+            self.assertEqual(first['messages'][0]['text'], 'test message 1')
+            self.assertIsNone(first['newer'])
+
+            second = c.get(f"/api/users/1000/messages?before={first['older']}").json
+            self.assertEqual([m['text'] for m in second['messages']],
+                             [f'old message {i}' for i in range(5, -1, -1)])
+            self.assertIsNone(second['older'])
+
+            # paging back up lands on the first page again
+            back = c.get(f"/api/users/1000/messages?after={second['newer']}").json
+            self.assertEqual(back['messages'], first['messages'])
+            self.assertIsNone(back['newer'])
+
+            # html view links to the next page
+            html = c.get('/users/1000').get_data(as_text=True)
+            self.assertIn(f"?before={first['older']}", html)
+
+            self.assertEqual(c.get('/users/1000?before=garbage').status_code, 400)
+
+    def test_homepage_json(self):
+        """Does the JSON home timeline include followed users' messages?"""
+
+        with self.client as c:
+            self.assertEqual(c.get('/api/timeline').status_code, 401)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post('/users/follow/2000')
+            resp = c.get('/api/timeline')
+
+            self.assertEqual([m['text'] for m in resp.json['messages']],
+                             ['test message 2'])
+            self.assertIsNone(resp.json['older'])
+
     def test_show_following(self):
         """Make sure following page shows all follows"""
         with self.client as c:
@@ -197,6 +384,25 @@ class UserViewTestCase(TestCase):
             self.assertEqual(get_resp.status_code, 200)
             self.assertIn(self.other_user_test_message.text, html)
 
+    def test_liked_state(self):
+        """Do timeline and likes pages show which messages I've liked?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post('/users/follow/2000')
+            html = c.get('/').get_data(as_text=True)
+            self.assertIn('/users/add_like/2000', html)
+
+            db.session.add(Likes(user_id = self.testuser.id, message_id = 2000))
+            db.session.commit()
+
+            for url in ['/', '/users/1000/likes', '/messages/2000']:
+                html = c.get(url).get_data(as_text=True)
+                self.assertIn('/users/remove_like/2000', html)
+                self.assertNotIn('/users/add_like/2000', html)
+
     def test_add_follow(self):
         """Can add and remove a follow?"""
 
@@ -218,6 +424,76 @@ class UserViewTestCase(TestCase):
             self.assertEqual(post_follow_resp.status_code, 302)
             self.assertEqual(post_follow_resp.location, '/users/1000/following')
 
+    def test_home_timeline(self):
+        """Does following/unfollowing update the home timeline?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            # other user's message shows up once we follow them
+            c.post('/users/follow/2000')
+            html = c.get('/').get_data(as_text=True)
+            self.assertIn('test message 2', html)
+
+            # and is gone again after we unfollow
+            c.post('/users/stop-following/2000')
+            html = c.get('/').get_data(as_text=True)
+            self.assertNotIn('test message 2', html)
+
+    def test_backfill_timelines(self):
+        """Does the backfill command build timelines from follows?"""
+
+        new_follow = Follows(user_being_followed_id = self.other_user.id,
+                             user_following_id = self.testuser.id)
+        db.session.add(new_follow)
+        db.session.commit()
+
+        result = app.test_cli_runner().invoke(args=['backfill-timelines'])
+        self.assertIn('Wrote 3 timeline entries', result.output)
+
+        entries = TimelineEntry.query.filter_by(user_id = self.testuser.id).all()
+        self.assertEqual({e.message_id for e in entries}, {1000, 2000})
+
+    def test_follow_counters(self):
+        """Do follow/unfollow keep the follow counters up to date?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post('/users/follow/2000')
+            self.assertEqual(db.session.get(User, 1000).following_count, 1)
+            self.assertEqual(db.session.get(User, 2000).followers_count, 1)
+
+            html = c.get('/users/2000').get_data(as_text=True)
+            self.assertIn('<a href="/users/2000/followers">1</a>', html)
+
+            c.post('/users/stop-following/2000')
+            self.assertEqual(db.session.get(User, 1000).following_count, 0)
+            self.assertEqual(db.session.get(User, 2000).followers_count, 0)
+
+    def test_reconcile_counters(self):
+        """Does the reconcile command fix drifted counters?"""
+
+        # rows added directly don't touch the counters
+        new_follow = Follows(user_being_followed_id = self.other_user.id,
+                             user_following_id = self.testuser.id)
+        db.session.add(new_follow)
+        db.session.commit()
+
+        result = app.test_cli_runner().invoke(args=['reconcile-counters'])
+        self.assertIn('Fixed counters for 2 users', result.output)
+
+        testuser = db.session.get(User, 1000)
+        other_user = db.session.get(User, 2000)
+        db.session.refresh(testuser)
+        db.session.refresh(other_user)
+
+        self.assertEqual(testuser.messages_count, 1)
+        self.assertEqual(testuser.following_count, 1)
+        self.assertEqual(other_user.followers_count, 1)
+
     def test_profile(self):
         """Can update profile info?"""
 
@@ -240,6 +516,54 @@ class UserViewTestCase(TestCase):
             self.assertEqual(post_resp.status_code, 200)
             self.assertIn('new improved test user name', html)
 
+    def test_profile_hasher_busy(self):
+        """Is a profile update refused with a 503 while the hasher is busy?"""
+
+        # take every slot in the hasher's queue
+        taken = 0
+        while hasher._slots.acquire(blocking=False):
+            taken += 1
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser.id
+
+                resp = c.post("/users/profile",
+                              data={"username": "busyuser",
+                                    "password": "testuser",
+                                    "email": "test@test.com"})
+
+                self.assertEqual(resp.status_code, 503)
+                self.assertIn(BUSY_MESSAGE.replace("'", "&#39;"),
+                              resp.get_data(as_text=True))
+                self.assertEqual(db.session.get(User, self.testuser.id)
+                                 .username, "testuser")
+
+        finally:
+            for _ in range(taken):
+                hasher._slots.release()
+
+    def test_current_user_cache(self):
+        """Is the current user's summary cached until invalidated?"""
+
+        summaries.invalidate(1000)
+        current = CurrentUser.get(1000)
+
+        self.assertEqual(current.username, 'testuser')
+        # fields outside the summary come from the full row
+        self.assertEqual(current.email, 'test@test.com')
+
+        User.query.filter_by(id = 1000).update({'username': 'renamed'})
+        db.session.commit()
+        self.assertEqual(CurrentUser.get(1000).username, 'testuser')
+
+        summaries.invalidate(1000)
+        self.assertEqual(CurrentUser.get(1000).username, 'renamed')
+        self.assertIsNone(CurrentUser.get(99999))
+
+        summaries.invalidate(1000)
+
     def test_delete_user(self):
         """Can delete profile?"""
         
@@ -251,3 +575,119 @@ class UserViewTestCase(TestCase):
 
             self.assertEqual(post_resp.status_code, 302)
             self.assertEqual(post_resp.location, '/signup')
+
+    def test_metrics(self):
+        """Are requests counted per endpoint, across worker processes?"""
+
+        metrics.reset()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.get('/users')
+            c.get('/users')
+            c.get('/no-such-page')
+
+            text = c.get('/metrics').get_data(as_text=True)
+
+        self.assertIn('warbler_http_requests_total{endpoint="list_users",'
+                      'method="GET",status="200"} 2', text)
+        # unrouted paths share one label, whatever the path
+        self.assertIn('warbler_http_requests_total{endpoint="none",'
+                      'method="GET",', text)
+        self.assertIn('warbler_http_request_duration_seconds_count'
+                      '{endpoint="list_users"} 2', text)
+        self.assertIn('warbler_http_request_duration_seconds_bucket'
+                      '{endpoint="list_users",le="+Inf"} 2', text)
+        self.assertIn('warbler_http_request_db_seconds_count'
+                      '{endpoint="list_users"} 2', text)
+        # the scrape itself
+        self.assertIn('warbler_http_requests_in_progress 1', text)
+
+        # another worker's counts are added in; its in-progress requests
+        # only while it's running
+        with tempfile.TemporaryDirectory() as directory:
+            metrics.directory = directory
+
+            try:
+                for pid, in_progress in [(os.getppid(), 2), (2 ** 22 + 1, 5)]:
+                    with open(os.path.join(directory, f"{pid}.json"),
+                              'w') as out:
+                        json.dump({'pid': pid, 'in_progress': in_progress,
+                                   'requests': [['list_users', 'GET', '200',
+                                                 3]],
+                                   'latency': {}, 'db_time': {}}, out)
+
+                text = metrics.exposition()
+
+            finally:
+                metrics.directory = None
+
+        self.assertIn('warbler_http_requests_total{endpoint="list_users",'
+                      'method="GET",status="200"} 8', text)
+        self.assertIn('warbler_http_requests_in_progress 2', text)
+
+    def test_metrics_writer_thread(self):
+        """Is the writer thread started by a worker's first request, and
+        again by the first one in a forked worker?"""
+
+        with tempfile.TemporaryDirectory() as directory:
+            worker = Metrics()
+            worker.enabled = True
+            worker.directory = directory
+            self.assertIsNone(worker._thread)
+
+            with app.test_request_context('/users'):
+                worker.start_request()
+                worker.record(200)
+            parent = worker._thread
+            self.assertTrue(parent.is_alive())
+
+            with app.test_request_context('/users'):
+                worker.start_request()
+                worker.record(200)
+            self.assertIs(worker._thread, parent)
+
+            # a forked worker starts its own, without the parent's counts
+            with patch('metrics.os.getpid', return_value=os.getpid() + 1):
+                with app.test_request_context('/users'):
+                    worker.start_request()
+                    worker.record(200)
+
+            self.assertIsNot(worker._thread, parent)
+            self.assertTrue(worker._thread.is_alive())
+            self.assertEqual(sum(worker.requests.values()), 1)
+
+            worker.close()
+            atexit.unregister(worker.close)
+            parent.join()
+            self.assertIsNone(worker._thread)
+            with open(os.path.join(directory, f"{os.getpid()}.json")) as in_file:
+                self.assertEqual(json.load(in_file)['requests'],
+                                 [['list_users', 'GET', '200', 1]])
+
+    def test_user_show_conditional(self):
+        """Is a profile answered with 304 until it changes?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1000
+
+            etag = c.get('/users/2000').headers['ETag']
+            resp = c.get('/users/2000', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+
+            # following them changes the follow button and their counts
+            c.post('/users/follow/2000')
+            resp = c.get('/users/2000', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Unfollow', resp.get_data(as_text=True))
+
+            # and a flashed message is always shown
+            etag = resp.headers['ETag']
+            with c.session_transaction() as sess:
+                sess['_flashes'] = [('success', 'Hello!')]
+            resp = c.get('/users/2000', headers={'If-None-Match': etag})
+            self.assertIn('Hello!', resp.get_data(as_text=True))
+            self.assertEqual(resp.headers['Cache-Control'], 'no-store')
@@ -0,0 +1,108 @@
+"""In-process prefix index over usernames, for search autocomplete.
+
+Usernames are kept in a sorted list of (lowercased username, id) keys, so
+a prefix lookup is a binary search plus a short scan. Each worker builds
+its own copy from the users table and rebuilds it in the background once
+it gets old (see reloading.py), so changes made by other workers show up
+within about `max_age` seconds.
+"""
+
+from bisect import bisect_left, insort
+
+from models import db, User
+from reloading import ReloadingIndex
+
+
+def add_name(keys, names, user_id, username):
+    discard_name(keys, names, user_id)
+    names[user_id] = username
+    insort(keys, (username.lower(), user_id))
+
+
+def discard_name(keys, names, user_id):
+    username = names.pop(user_id, None)
+
+    if username is not None:
+        key = (username.lower(), user_id)
+        i = bisect_left(keys, key)
+        if i < len(keys) and keys[i] == key:
+            del keys[i]
+
+
+class UsernameIndex(ReloadingIndex):
+    """Sorted prefix index of usernames."""
+
+    def __init__(self):
+        super().__init__()
+        self._keys = []
+        self._names = {}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def load(self):
+        """Rebuild from the users table."""
+
+        # from before the query, so nobody signing up after it starts is lost
+        self._start_recording()
+        self.rebuild(db.session.execute(
+            db.select(User.id, User.username)
+            .execution_options(yield_per=10000)))
+
+    def rebuild(self, rows):
+        """Replace the index contents with (id, username) `rows`."""
+
+        self._start_recording()
+        names = {user_id: username for user_id, username in rows}
+        keys = sorted((username.lower(), user_id)
+                      for user_id, username in names.items())
+
+        with self._lock:
+            for user_id, username in self._changes:
+                if username is None:
+                    discard_name(keys, names, user_id)
+                else:
+                    add_name(keys, names, user_id, username)
+
+            self._keys = keys
+            self._names = names
+            self._finish_rebuild()
+
+    def add(self, user_id, username):
+        """Add a user, or update their entry if they've been renamed."""
+
+        with self._lock:
+            add_name(self._keys, self._names, user_id, username)
+            self._note(user_id, username)
+
+    def remove(self, user_id):
+        """Remove a user from the index, if present."""
+
+        with self._lock:
+            discard_name(self._keys, self._names, user_id)
+            self._note(user_id, None)
+
+    def complete(self, prefix, limit=10):
+        """Get up to `limit` (id, username) pairs starting with `prefix`.
+
+        Matching ignores case; results are in alphabetical order.
+        """
+
+        prefix = prefix.lower()
+        results = []
+
+        with self._lock:
+            i = bisect_left(self._keys, (prefix,))
+
+            while len(results) < limit and i < len(self._keys):
+                name, user_id = self._keys[i]
+                if not name.startswith(prefix):
+                    break
+
+                results.append((user_id, self._names[user_id]))
+                i += 1
+
+        return results
+
+
+usernames = UsernameIndex()